@@ -0,0 +1,141 @@
+"""
+Times taxodist on synthetic taxonomies (see synthetic.py) at several scales and compares the results with a stored baseline. \n
+Run from the repository root, e.g. \n
+python benchmarks/run_benchmarks.py --scales small medium --baseline benchmarks/baselines/baseline.json \n
+Results are written as JSON (--output). Every benchmark is reported with its slowdown ratio (best time / best time of the baseline),
+ratios above --tolerance (and at least --min-slowdown seconds slower) count as regressions and make the run exit with status 1. --save-baseline stores the results as new baseline.
+Baselines are only comparable on the same machine.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from timeit import default_timer as timer
+import numpy as np
+sys.path.append(os.getcwd())
+from src.taxodist import td_utils as utils
+from src.taxodist.td_calc import Taxodist
+from src.taxodist.td_taxonomy import CompiledTaxonomy
+from benchmarks import synthetic
+
+IC_MODES = ('levels','sanchez')
+CS_MODES = ('wu_palmer','li','simple_wu_palmer','leacock_chodorow','nguyen_almubaid','batet','path_based')
+SETSIM_MODES = ('jaccard','dice','cosine','overlap','mean_cs','hierarchical','bipartite_matching')
+
+# nodes of the synthetic trees, concepts of the distance matrices, number and size range of the concept sets
+SCALES = {
+    'small': {'nodes': 1000, 'concepts': 300, 'sets': 100, 'set_size': (2, 8)},
+    'medium': {'nodes': 10000, 'concepts': 1500, 'sets': 500, 'set_size': (2, 12)},
+    'large': {'nodes': 17000, 'concepts': 5000, 'sets': 2000, 'set_size': (2, 15)},
+}
+BASELINE_PATH = os.path.join('benchmarks', 'baselines', 'baseline.json')
+
+def timeCall(function, repeat: int) -> dict:
+    """Returns the best and mean wall time of repeat calls of function."""
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        function()
+        times.append(timer() - start)
+    return {'best': min(times), 'mean': statistics.mean(times), 'runs': repeat}
+
+def getBenchmarks(scale: str, shape: str, max_workers: int):
+    """
+    Yields (name, parameters, function) for all benchmarks of a scale and tree shape: \n
+    compile - compiling the treelib tree to a td_taxonomy.CompiledTaxonomy \n
+    distance - calc_distance_with_concepts for every ic and cs mode except batet \n
+    set_sim, set_sim_par - calc_set_sim and calc_set_sim_par for every setsim mode, with levels and wu_palmer
+    """
+    params = SCALES[scale]
+    tree = synthetic.getSyntheticTree(shape, params['nodes'])
+    concepts = sorted(utils.getAllConcepts(tree), key=str)
+    concepts = [concepts[i] for i in np.random.default_rng(42).choice(len(concepts), min(params['concepts'], len(concepts)), replace=False)]
+    sets = synthetic.getRandomConceptSets(tree, params['sets'], *params['set_size'])
+    prefix = '/'.join((scale, shape))
+    sizes = {'nodes': tree.size(), 'depth': tree.depth()}
+
+    yield prefix + '/compile', sizes, lambda: CompiledTaxonomy(tree)
+    # compiled and memorized once for all following benchmarks
+    utils.getCompiledTaxonomy(tree)
+    for ic_mode in IC_MODES:
+        # batet is not defined for identical concepts, i.e. the diagonal of distance matrices
+        for cs_mode in [cs_mode for cs_mode in CS_MODES if cs_mode != 'batet']:
+            yield ('/'.join((prefix, 'distance', ic_mode, cs_mode)), dict(sizes, concepts=len(concepts)),
+                   lambda ic_mode=ic_mode, cs_mode=cs_mode: Taxodist().calc_distance_with_concepts(concepts, tree, ic_mode, cs_mode, max_workers=max_workers))
+    for setsim_mode in SETSIM_MODES:
+        yield ('/'.join((prefix, 'set_sim', setsim_mode)), dict(sizes, sets=len(sets)),
+               lambda setsim_mode=setsim_mode: Taxodist().calc_set_sim(sets, tree, 'levels', 'wu_palmer', setsim_mode))
+        yield ('/'.join((prefix, 'set_sim_par', setsim_mode)), dict(sizes, sets=len(sets)),
+               lambda setsim_mode=setsim_mode: Taxodist().calc_set_sim_par(sets, tree, 'levels', 'wu_palmer', setsim_mode, max_workers=max_workers))
+
+def runBenchmarks(scales: list, shapes: list, repeat: int = 3, max_workers: int = 1, filter: str = None) -> dict:
+    """Runs all benchmarks of the given scales and tree shapes whose name contains filter, returns the results as dict."""
+    results = {}
+    for scale in scales:
+        for shape in shapes:
+            for name, params, function in getBenchmarks(scale, shape, max_workers):
+                if filter is not None and filter not in name:
+                    continue
+                results[name] = dict(timeCall(function, repeat), params=params)
+                print('%-60s %10.4f s' % (name, results[name]['best']))
+    meta = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'repeat': repeat, 'max_workers': max_workers, 'scales': {scale: SCALES[scale] for scale in scales}}
+    return {'meta': meta, 'results': results}
+
+def compareResults(results: dict, baseline: dict, tolerance: float = 1.25, min_slowdown: float = 0.005) -> tuple:
+    """
+    Returns the slowdown ratio (best time / best time of the baseline) of every benchmark that is also in the baseline
+    and the names of the regressions, i.e. ratios above tolerance that are also at least min_slowdown seconds slower
+    (the timer noise of millisecond benchmarks easily exceeds the tolerance). Prints the ratios with the regressions marked.
+    """
+    ratios, regressions = {}, []
+    for name, result in results['results'].items():
+        if name in baseline['results']:
+            baseline_time = baseline['results'][name]['best']
+            ratios[name] = result['best']/max(baseline_time, 1e-9)
+            if ratios[name] > tolerance and result['best'] - baseline_time >= min_slowdown:
+                regressions.append(name)
+    for name, ratio in sorted(ratios.items(), key=lambda item: -item[1]):
+        print('%-60s %8.2fx%s' % (name, ratio, '  REGRESSION' if name in regressions else ''))
+    return ratios, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Times taxodist on synthetic taxonomies.')
+    parser.add_argument('--scales', nargs='+', default=['small'], choices=list(SCALES))
+    parser.add_argument('--shapes', nargs='+', default=list(synthetic.TREE_SHAPES), choices=list(synthetic.TREE_SHAPES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-workers', type=int, default=1)
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this string')
+    parser.add_argument('--output', default=os.path.join('benchmarks', 'results.json'))
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=1.25, help='largest slowdown ratio that is no regression')
+    parser.add_argument('--min-slowdown', type=float, default=0.005, help='smallest slowdown in seconds that counts as regression')
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.scales, args.shapes, args.repeat, args.max_workers, args.filter)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    regressions = []
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        results['ratios'], regressions = compareResults(results, baseline, args.tolerance, args.min_slowdown)
+        results['regressions'] = regressions
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(len(regressions), 'regression(s) above', args.tolerance)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import random
+import string
+import treelib
+from treelib.tree import Tree
+
+TREE_SHAPES = ('balanced','skewed','icd10')
+ROMAN_NUMERALS = ('I','II','III','IV','V','VI','VII','VIII','IX','X','XI','XII','XIII','XIV','XV','XVI','XVII','XVIII','XIX','XX','XXI','XXII')
+
+def getBalancedTree(size: int, fanout: int = 5) -> Tree:
+    """Returns a complete tree with size nodes, in which every inner node but the last has fanout children (filled level by level)."""
+    tree = treelib.Tree()
+    tree.create_node('root', 0)
+    for i in range(1, size):
+        tree.create_node(i, i, parent=(i - 1)//fanout)
+    return tree
+
+def getSkewedTree(size: int, chain_probability: float = 0.3, seed: int = 42) -> Tree:
+    """
+    Returns a random tree with size nodes and uneven fanout and depth. \n
+    Every new node continues the chain of the previous node with chain_probability, otherwise it is attached by preferential
+    attachment (a node with k children is picked with a probability proportional to k + 1), which yields a few very wide nodes.
+    """
+    rng = random.Random(seed)
+    tree = treelib.Tree()
+    tree.create_node('root', 0)
+    # every node appears once plus once per child
+    attachment = [0]
+    for i in range(1, size):
+        parent = i - 1 if rng.random() < chain_probability else rng.choice(attachment)
+        tree.create_node(i, i, parent=parent)
+        attachment.append(parent)
+        attachment.append(i)
+    return tree
+
+def getICD10LikeTree(blocks: int = 11, codes: int = 7, modifiers: int = 8, chapters: int = 22, seed: int = 42) -> Tree:
+    """
+    Returns a random tree shaped like ICD-10: chapters (I, II, ...) with blocks (A00-A09), three-character codes (A00)
+    and four-character modifiers (A00.0). \n
+    blocks, codes and modifiers are the mean fanouts per chapter, block and code. Blocks and codes have at least one child,
+    codes may have no modifiers and are leaves then. The defaults give about the size of ICD-10-GM.
+    """
+    rng = random.Random(seed)
+    tree = treelib.Tree()
+    tree.create_node('ICD-10', 0)
+    letters = string.ascii_uppercase
+    code_number = 0
+    for c in range(chapters):
+        chapter = ROMAN_NUMERALS[c] if c < len(ROMAN_NUMERALS) else 'C' + str(c + 1)
+        tree.create_node(chapter, chapter, parent=0)
+        for _ in range(rng.randint(1, 2*blocks - 1)):
+            block_codes = []
+            for _ in range(rng.randint(1, 2*codes - 1)):
+                # A00 to Z99, then A00_1 and so on for very large trees
+                code = letters[code_number//100 % len(letters)] + '%02d' % (code_number % 100)
+                block_codes.append(code if code_number < 2600 else code + '_' + str(code_number//2600))
+                code_number += 1
+            block = block_codes[0] + '-' + block_codes[-1]
+            tree.create_node(block, block, parent=chapter)
+            for code in block_codes:
+                tree.create_node(code, code, parent=block)
+                for m in range(rng.randint(0, 2*modifiers)):
+                    modifier = code + '.' + str(m)
+                    tree.create_node(modifier, modifier, parent=code)
+    return tree
+
+def getSyntheticTree(shape: str, size: int, seed: int = 42) -> Tree:
+    """Returns a synthetic taxonomy of the given shape ('balanced', 'skewed' or 'icd10') with about size nodes."""
+    if shape == 'balanced':
+        return getBalancedTree(size)
+    elif shape == 'skewed':
+        return getSkewedTree(size, seed=seed)
+    elif shape == 'icd10':
+        # scales the mean fanouts of the ICD-10-GM proportions (11 blocks, 7 codes, 8 modifiers, about 17000 nodes)
+        factor = (size/17000)**(1/3)
+        return getICD10LikeTree(max(1, round(11*factor)), max(1, round(7*factor)), max(1, round(8*factor)), seed=seed)
+    raise ValueError('Unsupported tree shape: ', shape)
+
+def getRandomConceptSets(tree: Tree, n_sets: int, min_size: int = 1, max_size: int = 10, leaves_only: bool = False, seed: int = 42) -> list:
+    """
+    Returns n_sets random concept sets (lists of distinct node identifiers, e.g. the diagnoses of patients) of min_size to max_size
+    concepts of the tree, drawn from its leaves only if leaves_only is set. The root is never drawn.
+    """
+    rng = random.Random(seed)
+    if leaves_only:
+        concepts = [node.identifier for node in tree.leaves()]
+    else:
+        concepts = [node.identifier for node in tree.all_nodes() if node.identifier != tree.root]
+    concepts.sort(key=str)
+    max_size = min(max_size, len(concepts))
+    return [rng.sample(concepts, rng.randint(min(min_size, max_size), max_size)) for _ in range(n_sets)]
@@ -16,5 +16,7 @@ setup(
     include_package_data=True,
     packages=find_packages(),
     python_requires=">=3.9.6",
-    install_requires=['openpyxl','xml.etree.ElementTree','concurrent.futures','scipy>=1.3.1','numpy>=1.16.5', 'scikit-learn>=0.21.3', 'pandas>=0.25.1', 'treelib==1.6.1']
+    install_requires=['openpyxl','xml.etree.ElementTree','concurrent.futures','scipy>=1.3.1','numpy>=1.17', 'scikit-learn>=0.21.3', 'pandas>=0.25.1', 'treelib==1.6.1'],
+    # optional writers of td_writers
+    extras_require={'parquet': ['pyarrow'], 'hdf5': ['h5py']}
 )
\ No newline at end of file
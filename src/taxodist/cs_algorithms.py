@@ -2,8 +2,11 @@ import sys
 import os
 sys.path.append(os.getcwd())
 from src.taxodist import td_utils as utils
+from src.taxodist.td_taxonomy import CompiledTaxonomy
 import math
+import numpy as np
 from treelib import Tree
+from numpy import ndarray
 
 def getCSLi(ic_1,ic_2,ic_lca):
     """
@@ -52,6 +55,14 @@ def getCSBatet(concept1: str, concept2: str, tree: Tree):
         if concept1 == concept2:
             raise ValueError('Batet measure does not support identical concept comparisons.')
 
+        if isinstance(tree, CompiledTaxonomy):
+            # ancestor sets include the concept itself, so they only differ below the LCA
+            id_1, id_2 = tree.ids[concept1], tree.ids[concept2]
+            depth_1, depth_2 = int(tree.depths[id_1]), int(tree.depths[id_2])
+            depth_lca = int(tree.depths[tree.get_lca_ids(id_1, id_2)])
+            all_ancestors_cnt = depth_1 + depth_2 - depth_lca + 1
+            return -math.log2( (depth_1 + depth_2 - 2*depth_lca) / all_ancestors_cnt )
+
         ancestors_1 = utils.getAncestors(concept1,tree)
         ancestors_1.add(concept1)
 
@@ -69,4 +80,41 @@ def getCSBatet(concept1: str, concept2: str, tree: Tree):
 def getPathBasedDist(concept1: str, concept2: str, tree: Tree, depth) -> float:
     depth_1 = tree.depth(concept1)
     depth_2 = tree.depth(concept2)
-    return depth/(depth_1+depth_2)
\ No newline at end of file
+    return depth/(depth_1+depth_2)
+
+######################### BATCH KERNELS #########################
+# Element-wise NumPy versions of the measures above. All arguments are arrays of equal
+# (or broadcastable) shape, the result holds one CS value per element.
+
+def getCSLiBatch(ic_1: ndarray, ic_2: ndarray, ic_lca: ndarray) -> ndarray:
+    """ Batch version of getCSLi """
+    return np.exp(0.2*(ic_1 + ic_2 - 2*ic_lca))*(np.exp(0.6*ic_lca)-np.exp(-0.6*ic_lca))/(np.exp(0.6*ic_lca)+np.exp(-0.6*ic_lca))
+
+def getCSWuPalmerBatch(ic_1: ndarray, ic_2: ndarray, ic_lca: ndarray) -> ndarray:
+    """ Batch version of getCSWuPalmer """
+    return (2*ic_lca)/(ic_1+ic_2)
+
+def getCSSimpleWuPalmerBatch(ic_lca: ndarray, depth: int) -> ndarray:
+    """ Batch version of getCSSimpleWuPalmer """
+    return 1-(depth - ic_lca)/depth
+
+def getCSLeacockChodorowBatch(ic_1: ndarray, ic_2: ndarray, ic_lca: ndarray, max_ic: float) -> ndarray:
+    """ Batch version of getCSLeacockChodorow, max_ic is the taxonomy's maximum IC (the depth for 'levels') """
+    return -np.log((ic_1+ic_2-2*ic_lca+1)/(2*max_ic))
+
+def getCSNguyenAlMubaidBatch(depth_1: ndarray, depth_2: ndarray, depth_lca: ndarray, depth: int) -> ndarray:
+    """ Batch version of getCSNguyenAlMubaid, based on the depths of the concepts and their LCA """
+    shortest_path = depth_1 + depth_2 - 2*depth_lca
+    return np.log((shortest_path-1)*(depth - depth_lca)+1)
+
+def getCSBatetBatch(depth_1: ndarray, depth_2: ndarray, depth_shared: ndarray) -> ndarray:
+    """
+    Batch version of getCSBatet. \n
+    depth_shared is the depth of the deepest node in both ancestor sets, i.e. the LCA where a concept is its own ancestor.
+    """
+    all_ancestors_cnt = depth_1 + depth_2 - depth_shared + 1
+    return -np.log2( (depth_1 + depth_2 - 2*depth_shared) / all_ancestors_cnt )
+
+def getPathBasedDistBatch(depth_1: ndarray, depth_2: ndarray, depth: int) -> ndarray:
+    """ Batch version of getPathBasedDist """
+    return depth/(depth_1+depth_2)
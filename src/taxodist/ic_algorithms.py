@@ -3,12 +3,17 @@ import sys
 import os
 sys.path.append(os.getcwd())
 from src.taxodist import td_utils as utils
+from src.taxodist.td_taxonomy import CompiledTaxonomy
 import math
+import numpy as np
+from numpy import ndarray
 
 def getICSanchez(concept: str, tree: Tree):
     """IC calculation based on Sánchez et al. https://doi.org/10.1016/j.knosys.2010.10.001"""
     if concept == tree.root:
         return 0.0
+    if isinstance(tree, CompiledTaxonomy):
+        return float(utils.getICVector(tree, 'sanchez')[tree.ids[concept]])
     
     # we have to add 1 to this set, because Sánchez et al. defined the set of subsumer so, 
     # that the concept itself is part of the set
@@ -24,3 +29,29 @@ def getICSanchez(concept: str, tree: Tree):
 
     all_leaves_cnt = len(tree.leaves()) 
     return -math.log( ( (subtree_leaves_cnt/subsumers) + 1)/(all_leaves_cnt+1) )
+
+def getLeafCounts(tree: CompiledTaxonomy) -> ndarray:
+    """
+    Returns the number of leaves below every node of a compiled taxonomy (0 for leaves themselves).
+    Subtrees are contiguous id-ranges, so a prefix sum over the leaf flags covers all nodes in one pass.
+    """
+    ids = np.arange(len(tree), dtype=np.int64)
+    is_leaf = tree.subtree_ends == ids + 1
+    leaves_before = np.concatenate(([0], np.cumsum(is_leaf)))
+    leaf_counts = leaves_before[tree.subtree_ends] - leaves_before[ids]
+    leaf_counts[is_leaf] = 0
+    return leaf_counts
+
+def getICVectorLevels(tree: CompiledTaxonomy) -> ndarray:
+    """IC of every node of a compiled taxonomy based on its level, see td_utils.getIC"""
+    return tree.depths.astype(np.float64)
+
+def getICVectorSanchez(tree: CompiledTaxonomy) -> ndarray:
+    """IC of every node of a compiled taxonomy based on Sánchez et al., same values as getICSanchez"""
+    leaf_counts = getLeafCounts(tree)
+    subsumers = tree.depths.astype(np.float64) + 1
+    all_leaves_cnt = np.count_nonzero(tree.subtree_ends == np.arange(1, len(tree) + 1))
+    ic = -np.log( ( (leaf_counts/subsumers) + 1)/(all_leaves_cnt+1) )
+    # subsumer(root) = 1 according to Sánchez at el.
+    ic[0] = 0.0
+    return ic
@@ -3,11 +3,18 @@ import sys
 import os
 sys.path.append(os.getcwd())
 from src.taxodist import td_utils as utils
+from src.taxodist.td_cache import CSCache
 from treelib import Tree
 import warnings
+import itertools
+import functools
+import numpy as np
 from scipy.optimize import linear_sum_assignment
 from sklearn import preprocessing
 
+# small assignment problems with at most this many possible assignments are solved by enumeration
+MAX_ENUMERATED_ASSIGNMENTS = 720
+
 def getJaccardSetSim(concepts_1: set, concepts_2: set):
     """ Returns Jaccard Set Similarity for the given concept sets """
     
@@ -35,16 +42,37 @@ def getOverlapSetSim(concepts_1: set, concepts_2: set):
     intersection = len(concepts_1.intersection(concepts_2))
     return intersection/min(len(concepts_1),len(concepts_2))
 
-def getMeanCSSetSim(concepts_1: set, concepts_2: set,tree: Tree, cs_mode:str,ic_mode: str = 'sanchez'):
+def getJaccardSetSimBatch(intersections, sizes_1, sizes_2):
+    """ Returns Jaccard Set Similarities from intersection counts and set sizes (broadcastable arrays) """
+    return intersections/(sizes_1 + sizes_2 - intersections)
+
+def getDiceSetSimBatch(intersections, sizes_1, sizes_2):
+    """ Returns Dice Set Similarities from intersection counts and set sizes (broadcastable arrays) """
+    return (2*intersections)/(sizes_1 + sizes_2)
+
+def getCosineSetSimBatch(intersections, sizes_1, sizes_2):
+    """ Returns Cosine Set Similarities from intersection counts and set sizes (broadcastable arrays) """
+    return intersections/np.sqrt(sizes_1*sizes_2)
+
+def getOverlapSetSimBatch(intersections, sizes_1, sizes_2):
+    """ Returns Overlap Set Similarities from intersection counts and set sizes (broadcastable arrays) """
+    return intersections/np.minimum(sizes_1, sizes_2)
+
+def getMeanCSSetSim(concepts_1: set, concepts_2: set,tree: Tree, cs_mode:str,ic_mode: str = 'sanchez', cache: CSCache = None):
     ''' Returns Set Similarity based on SS#7 from Jia et al. '''
     sum = 0
+    tree = utils.getCompiledTaxonomy(tree)
     depth = tree.depth()
     for concept_1 in concepts_1:
         for concept_2 in concepts_2:
-            sum += utils.getCS(concept_1,concept_2,tree,depth,ic_mode,cs_mode)
+            sum += utils.getCS(concept_1,concept_2,tree,depth,ic_mode,cs_mode,cache)
     return (sum*0.5)/(len(concepts_1)+len(concepts_2))
 
-def getHierachicalDistSetSim(concepts_1: set, concepts_2: set,tree: Tree, cs_mode:str,ic_mode: str = 'sanchez'):
+def getMeanCSSetSimBatch(cs_sums, sizes_1, sizes_2):
+    """ Returns mean CS Set Similarities from the CS sums of the set pairs and the set sizes (broadcastable arrays) """
+    return (cs_sums*0.5)/(sizes_1 + sizes_2)
+
+def getHierachicalDistSetSim(concepts_1: set, concepts_2: set,tree: Tree, cs_mode:str,ic_mode: str = 'sanchez', cache: CSCache = None):
     """ Returns hierarchical DISTANCE for the given concept sets based on https://doi.org/10.1016/j.jbi.2016.07.021 """
     
     if concepts_1 == concepts_2:
@@ -53,6 +81,7 @@ def getHierachicalDistSetSim(concepts_1: set, concepts_2: set,tree: Tree, cs_mod
     difference_1 = concepts_1.difference(concepts_2)
     difference_2 = concepts_2.difference(concepts_1)
     union = concepts_1.union(concepts_2)
+    tree = utils.getCompiledTaxonomy(tree)
     depth = tree.depth()
 
     # NOTE commented out the sim/dist differences, because MAX_CS 
@@ -62,8 +91,8 @@ def getHierachicalDistSetSim(concepts_1: set, concepts_2: set,tree: Tree, cs_mod
     # if cs_mode == 'path_based' or cs_mode == 'nguyen_almubaid':
     #     first_summand = sum([utils.getCS(concept_difference_1,concept_2,tree,depth,ic_mode,cs_mode) for concept_2 in concepts_2 for concept_difference_1 in difference_1])
     #     second_summand = sum([utils.getCS(concept_difference_2,concept_1,tree,depth,ic_mode,cs_mode) for concept_1 in concepts_1 for concept_difference_2 in difference_2])
-    first_summand = sum([utils.getCS(concept_difference_1,concept_2,tree,depth,ic_mode,cs_mode) for concept_2 in concepts_2 for concept_difference_1 in difference_1])
-    second_summand = sum([utils.getCS(concept_difference_2,concept_1,tree,depth,ic_mode,cs_mode) for concept_1 in concepts_1 for concept_difference_2 in difference_2])
+    first_summand = sum([utils.getCS(concept_difference_1,concept_2,tree,depth,ic_mode,cs_mode,cache) for concept_2 in concepts_2 for concept_difference_1 in difference_1])
+    second_summand = sum([utils.getCS(concept_difference_2,concept_1,tree,depth,ic_mode,cs_mode,cache) for concept_1 in concepts_1 for concept_difference_2 in difference_2])
     
     # else:
     #     max_cs = utils.getMaxDistOrSim(tree,ic_mode,cs_mode)
@@ -73,13 +102,17 @@ def getHierachicalDistSetSim(concepts_1: set, concepts_2: set,tree: Tree, cs_mod
 
     return ( first_summand/len(concepts_2) + second_summand/len(concepts_1) )/len(union) 
 
-def getWeightedBipartiteMatchingSim(concepts_1: set, concepts_2: set, tree: Tree, ic_mode, cs_mode):
+def getWeightedBipartiteMatchingSim(concepts_1: set, concepts_2: set, tree: Tree, ic_mode, cs_mode, cache: CSCache = None):
     ''' Weighted undirected bipartite Graph with weight function CS(a,b). 
         Matching = subset of edges with max weights aka highest similarity (or min weights for distance measures) for the two given concept-sets. \n
         Returns max-sum (or min-sum) of the weighted edges. ''' 
 
     # get pairwise-sim/dist matrix for bipartite matching
-    cs_matrix = utils.getCSMatrix(list(concepts_1), list(concepts_2), tree, ic_mode, cs_mode)
+    cs_matrix = utils.getCSMatrix(list(concepts_1), list(concepts_2), tree, ic_mode, cs_mode, cache)
+    return getWeightedBipartiteMatchingSimFromCS(cs_matrix, cs_mode)
+
+def getWeightedBipartiteMatchingSimFromCS(cs_matrix, cs_mode: str):
+    """ Returns the weighted bipartite matching sim of two concept sets from their pairwise CS matrix. """
     
     # min for distance measures, max for similarity measures
     if cs_mode == "nguyen_almubaid" or cs_mode == "path_based":
@@ -93,4 +126,160 @@ def getWeightedBipartiteMatchingSim(concepts_1: set, concepts_2: set, tree: Tree
 
     return cs_matrix[row_ind, col_ind].sum()
 
+def getMeanCSSetSimFromCS(cs_matrix):
+    """ Returns the mean CS set sim of two concept sets from their pairwise CS matrix. """
+    return (cs_matrix.sum()*0.5)/(cs_matrix.shape[0]+cs_matrix.shape[1])
+
+def getHierachicalDistSetSimBatch(first_summands, second_summands, intersections, sizes_1, sizes_2):
+    """
+    Returns hierarchical DISTANCES from the CS sums of the concepts only in the first set with the second set
+    (first_summands), the CS sums vice versa (second_summands), the intersection counts and the set sizes.
+    """
+    union = sizes_1 + sizes_2 - intersections
+    distances = ( first_summands/sizes_2 + second_summands/sizes_1 )/union
+    # identical sets, where the summands only cancel up to rounding
+    distances[(intersections == sizes_1) & (intersections == sizes_2)] = 0.0
+    return distances
+
+def getHierachicalDistSetSimFromCS(cs_matrix, only_in_1, only_in_2):
+    """
+    Returns the hierarchical distance of two concept sets from their pairwise CS matrix. \n
+    only_in_1 and only_in_2 are boolean masks of the rows/columns whose concepts are not part of the other set.
+    """
+    len_1, len_2 = cs_matrix.shape
+    if not only_in_1.any() and not only_in_2.any():
+        return 0.0
+    union = len_2 + only_in_1.sum()
+    first_summand = cs_matrix[only_in_1].sum()
+    second_summand = cs_matrix[:, only_in_2].sum()
+    return ( first_summand/len_2 + second_summand/len_1 )/union
+
+def getWeightedBipartiteMatchingSimBatch(sets, sets_1, sets_2, cs_matrix, cs_mode: str):
+    """
+    Returns the weighted bipartite matching sims of many set pairs. \n
+    sets are td_taxonomy.ConceptSets whose ids index cs_matrix, the pairs are given by the index arrays sets_1 and sets_2.
+    Identical sets and 1 x k problems are answered directly, small problems of equal shape are solved together
+    by enumerating all assignments, and only the remaining ones are passed to linear_sum_assignment.
+    """
+    maximize = cs_mode != "nguyen_almubaid" and cs_mode != "path_based"
+    sizes = sets.sizes()
+    sets_1 = np.asarray(sets_1, dtype=np.int64)
+    sets_2 = np.asarray(sets_2, dtype=np.int64)
+    # assignment sums are symmetric, so the first set is always the smaller one
+    swap = sizes[sets_1] > sizes[sets_2]
+    small = np.where(swap, sets_2, sets_1)
+    large = np.where(swap, sets_1, sets_2)
+    len_small = sizes[small]
+    len_large = sizes[large]
+    sims = np.empty(len(small))
+
+    done = np.zeros(len(small), dtype=bool)
+    if cs_mode == 'wu_palmer' or cs_mode == 'simple_wu_palmer':
+        # every concept is matched to itself with the maximal CS of 1
+        done = small == large
+        sims[done] = len_small[done]
+    elif cs_mode == 'path_based':
+        done = small == large
+        sims[done] = 0.0
+
+    single = ~done & (len_small == 1)
+    if single.any():
+        # best CS of the single concept with any concept of the other set
+        concepts = sets.ids[sets.offsets[small[single]]]
+        lengths = len_large[single]
+        starts = np.cumsum(lengths) - lengths
+        positions = np.repeat(sets.offsets[large[single]] - starts, lengths) + np.arange(lengths.sum())
+        costs = cs_matrix[np.repeat(concepts, lengths), sets.ids[positions]]
+        sims[single] = (np.maximum if maximize else np.minimum).reduceat(costs, starts)
+
+    rest = np.flatnonzero(~done & ~single)
+    for pairs, costs in iterCostBlocks(sets, small[rest], large[rest], cs_matrix):
+        sims[rest[pairs]] = getOptimalAssignmentSumsBatch(costs, cs_mode)
+    return sims
+
+def getOptimalAssignmentSumsBatch(costs, cs_mode: str):
+    """ Returns the weighted bipartite matching sims of a stack of m x k CS matrices (m <= k), enumerated for small shapes. """
+    _, m, k = costs.shape
+    if math.perm(k, m) <= MAX_ENUMERATED_ASSIGNMENTS:
+        return getAssignmentSumsBatch(costs, cs_mode != "nguyen_almubaid" and cs_mode != "path_based")
+    return np.array([getWeightedBipartiteMatchingSimFromCS(cost, cs_mode) for cost in costs])
+
+def getWeightedBipartiteMatchingBoundsBatch(sets, sets_1, sets_2, cs_matrix, cs_mode: str):
+    """
+    Returns cheap lower and upper bounds of the weighted bipartite matching sims of many set pairs (see
+    getWeightedBipartiteMatchingSimBatch). For similarity measures the upper bound is the smaller of the
+    row-max sum and the sum of the best column maxima, the lower bound is a greedy matching; distance measures
+    use the row/column minima and the greedy matching the other way round.
+    """
+    maximize = cs_mode != "nguyen_almubaid" and cs_mode != "path_based"
+    sizes = sets.sizes()
+    sets_1 = np.asarray(sets_1, dtype=np.int64)
+    sets_2 = np.asarray(sets_2, dtype=np.int64)
+    swap = sizes[sets_1] > sizes[sets_2]
+    small = np.where(swap, sets_2, sets_1)
+    large = np.where(swap, sets_1, sets_2)
+    lower = np.empty(len(small))
+    upper = np.empty(len(small))
+    for pairs, costs in iterCostBlocks(sets, small, large, cs_matrix):
+        lower[pairs], upper[pairs] = getAssignmentBoundsBatch(costs, maximize)
+    return lower, upper
+
+def getAssignmentBoundsBatch(costs, maximize: bool):
+    """ Returns the lower and upper bounds of getWeightedBipartiteMatchingBoundsBatch for a stack of m x k CS matrices (m <= k). """
+    # bounds of the best score, with score = sim for similarities and -dist for distances
+    scores = costs if maximize else -costs
+    m = scores.shape[1]
+    row_bound = scores.max(axis=2).sum(axis=1)
+    column_bound = np.sort(scores.max(axis=1), axis=1)[:, -m:].sum(axis=1)
+    best = np.minimum(row_bound, column_bound)
+    worst = getGreedyAssignmentSumsBatch(scores)
+    if maximize:
+        return worst, best
+    return -best, -worst
+
+def iterCostBlocks(sets, small, large, cs_matrix, max_values: int = 1 << 22):
+    """
+    Yields (positions, costs) for the set pairs (small[p], large[p]) grouped by shape, where costs stacks the
+    m x k CS matrices of the pairs at positions. Blocks hold at most about max_values enumerated assignment values.
+    """
+    sizes = sets.sizes()
+    len_small = sizes[small]
+    len_large = sizes[large]
+    if len(small) == 0:
+        return
+    shapes = len_small*(len_large.max() + 1) + len_large
+    for shape in np.unique(shapes):
+        pairs = np.flatnonzero(shapes == shape)
+        m, k = int(len_small[pairs[0]]), int(len_large[pairs[0]])
+        chunk = max(1, max_values//(min(math.perm(k, m), MAX_ENUMERATED_ASSIGNMENTS + 1)*m))
+        for start in range(0, len(pairs), chunk):
+            block = pairs[start:start + chunk]
+            ids_small = sets.ids[sets.offsets[small[block]][:, None] + np.arange(m)]
+            ids_large = sets.ids[sets.offsets[large[block]][:, None] + np.arange(k)]
+            yield block, cs_matrix[ids_small[:, :, None], ids_large[:, None, :]]
+
+def getGreedyAssignmentSumsBatch(scores):
+    """ Returns the sums of greedy maximum assignments of a stack of m x k score matrices (m <= k). """
+    scores = np.array(scores, dtype=np.float64)
+    count, m, k = scores.shape
+    pairs = np.arange(count)
+    sums = np.zeros(count)
+    for _ in range(m):
+        best = scores.reshape(count, -1).argmax(axis=1)
+        rows, cols = best//k, best % k
+        sums += scores[pairs, rows, cols]
+        scores[pairs, rows, :] = -np.inf
+        scores[pairs, :, cols] = -np.inf
+    return sums
+
+def getAssignmentSumsBatch(costs, maximize: bool):
+    """ Returns the optimal assignment sums of a stack of m x k cost matrices (m <= k) by enumerating all assignments. """
+    _, m, k = costs.shape
+    assignments = getAssignments(m, k)
+    sums = costs[:, np.arange(m), assignments].sum(axis=2)
+    return sums.max(axis=1) if maximize else sums.min(axis=1)
 
+@functools.lru_cache(maxsize=None)
+def getAssignments(m: int, k: int):
+    """ Returns all assignments of m rows to distinct columns out of k as array of column indices. """
+    return np.array(list(itertools.permutations(range(k), m)), dtype=np.intp).reshape(-1, m)
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+import hashlib
+import numpy as np
+
+# rough size of one cached CS value (OrderedDict slot, key tuple, float) in bytes
+ENTRY_SIZE = 200
+
+class CSCache:
+    """
+    Bounded LRU cache for concept-similarity values. \n
+    Entries are single CS values, keyed by the namespace (taxonomy fingerprint, ic_mode, cs_mode) and the unordered pair
+    of concept ids (see getKey), or CS blocks of two arrays of concept ids (see getBlockKey), e.g. the CS matrix of a cohort's
+    vocabulary, so switching modes or taxonomies never returns stale values. max_entries bounds the number of cached
+    CS values, a block counts with all its values. Once max_entries or max_memory (bytes, estimated with ENTRY_SIZE per
+    single value and the size of the array per block) is exceeded, the least recently used entries are evicted.
+    Entries that exceed the bounds on their own are not cached.
+    """
+    def __init__(self, max_entries: int = 1000000, max_memory: int = None) -> None:
+        if max_entries < 1 or (max_memory is not None and max_memory < ENTRY_SIZE):
+            raise ValueError('Cache must hold at least one entry')
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.values = 0
+        self.memory = 0
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def getKey(namespace: tuple, id_1: int, id_2: int) -> tuple:
+        """Returns the cache key of a concept pair, CS values are symmetric."""
+        if id_1 > id_2:
+            id_1, id_2 = id_2, id_1
+        return (namespace, id_1, id_2)
+
+    @staticmethod
+    def getBlockKey(namespace: tuple, ids_1, ids_2) -> tuple:
+        """Returns the cache key of the CS block of two arrays of concept ids, by the hashes of the arrays."""
+        digests = [hashlib.sha1(np.ascontiguousarray(ids, dtype=np.int64).tobytes()).hexdigest() for ids in (ids_1, ids_2)]
+        return (namespace, 'block', digests[0], digests[1])
+
+    def get(self, key: tuple):
+        """Returns the cached value or None. Cached zeros are hits like every other value."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: tuple, value):
+        """Caches a CS value or a CS block; blocks are made read-only, as they are handed out to every caller."""
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+            size, memory = value.size, value.nbytes + ENTRY_SIZE
+        else:
+            size, memory = 1, ENTRY_SIZE
+        if size > self.max_entries or (self.max_memory is not None and memory > self.max_memory):
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, size, memory)
+        self.values += size
+        self.memory += memory
+        while self.values > self.max_entries or (self.max_memory is not None and self.memory > self.max_memory):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: tuple):
+        _, size, memory = self._entries.pop(key)
+        self.values -= size
+        self.memory -= memory
+
+    def clear(self):
+        """Removes all entries, the counters are kept."""
+        self._entries.clear()
+        self.values = 0
+        self.memory = 0
+
+    def stats(self) -> dict:
+        """Returns hit, miss and eviction counters as well as the current size of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits/lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'values': self.values,
+            'max_entries': self.max_entries,
+            'memory': self.memory,
+        }
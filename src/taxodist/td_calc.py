@@ -1,20 +1,50 @@
-import math
 import sys
 from treelib.tree import Tree
 from src.taxodist import td_utils as utils
 import numpy as np
-import concurrent.futures as cf
-from timeit import default_timer as timer
-from sklearn import preprocessing
+from src.taxodist.td_cache import CSCache
+from src.taxodist.td_taxonomy import ConceptSets
+from src.taxodist.td_index import SetSimIndex
+from src.taxodist.td_state import SetSimState
+from src.taxodist import td_writers
+from src.taxodist import td_profiling
+from src.taxodist.td_profiling import instrumented
 
 class Taxodist:
-    def __init__(self) -> None:
-        pass
-    def calc_distance_with_concepts(self, concepts: list=None,taxonomy_tree: Tree=None, ic_mode: str='levels', cs_mode: str='simple_wu_palmer', normalize: bool= False, calc_mode: str='distance'):
+    def __init__(self, cache_size: int = 1000000, cache_memory: int = None, instrument: bool = False, profile_path: str = None) -> None:
+        """
+        cache_size (CS values) and cache_memory (bytes) bound the CS cache of this instance, see td_cache.CSCache.
+        It holds the CS matrices of the cohorts' vocabularies of the set sim methods, so repeated runs on the same concepts
+        skip the CS computation; pairwise concept distances are computed in tiles and not cached.
+        Its hit, miss and eviction counters are available via self.cache.stats() and in get_report. \n
+        With instrument=True, the calc methods record wall time per phase, counters and worker times, see get_report
+        and td_profiling.Instrumentation. A profile_path also turns on instrumentation and dumps cProfile stats there.
+        """
+        self.cache = CSCache(max_entries=cache_size, max_memory=cache_memory)
+        if instrument or profile_path is not None:
+            self.instrumentation = td_profiling.Instrumentation(profile_path)
+        else:
+            self.instrumentation = td_profiling.NULL_INSTRUMENTATION
+
+    def get_report(self) -> dict:
+        """
+        Returns the instrumentation report of all calc runs of this instance so far (None if instrumentation is off): \n
+        total_time, runs (calls per method), phases (exclusive wall time and entries per phase), counters (e.g. cs_lookups,
+        cs_cache_hits, cs_cache_misses, cs_values, set_sims, tiles, including those of the worker processes), workers
+        (busy and idle time and tiles per process id), profile_path
+        and the stats of the CS cache. Parsing a taxonomy can be added as phase with: \n
+        with taxodist.instrumentation.phase('tree_parse'): tree = tree_parsers.getICD10GMTree()
+        """
+        report = self.instrumentation.report()
+        if report is not None:
+            report['cache'] = self.cache.stats()
+        return report
+
+    @instrumented
+    def calc_distance_with_concepts(self, concepts: list=None,taxonomy_tree: Tree=None, ic_mode: str='levels', cs_mode: str='simple_wu_palmer', normalize: bool= False, calc_mode: str='distance', max_workers: int=None, tile_size: int=None, storage: str='dense', dtype=np.float64, path: str=None, threshold: float=None, block_level: int=1, embedding: str='none', embedding_stats: dict=None, writer=None):
         """
         Computes the distance or similarity of concepts based on their position in the corresponding taxonomy. \n
-        Saves x and y coordiantes of the concepts in an excel-sheet for further distance calculation. \n
-        Saves pairwise distances of the concepts in another excel-sheet.\n
+        Returns the pairwise distances of the concepts; they are only written to a file if a writer is given.\n
 
         ----
         ## Parameters:\n
@@ -23,11 +53,14 @@ class Taxodist:
         \tA list of concepts to calculate the distances. \n
         \tPer default, if this parameter is left out or set to None,\n 
         \tthis method uses all concepts of the given taxonomy.\n
+        \tA numpy array is taken as node ids of the compiled taxonomy (see CompiledTaxonomy.get_ids).\n
         
         * taxonomy_tree (Tree):\n 
         \tA tree object representing the taxonomy you wish to calculate concept distances in. \n
         \tThis package offers methods to get trees for the following taxonomies:\n
         \t\t-ICD-10-GM (getICD10GMTree)
+        \tIts compiled version is reused until the structure of the tree changes; after changing node data,
+        \tcall td_utils.invalidateCompiledTaxonomy(tree).
         \n
         * ic_mode (str):\n
         \tDefines what information-content algorithm should be used. \n
@@ -44,7 +77,45 @@ class Taxodist:
         \t\t-'leacock_chodorow' \n
         \t\t-'nguyen_almubaid' \n
         \t\t-'batet' \n
-       
+
+        * max_workers (int):\n
+        \tNumber of worker processes, defaults to the number of CPUs. 1 computes in the calling process.\n
+
+        * tile_size (int):\n
+        \tEdge length of the square tiles that are scheduled to the workers.\n
+        \tPer default chosen so that every worker gets about 16 tiles.\n
+
+        * storage (str):\n
+        \t'dense' (default) returns the square matrix as ndarray.\n
+        \t'condensed' returns a td_matrix.CondensedMatrix that only stores the upper triangle.\n
+
+        * dtype:\n
+        \tFloat type of the matrix values, e.g. np.float32 or np.float16 to save memory.\n
+
+        * path (str):\n
+        \tFile (.npy) the condensed matrix is memory-mapped to, for matrices larger than the main memory.\n
+
+        * threshold (float):\n
+        \tIf given, only the concept pairs i < j reaching the threshold (at least for similarities, at most for distances) are computed\n
+        \tand returned as scipy.sparse CSR matrix of raw CS values, without normalization, MDS or export.\n
+
+        * block_level (int):\n
+        \tWith a threshold, only concepts with the same ancestor at this level (e.g. 1 for ICD chapters) are compared, see td_utils.getThresholdedDistMatrix.\n
+
+        * embedding (str):\n
+        \tHow two-dimensional concept coordinates are computed from the dense or condensed matrix, see td_embedding.getEmbedding:\n
+        \t\t-'none' (default) computes no coordinates \n
+        \t\t-'classical' \n
+        \t\t-'landmark' for large numbers of concepts \n
+        \t\t-'smacof' \n
+
+        * embedding_stats (dict):\n
+        \tIf given, filled with the coordinates (DataFrame), the elapsed time and the stress of the embedding.\n
+
+        * writer (str or td_writers.RowBlockWriter):\n
+        \tPer default, nothing is written. A file path writes the matrix with the writer for its extension\n
+        \t(.npy, .npz, .csv, .parquet, .h5, .xlsx), see td_writers.getRowBlockWriter. Excel files are only written when asked for this way.\n
+
         """
 
         ######################### SETUP #########################
@@ -57,80 +128,103 @@ class Taxodist:
             print(err.args)
             sys.exit()
 
-        if not concepts:
+        # workers only need the array-backed taxonomy
+        taxonomy = utils.getCompiledTaxonomy(taxonomy_tree)
+        if concepts is None or len(concepts) == 0:
             concepts = utils.getAllConcepts(taxonomy_tree)
+        if isinstance(concepts, np.ndarray):
+            concept_ids = concepts.astype(np.int32)
+        else:
+            concept_ids = taxonomy.get_ids(concepts)
 
-        length = len(concepts)
+        if threshold is not None:
+            return utils.getThresholdedDistMatrix(concept_ids, taxonomy, ic_mode, cs_mode, threshold, block_level, dtype)
+
+        instrumentation = self.instrumentation
         #TODO not dist matrix, but sim matrix -> normalize & substract from 1 to get distances
-        dist_matrix = np.zeros(shape=(len(concepts), len(concepts)))
-
-        fs = []
-        with cf.ProcessPoolExecutor(max_workers=1) as executor:
-            max_workers = executor.__getattribute__('_max_workers')
-            for i in range(0,max_workers):
-                # start processes and save return values 
-                fs.append(executor.submit(utils.getDistMatrixWrapper, (concepts, taxonomy_tree, i+1, max_workers,ic_mode,cs_mode)))
-        for future in cf.as_completed(fs):
-            # merge partial matrices
-            partial_dist_matrix, worker_index = future.result()
-            dist_matrix[utils.getStart(worker_index,max_workers,length):utils.getStop(worker_index,max_workers,length)] = partial_dist_matrix
-        
-        dist_matrix = utils.mirrorMatrix(dist_matrix)
+        with instrumentation.phase('cs'):
+            dist_matrix = utils.getDistMatrix(concept_ids, taxonomy, ic_mode, cs_mode, max_workers=max_workers, tile_size=tile_size, storage=storage, dtype=dtype, path=path)
 
-        if normalize:
-            dist_matrix = utils.normalize(dist_matrix)
+        if storage == 'condensed':
+            if normalize:
+                with instrumentation.phase('normalize'):
+                    dist_matrix = utils.normalize(dist_matrix)
+        else:
+            with instrumentation.phase('normalize'):
+                dist_matrix = utils.mirrorMatrix(dist_matrix)
 
-        # if calc_mode == 'distance':
-        #     if cs_mode == ''
+                if normalize:
+                    dist_matrix = utils.normalize(dist_matrix)
+
+            # if calc_mode == 'distance':
+            #     if cs_mode == ''
 
-        df_mds_coordinates = utils.getMDSMatrix(dist_matrix)
+        # the embeddings read dense and condensed matrices in row blocks
+        with instrumentation.phase('mds'):
+            df_mds_coordinates = utils.getMDSMatrix(dist_matrix, embedding, embedding_stats)
+        if embedding_stats is not None and df_mds_coordinates is not None:
+            embedding_stats['coordinates'] = df_mds_coordinates
 
-        utils.saveConceptDistancesInExcel(df_mds_coordinates, concepts)
+        if writer is not None:
+            with instrumentation.phase('output'):
+                td_writers.writeMatrix(dist_matrix, writer)
 
         return dist_matrix
 
+    @instrumented
     def calc_dist_for_specific_subcategory(self,concepts: list=None, taxonomy_tree: Tree=None):
         """Use this method when you know, that your concepts are from the same subcategory and that they are leaves."""
-        self.calc_distance_with_concepts(concepts=concepts,taxonomy_tree=taxonomy_tree,ic_mode='levels',cs_mode='simple_wu_palmer')
+        return self.calc_distance_with_concepts(concepts=concepts,taxonomy_tree=taxonomy_tree,ic_mode='levels',cs_mode='simple_wu_palmer')
 
+    @instrumented
     def calc_dist_for_distinct_concepts(self,concepts: list=None,taxonomy_tree: Tree=None,normalize: bool=False):
         """
         Use this method when you know, that your concepts are more distinct, might not be leaves and you are working
         with a more comprehensive concept background.
         """
-        self.calc_distance_with_concepts(concepts=concepts,taxonomy_tree=taxonomy_tree,ic_mode='sanchez',cs_mode='wu_palmer',normalize=normalize)
+        return self.calc_distance_with_concepts(concepts=concepts,taxonomy_tree=taxonomy_tree,ic_mode='sanchez',cs_mode='wu_palmer',normalize=normalize)
 
+    @instrumented
     def calc_similarity_with_concepts(self, concepts: list=None,taxonomy_tree: Tree=None, ic_mode: str='levels', cs_mode: str='simple_wu_palmer', normalize: bool= False, calc_mode: str='similarity'):
         """
         Use this method when you want to have similarity scores instead of distances of the given concepts.
         """
-        self.calc_distance_with_concepts(concepts=concepts,taxonomy_tree=taxonomy_tree,ic_mode=ic_mode,cs_mode=cs_mode,normalize=normalize,calc_mode=calc_mode)
+        return self.calc_distance_with_concepts(concepts=concepts,taxonomy_tree=taxonomy_tree,ic_mode=ic_mode,cs_mode=cs_mode,normalize=normalize,calc_mode=calc_mode)
 
+    @instrumented
     def calc_set_sim(self, sets: list,tree: Tree, ic_mode:str, cs_mode: str, setsim_mode: str, normalize: bool=False, scale_to_setsizes: bool = True) -> np.ndarray:
-        """ Calculates the set similarity/distance of the given concept-sets. Returns the pairwise similarity/distance matrix"""
-        
-        matrix = np.zeros(shape=(len(sets),len(sets)))
-        for i, set1 in enumerate(sets):
-            for j, set2 in enumerate(sets[i:]): 
-                setSim = utils.getSetSim(set(set1), set(set2),tree=tree,cs_mode=cs_mode, ic_mode=ic_mode, setsim_mode=setsim_mode)
-                if scale_to_setsizes:
-                    setSim = utils.getScaledSetSim(setSim,len(set1),len(set2))
-                matrix[i, j+i] = setSim
-                matrix[j+i, i] = setSim
-                #print('calculated patient:',set1_index,'and patient:',sets.index(set2))
-    
-        #matrix = utils.mirrorMatrix(matrix) 
-
-        if normalize:
-            matrix = utils.normalize(matrix)
+        """ 
+        Calculates the set similarity/distance of the given concept-sets. Returns the pairwise similarity/distance matrix.\n
+        sets can also be ConceptSets of node ids (see CompiledTaxonomy.get_concept_sets), which are compared without concept lookups.
+        The compiled version of the tree is reused until its structure changes, see td_utils.invalidateCompiledTaxonomy.
+        """
         
-        # clear hashmaps
-        utils.cs_table = {}
-        utils.ic_table = {}
+        instrumentation = self.instrumentation
+        # all pairs at once from the sparse incidence matrix
+        taxonomy = None if setsim_mode in utils.TRIVIAL_SETSIM_MODES else utils.getCompiledTaxonomy(tree)
+        with instrumentation.phase('set_sim'):
+            matrix = utils.getBatchSetSimMatrix(sets, taxonomy, ic_mode, cs_mode, setsim_mode, cache=self.cache)
+            if scale_to_setsizes:
+                sizes = sets.sizes() if isinstance(sets, ConceptSets) else np.array([len(concepts) for concepts in sets])
+                matrix = utils.getScaledSetSims(matrix, sizes, sizes)
+        with instrumentation.phase('normalize'):
+            matrix = utils.mirrorMatrix(matrix)
+            if normalize:
+                matrix = utils.normalize(matrix)
         return matrix
     
-    def calc_set_sim_par(self, sets: list,tree: Tree, ic_mode:str, cs_mode: str, setsim_mode: str, normalize: bool=True) -> np.ndarray:
-        """ Calculates the set similarity/distance of the given concept-sets. Returns the pairwise similarity/distance matrix"""
+    @instrumented
+    def calc_set_sim_par(self, sets: list,tree: Tree, ic_mode:str, cs_mode: str, setsim_mode: str, normalize: bool=True, max_workers: int=None, tile_size: int=None, output_path: str=None, dtype=np.float64, threshold: float=None, block_level: int=1) -> np.ndarray:
+        """ 
+        Calculates the set similarity/distance of the given concept-sets in max_workers processes. Returns the pairwise similarity/distance matrix.\n
+        The sets and the CS matrix of their concepts are placed in shared memory once and the matrix is computed in tiles of tile_size sets,
+        see td_utils.getSetDistMatrix. sets can also be ConceptSets of node ids. \n
+        With an output_path (.npy, .parquet, .h5), the upper triangle is streamed to the file in row blocks instead (see iter_set_sim and td_writers)
+        and output_path is returned. Only .npy files are normalized, as the maximum is only known at the end. \n
+        With a threshold, only the pairs i < j reaching it are returned as scipy.sparse CSR matrix of raw set sims, comparing only sets
+        that share an ancestor at block_level (see td_utils.getThresholdedSetSimMatrix). \n
+        The compiled version of the tree is reused until its structure changes, see td_utils.invalidateCompiledTaxonomy.
+        """
       
     ######################### SETUP #########################
         try:
@@ -142,25 +236,30 @@ class Taxodist:
             print(err.args)
             sys.exit()
 
-        length = len(sets)
+        taxonomy = utils.getCompiledTaxonomy(tree)
+        instrumentation = self.instrumentation
+        if threshold is not None:
+            with instrumentation.phase('set_sim'):
+                return utils.getThresholdedSetSimMatrix(sets, taxonomy, ic_mode, cs_mode, setsim_mode, threshold, block_level, dtype, cache=self.cache)
+        if output_path is not None:
+            # the blocks are computed while they are written, writing is counted as output
+            with instrumentation.phase('set_sim'):
+                writer = td_writers.writeBlocks(self.iter_set_sim(sets, taxonomy, ic_mode, cs_mode, setsim_mode), td_writers.getRowBlockWriter(output_path, len(sets), dtype))
+            if normalize and isinstance(writer, td_writers.NpyWriter):
+                with instrumentation.phase('normalize'):
+                    writer.matrix.normalize()
+                    writer.matrix.flush()
+            return output_path
+
         #TODO not dist matrix, but sim matrix -> normalize & substract from 1 to get distances
-        dist_matrix = np.zeros(shape=(len(sets), len(sets)))
-
-        fs = []
-        with cf.ProcessPoolExecutor() as executor:
-            max_workers = executor.__getattribute__('_max_workers')
-            for i in range(0,max_workers):
-                # start processes and save return values 
-                fs.append(executor.submit(utils.getSetDistMatrixWrapper, (sets, tree, i+1, max_workers,ic_mode,cs_mode,setsim_mode)))
-        for future in cf.as_completed(fs):
-            # merge partial matrices
-            partial_dist_matrix, worker_index = future.result()
-            dist_matrix[utils.getStart(worker_index,max_workers,length):utils.getStop(worker_index,max_workers,length)] = partial_dist_matrix
+        with instrumentation.phase('set_sim'):
+            dist_matrix = utils.getSetDistMatrix(sets, taxonomy, ic_mode, cs_mode, setsim_mode, max_workers=max_workers, tile_size=tile_size, cache=self.cache)
         
-        dist_matrix = utils.mirrorMatrix(dist_matrix)
+        with instrumentation.phase('normalize'):
+            dist_matrix = utils.mirrorMatrix(dist_matrix)
 
-        if normalize:
-            dist_matrix = utils.normalize(dist_matrix)
+            if normalize:
+                dist_matrix = utils.normalize(dist_matrix)
 
         # if calc_mode == 'distance':
         #     if cs_mode == ''
@@ -169,4 +268,30 @@ class Taxodist:
 
         # utils.saveConceptDistancesInExcel(df_mds_coordinates, concepts)
 
-        return dist_matrix
\ No newline at end of file
+        return dist_matrix
+
+    def iter_set_sim(self, sets: list, tree: Tree, ic_mode: str, cs_mode: str, setsim_mode: str, block_size: int=None):
+        """
+        Yields the upper triangle of the (raw) set similarity/distance matrix as (row_start, block) tuples with bounded memory, e.g. \n
+        for row_start, block in taxodist.iter_set_sim(...): block holds rows row_start:row_start+len(block) and columns row_start:. See td_utils.iterSetSimBlocks.
+        """
+        taxonomy = None if setsim_mode in utils.TRIVIAL_SETSIM_MODES else utils.getCompiledTaxonomy(tree)
+        return utils.iterSetSimBlocks(sets, taxonomy, ic_mode, cs_mode, setsim_mode, block_size, self.cache)
+
+    @instrumented
+    def create_set_sim_index(self, sets: list, tree: Tree, ic_mode: str, cs_mode: str, setsim_mode: str, scale_to_setsizes: bool = False) -> SetSimIndex:
+        """
+        Indexes a reference cohort of concept-sets once for top-k queries, e.g. \n
+        index.query(patient_concepts, top_k=20) returns the 20 most similar sets as (set index, sim) tuples. See td_index.SetSimIndex.
+        """
+        return SetSimIndex(sets, tree, ic_mode, cs_mode, setsim_mode, scale_to_setsizes, self.cache)
+
+    @instrumented
+    def create_set_sim_state(self, path: str, sets: list, tree: Tree, ic_mode: str, cs_mode: str, setsim_mode: str, dtype=np.float64) -> SetSimState:
+        """
+        Computes the raw set sims of a cohort of concept-sets into a persisted state directory at path. \n
+        Sets can be added later with state.append_sets(sets), which only computes the new rows, and removed with state.remove_sets(indices).
+        Reopen it with td_state.SetSimState.open(path, tree). See td_state.SetSimState.
+        """
+        with self.instrumentation.phase('set_sim'):
+            return SetSimState.create(path, sets, tree, ic_mode, cs_mode, setsim_mode, dtype, self.cache)
@@ -0,0 +1,128 @@
+import sys
+import numpy as np
+import pandas as pd
+from numpy import ndarray
+from pandas.core.frame import DataFrame
+from scipy.sparse.linalg import LinearOperator, eigsh
+from sklearn.manifold import MDS
+from timeit import default_timer as timer
+from src.taxodist.td_matrix import CondensedMatrix, CHUNK_SIZE
+
+# 'none' skips the embedding
+EMBEDDING_MODES = ('classical','landmark','smacof','none')
+# largest matrices that are centered and decomposed densely by classical MDS
+DENSE_EIGH_SIZE = 1000
+# number of sampled pairs for the stress of large matrices
+STRESS_SAMPLES = 1 << 20
+
+def getEmbedding(dist_matrix, embedding_mode: str = 'classical', n_components: int = 2, n_landmarks: int = None, stats: dict = None) -> DataFrame:
+    """
+    Returns n_components-dimensional coordinates of the points of a symmetric distance matrix (ndarray or td_matrix.CondensedMatrix),
+    whose euclidean distances approximate the given ones. \n
+    'classical' - classical (Torgerson) MDS from the top eigenvectors of the double-centered squared distances, computed with eigsh
+    on row blocks of the matrix, so the centered matrix is never materialized \n
+    'landmark' - landmark MDS (the Nyström approximation of classical MDS): classical MDS of n_landmarks maxmin landmarks,
+    every other point is placed from its distances to the landmarks only, so just n x n_landmarks distances are read \n
+    'smacof' - metric SMACOF of sklearn.manifold.MDS started from classical MDS, iterative and O(n²) memory, for small matrices \n
+    'none' - no embedding, returns None \n
+    If stats is given, it is filled with the mode, the elapsed time and the Kruskal stress-1 of the coordinates.
+    """
+    try:
+        if embedding_mode not in EMBEDDING_MODES:
+            raise ValueError('Unsupported embedding mode: ', embedding_mode)
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+    if embedding_mode == 'none':
+        return None
+
+    start = timer()
+    if embedding_mode == 'classical':
+        coordinates = getClassicalMDS(dist_matrix, n_components)
+    elif embedding_mode == 'landmark':
+        coordinates = getLandmarkMDS(dist_matrix, n_components, n_landmarks)
+    else:
+        square = dist_matrix.to_square() if isinstance(dist_matrix, CondensedMatrix) else dist_matrix
+        # started from the classical solution instead of several random ones
+        coordinates = MDS(n_components=n_components, dissimilarity='precomputed', n_init=1).fit_transform(square, init=getClassicalMDS(square, n_components))
+    if stats is not None:
+        stats.update({'embedding_mode': embedding_mode, 'elapsed_time': timer() - start, 'stress': getStress(dist_matrix, coordinates)})
+    return pd.DataFrame(coordinates)
+
+def getClassicalMDS(dist_matrix, n_components: int = 2) -> ndarray:
+    """Returns the classical MDS coordinates of a distance matrix, see getEmbedding."""
+    n = len(dist_matrix)
+    if n <= DENSE_EIGH_SIZE:
+        squared = getDistRows(dist_matrix, 0, n).astype(np.float64)**2
+        centered = squared - squared.mean(axis=0) - squared.mean(axis=1)[:, None] + squared.mean()
+        eigenvalues, eigenvectors = np.linalg.eigh(-0.5*centered)
+        eigenvalues, eigenvectors = eigenvalues[::-1][:n_components], eigenvectors[:, ::-1][:, :n_components]
+    else:
+        block_size = max(1, CHUNK_SIZE//n)
+        def centeredProduct(vector):
+            # -1/2·J·D²·J·v, with the centering matrix J = I - 11ᵀ/n
+            vector = np.ravel(vector) - np.mean(vector)
+            product = np.empty(n)
+            for row_start in range(0, n, block_size):
+                row_stop = min(row_start + block_size, n)
+                product[row_start:row_stop] = (getDistRows(dist_matrix, row_start, row_stop).astype(np.float64)**2) @ vector
+            return -0.5*(product - product.mean())
+        operator = LinearOperator((n, n), matvec=centeredProduct, dtype=np.float64)
+        eigenvalues, eigenvectors = eigsh(operator, k=n_components, which='LA')
+        order = np.argsort(eigenvalues)[::-1]
+        eigenvalues, eigenvectors = eigenvalues[order], eigenvectors[:, order]
+    # negative eigenvalues belong to non-euclidean parts of the distances
+    return eigenvectors*np.sqrt(np.maximum(eigenvalues, 0))
+
+def getLandmarkMDS(dist_matrix, n_components: int = 2, n_landmarks: int = None) -> ndarray:
+    """Returns the landmark MDS coordinates of a distance matrix, see getEmbedding. n_landmarks defaults to min(n, 1000)."""
+    n = len(dist_matrix)
+    if n_landmarks is None:
+        n_landmarks = min(n, 1000)
+    n_landmarks = max(min(n_landmarks, n), n_components + 1)
+    # maxmin selection: every next landmark is the point farthest from all landmarks so far
+    landmarks = np.empty(min(n_landmarks, n), dtype=np.int64)
+    landmark_dists = np.empty((len(landmarks), n))
+    landmarks[0] = np.random.default_rng(0).integers(n)
+    closest = np.full(n, np.inf)
+    for l in range(len(landmarks)):
+        if l > 0:
+            landmarks[l] = np.argmax(closest)
+        landmark_dists[l] = getDistRows(dist_matrix, landmarks[l], landmarks[l] + 1)[0]
+        closest = np.minimum(closest, landmark_dists[l])
+
+    squared = landmark_dists**2
+    landmark_squared = squared[:, landmarks]
+    centered = landmark_squared - landmark_squared.mean(axis=0) - landmark_squared.mean(axis=1)[:, None] + landmark_squared.mean()
+    eigenvalues, eigenvectors = np.linalg.eigh(-0.5*centered)
+    eigenvalues, eigenvectors = eigenvalues[::-1][:n_components], eigenvectors[:, ::-1][:, :n_components]
+    positive = eigenvalues > 0
+    # distance-based triangulation: x = -1/2·L#·(δ - δ_mean) with the pseudo-inverse L# of the landmark coordinates
+    pseudo_inverse = np.zeros_like(eigenvectors)
+    pseudo_inverse[:, positive] = eigenvectors[:, positive]/np.sqrt(eigenvalues[positive])
+    return -0.5*(squared - landmark_squared.mean(axis=1)[:, None]).T @ pseudo_inverse
+
+def getStress(dist_matrix, coordinates: ndarray) -> float:
+    """
+    Returns the Kruskal stress-1 sqrt(Σ(d - d̂)²/Σd²) of the euclidean distances d̂ of the coordinates against the given distances. \n
+    Larger matrices are evaluated on STRESS_SAMPLES random pairs.
+    """
+    n = len(dist_matrix)
+    coordinates = np.asarray(coordinates)
+    if n*(n - 1)//2 <= STRESS_SAMPLES:
+        rows, cols = np.triu_indices(n, 1)
+    else:
+        rng = np.random.default_rng(0)
+        rows, cols = rng.integers(n, size=STRESS_SAMPLES), rng.integers(n, size=STRESS_SAMPLES)
+    if isinstance(dist_matrix, CondensedMatrix):
+        dists = dist_matrix.get_pairs(rows, cols).astype(np.float64)
+    else:
+        dists = np.asarray(dist_matrix[rows, cols], dtype=np.float64)
+    embedded = np.linalg.norm(coordinates[rows] - coordinates[cols], axis=1)
+    return float(np.sqrt(np.sum((dists - embedded)**2)/np.sum(dists**2)))
+
+def getDistRows(dist_matrix, row_start: int, row_stop: int) -> ndarray:
+    """Returns rows row_start:row_stop of a square ndarray or CondensedMatrix."""
+    if isinstance(dist_matrix, CondensedMatrix):
+        return dist_matrix.get_pairs(np.arange(row_start, row_stop)[:, None], np.arange(dist_matrix.n)[None, :])
+    return np.asarray(dist_matrix[row_start:row_stop])
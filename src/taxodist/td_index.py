@@ -0,0 +1,205 @@
+import sys
+import numpy as np
+from numpy import ndarray
+from treelib.tree import Tree
+from src.taxodist import td_utils as utils
+from src.taxodist import setsim_algorithms
+from src.taxodist import td_profiling
+from src.taxodist.td_taxonomy import CompiledTaxonomy, ConceptSets
+from src.taxodist.td_cache import CSCache
+
+class SetSimIndex:
+    """
+    Index of a reference cohort of concept sets for exact top-k queries (e.g. the patients most similar to a new patient). \n
+    Trivial set sims (jaccard, dice, cosine, overlap) are computed for all sets from the intersection counts of an inverted
+    index that maps every concept to the sets that contain it. For the CS-based ones, the sets are kept as a sparse set x concept
+    incidence matrix over the cohort's vocabulary (the concepts that occur in any set), and a query computes the CS values
+    of its concepts with the vocabulary once: mean_cs and hierarchical follow for all sets from sparse products with the
+    incidence matrix. For bipartite_matching, every set gets cheap bounds (see
+    setsim_algorithms.getAssignmentBoundsBatch), and the assignments are only solved for the sets whose bound can still
+    beat the current k-th best, most promising first. With a cache, the CS values of repeated queries are reused.
+    """
+    def __init__(self, sets, tree: Tree, ic_mode: str, cs_mode: str, setsim_mode: str, scale_to_setsizes: bool = False, cache: CSCache = None) -> None:
+        self.taxonomy: CompiledTaxonomy = utils.getCompiledTaxonomy(tree)
+        self.sets: ConceptSets = self.taxonomy.get_concept_sets(sets)
+        try:
+            if setsim_mode not in utils.BATCH_SETSIM_MODES:
+                raise ValueError("Unsupported setsim algorithm: ", setsim_mode)
+            if (self.sets.sizes() == 0).any():
+                raise ValueError('Empty Concept Set(s)')
+        except ValueError as err:
+            print(err.args)
+            sys.exit()
+        self.ic_mode = ic_mode
+        self.cs_mode = cs_mode
+        self.setsim_mode = setsim_mode
+        self.scale_to_setsizes = scale_to_setsizes
+        self.cache = cache
+        # hierarchical and the distance CS measures rank smaller values first
+        self.is_distance = utils.isDistance(cs_mode, setsim_mode)
+        set_indices = np.repeat(np.arange(len(self.sets), dtype=np.int64), self.sets.sizes())
+        self.concept_index = self._getInvertedIndex(self.sets.ids.astype(np.int64)*len(self.sets) + set_indices)
+        self.vocabulary, local_ids = np.unique(self.sets.ids, return_inverse=True)
+        self.incidence = utils.getIncidenceMatrix(ConceptSets(self.sets.offsets, local_ids), len(self.vocabulary))
+
+    def _getInvertedIndex(self, keys: ndarray):
+        """
+        Returns an inverted index as CSR arrays (offsets, sets) from keys node*len(sets) + set index:
+        the sets of node n are sets[offsets[n]:offsets[n+1]].
+        """
+        keys = np.unique(keys)
+        offsets = np.zeros(len(self.taxonomy) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(keys//len(self.sets), minlength=len(self.taxonomy)))
+        return offsets, (keys % len(self.sets)).astype(np.int32)
+
+    def _getPostings(self, index: tuple, nodes: ndarray) -> ndarray:
+        """Returns the concatenated postings of the given nodes."""
+        offsets, sets = index
+        lengths = offsets[nodes + 1] - offsets[nodes]
+        starts = np.cumsum(lengths) - lengths
+        return sets[np.repeat(offsets[nodes] - starts, lengths) + np.arange(lengths.sum())]
+
+    def __len__(self) -> int:
+        return len(self.sets)
+
+    def query(self, concepts, top_k: int = 20, exact: bool = False, stats: dict = None) -> list:
+        """
+        Returns the top_k sets of the index that are most similar (least distant for distance measures) to the
+        given concepts, as list of (set index, sim) with the best first, ties in set order. \n
+        The result is always exact. exact=True only turns off the pruning of bipartite_matching and solves the assignments
+        of all sets. If stats is given, it is filled with the number of indexed sets and of scored sets, and with the number of
+        candidates: sets not pruned by their bounds for bipartite_matching, sets sharing a concept with the query for trivial
+        set sims. mean_cs and hierarchical score all sets.
+        """
+        if isinstance(concepts, ndarray):
+            concept_ids = np.unique(concepts.astype(np.int32))
+        else:
+            concept_ids = np.unique(self.taxonomy.get_ids(concepts))
+        if self.setsim_mode in utils.TRIVIAL_SETSIM_MODES:
+            return self._queryTrivial(concept_ids, top_k, stats)
+
+        # CS values of the query concepts with the vocabulary, CS(q, v) for all sets at once
+        cs_matrix = utils.getCSBlock(concept_ids, self.vocabulary, self.taxonomy, self.ic_mode, self.cs_mode, self.cache)
+        sizes = self.sets.sizes().astype(np.float64)
+        sign = -1.0 if self.is_distance else 1.0
+        # set sims are divided by a positive factor per set, which keeps the bounds valid
+        factors = np.ones(len(self.sets))
+        if self.scale_to_setsizes:
+            factors = np.minimum(len(concept_ids), sizes) + np.log(np.abs(len(concept_ids) - sizes) + 1)
+        if self.setsim_mode == 'bipartite_matching':
+            return self._queryBipartiteMatching(cs_matrix, factors, sign, top_k, exact, stats)
+
+        set_cs_sums = np.asarray(self.incidence @ cs_matrix.T)
+        cs_sums = set_cs_sums.sum(axis=1)
+        if self.setsim_mode == 'mean_cs':
+            sims = setsim_algorithms.getMeanCSSetSimBatch(cs_sums, len(concept_ids), sizes)
+        else:
+            # shared[i, q]: query concept q is part of set i, see td_utils.getCSSetSimMatrix
+            positions = np.minimum(np.searchsorted(self.vocabulary, concept_ids), len(self.vocabulary) - 1)
+            in_vocabulary = self.vocabulary[positions] == concept_ids
+            shared = np.zeros((len(self.sets), len(concept_ids)))
+            shared[:, in_vocabulary] = self.incidence[:, positions[in_vocabulary]].toarray()
+            first_summands = (set_cs_sums*(1 - shared)).sum(axis=1)
+            second_summands = cs_sums - shared @ cs_matrix.sum(axis=0)[positions]
+            sims = setsim_algorithms.getHierachicalDistSetSimBatch(first_summands, second_summands, shared.sum(axis=1), len(concept_ids), sizes)
+        sims = sims/factors
+        ranking = np.lexsort((np.arange(len(sims)), -sign*sims))[:top_k]
+
+        td_profiling.active.count('set_sims', len(self.sets))
+        if stats is not None:
+            stats.update({'sets': len(self.sets), 'scored': len(self.sets)})
+        return [(int(r), float(sims[r])) for r in ranking]
+
+    def _queryBipartiteMatching(self, cs_matrix: ndarray, factors: ndarray, sign: float, top_k: int, exact: bool, stats: dict) -> list:
+        """
+        Solves the assignments of the sets in chunks, best upper bound (of the score sign*sim) first, until no remaining
+        bound reaches the k-th best score, see td_utils.getBipartiteMatchingNeighbours.
+        """
+        n_sets = len(self.sets)
+        lower, upper = self._getBipartiteMatchingSims(cs_matrix, np.arange(n_sets), bounds=True)
+        best, worst = (upper, lower) if sign > 0 else (-lower, -upper)
+        best, worst = best/factors, worst/factors
+        # bounds and exact sims are summed in different orders
+        slack = 1e-9*(np.abs(best) + 1)
+        best, worst = best + slack, worst - slack
+        bar = -np.inf
+        if not exact and top_k < n_sets:
+            # the k best sets score at least as much as the k-th best guaranteed score
+            bar = np.partition(worst, n_sets - top_k)[n_sets - top_k]
+        order = np.argsort(-best, kind='stable')
+        order = order[best[order] >= bar]
+
+        scores = np.empty(0)
+        indices = np.empty(0, dtype=np.int64)
+        position = 0
+        scored = 0
+        # solve the most promising sets first, in chunks, until no bound reaches the bar
+        while position < len(order) and best[order[position]] >= bar:
+            chunk = order[position:position + 256]
+            chunk = chunk[best[chunk] >= bar]
+            position += 256
+            scored += len(chunk)
+            sims = self._getBipartiteMatchingSims(cs_matrix, chunk)/factors[chunk]
+            scores = np.concatenate((scores, sign*sims))
+            indices = np.concatenate((indices, chunk))
+            if not exact and len(scores) >= top_k:
+                best_k = np.lexsort((indices, -scores))[:top_k]
+                scores, indices = scores[best_k], indices[best_k]
+                bar = max(bar, scores[-1])
+
+        ranking = np.lexsort((indices, -scores))[:top_k]
+        td_profiling.active.count('set_sims', scored)
+        if stats is not None:
+            stats.update({'sets': n_sets, 'candidates': len(order), 'scored': scored})
+        return [(int(indices[r]), float(sign*scores[r])) for r in ranking]
+
+    def _getBipartiteMatchingSims(self, cs_matrix: ndarray, set_indices: ndarray, bounds: bool = False):
+        """
+        Returns the bipartite matching sims of the query with the given sets, or their (lower, upper) bounds.
+        cs_matrix holds the CS values of the query concepts with the vocabulary.
+        """
+        sizes = self.sets.sizes()[set_indices]
+        sims = np.empty(len(set_indices))
+        lower = np.empty(len(set_indices))
+        maximize = not utils.isDistance(self.cs_mode)
+        indptr, indices = self.incidence.indptr, self.incidence.indices
+        for k in np.unique(sizes).tolist():
+            group = np.flatnonzero(sizes == k)
+            # at most about 4M CS values per block
+            block_size = max(1, (1 << 22)//(cs_matrix.shape[0]*k))
+            for start in range(0, len(group), block_size):
+                block = group[start:start + block_size]
+                costs = np.moveaxis(cs_matrix[:, indices[indptr[set_indices[block]][:, None] + np.arange(k)]], 0, 1)
+                if costs.shape[1] > k:
+                    # the assignment sums are symmetric, the smaller set goes first
+                    costs = costs.transpose(0, 2, 1)
+                if bounds:
+                    lower[block], sims[block] = setsim_algorithms.getAssignmentBoundsBatch(costs, maximize)
+                else:
+                    sims[block] = setsim_algorithms.getOptimalAssignmentSumsBatch(costs, self.cs_mode)
+        if bounds:
+            return lower, sims
+        return sims
+
+    def _queryTrivial(self, concept_ids: ndarray, top_k: int, stats: dict) -> list:
+        """Scores all sets at once from the intersection counts of the concept index."""
+        postings = self._getPostings(self.concept_index, concept_ids.astype(np.int64))
+        intersections = np.bincount(postings, minlength=len(self.sets)).astype(np.float64)
+        sizes = self.sets.sizes().astype(np.float64)
+        if self.setsim_mode == 'jaccard':
+            sims = setsim_algorithms.getJaccardSetSimBatch(intersections, len(concept_ids), sizes)
+        elif self.setsim_mode == 'dice':
+            sims = setsim_algorithms.getDiceSetSimBatch(intersections, len(concept_ids), sizes)
+        elif self.setsim_mode == 'cosine':
+            sims = setsim_algorithms.getCosineSetSimBatch(intersections, len(concept_ids), sizes)
+        else:
+            sims = setsim_algorithms.getOverlapSetSimBatch(intersections, len(concept_ids), sizes)
+        if self.scale_to_setsizes:
+            sims = utils.getScaledSetSims(sims[None, :], [len(concept_ids)], sizes)[0]
+        ranking = np.argsort(-sims, kind='stable')[:top_k]
+
+        td_profiling.active.count('set_sims', len(self.sets))
+        if stats is not None:
+            n_candidates = int(np.count_nonzero(intersections))
+            stats.update({'sets': len(self.sets), 'candidates': n_candidates, 'scored': len(self.sets)})
+        return [(int(r), float(sims[r])) for r in ranking]
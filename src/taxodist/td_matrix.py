@@ -0,0 +1,126 @@
+import math
+import numpy as np
+from numpy import ndarray
+from numpy.lib.format import open_memmap
+
+# number of values processed at once when a whole matrix is scanned or rescaled
+CHUNK_SIZE = 1 << 22
+
+class CondensedMatrix:
+    """
+    Symmetric n x n matrix that only stores the upper triangle. \n
+    values holds the n diagonal entries followed by the n(n-1)/2 entries above the diagonal
+    in scipy squareform layout (row by row), see condensed. Values can be any float dtype and
+    may be a np.memmap, so matrices larger than the main memory are possible (see create and open).
+    Rows and pairs are read without materializing the square matrix.
+    """
+    def __init__(self, values: ndarray) -> None:
+        self.n = getMatrixSize(len(values))
+        self.values = values
+        self.diagonal = values[:self.n]
+        self.condensed = values[self.n:]
+
+    @classmethod
+    def create(cls, n: int, dtype=np.float32, path: str = None) -> 'CondensedMatrix':
+        """Returns a zero-initialized matrix, stored as memory-mapped .npy file if a path is given."""
+        length = n*(n + 1)//2
+        if path is None:
+            return cls(np.zeros(length, dtype=dtype))
+        return cls(open_memmap(path, mode='w+', dtype=dtype, shape=(length,)))
+
+    @classmethod
+    def open(cls, path: str, mode: str = 'r') -> 'CondensedMatrix':
+        """Memory-maps a matrix that was created with a path."""
+        return cls(np.load(path, mmap_mode=mode))
+
+    @property
+    def shape(self) -> tuple:
+        return (self.n, self.n)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def __len__(self) -> int:
+        return self.n
+
+    def index(self, i, j):
+        """Returns the position of entry (i, j), i < j, in condensed. Works element-wise on arrays."""
+        return self.n*i - i*(i + 1)//2 + (j - i - 1)
+
+    def get(self, i: int, j: int) -> float:
+        if i == j:
+            return self.diagonal[i].item()
+        if i > j:
+            i, j = j, i
+        return self.condensed[self.index(i, j)].item()
+
+    def get_pairs(self, rows, cols) -> ndarray:
+        """Returns the entries of the given (row, column) pairs."""
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        i = np.minimum(rows, cols)
+        j = np.maximum(rows, cols)
+        off_diagonal = i != j
+        values = self.diagonal[i]
+        values[off_diagonal] = self.condensed[self.index(i[off_diagonal], j[off_diagonal])]
+        return values
+
+    def row(self, i: int) -> ndarray:
+        """Returns row i of the square matrix."""
+        row = np.empty(self.n, dtype=self.dtype)
+        above = np.arange(i, dtype=np.int64)
+        row[:i] = self.condensed[self.index(above, i)]
+        row[i] = self.diagonal[i]
+        start = self.index(i, i + 1)
+        row[i + 1:] = self.condensed[start:start + self.n - i - 1]
+        return row
+
+    def set_block(self, row_start: int, col_start: int, block: ndarray):
+        """Writes the part of a block of the square matrix that lies on or above the diagonal."""
+        rows, cols = block.shape
+        for r in range(rows):
+            i = row_start + r
+            if col_start <= i < col_start + cols:
+                self.diagonal[i] = block[r, i - col_start]
+            first = max(col_start, i + 1)
+            if first < col_start + cols:
+                start = self.index(i, first)
+                self.condensed[start:start + col_start + cols - first] = block[r, first - col_start:]
+
+    def max(self) -> float:
+        return max(getChunkedMax(self.diagonal), getChunkedMax(self.condensed))
+
+    def normalize(self) -> 'CondensedMatrix':
+        """Divides all entries by the maximum in place."""
+        max_value = self.max()
+        for start in range(0, len(self.values), CHUNK_SIZE):
+            self.values[start:start + CHUNK_SIZE] /= max_value
+        return self
+
+    def to_square(self) -> ndarray:
+        """Returns the dense n x n matrix."""
+        square = np.zeros(self.shape, dtype=self.dtype)
+        for i in range(self.n):
+            start = self.index(i, i + 1)
+            square[i, i + 1:] = self.condensed[start:start + self.n - i - 1]
+        square += square.T
+        square[np.diag_indices(self.n)] = self.diagonal
+        return square
+
+    def flush(self):
+        """Writes pending changes of a memory-mapped matrix to disk."""
+        if isinstance(self.values, np.memmap):
+            self.values.flush()
+
+def getMatrixSize(length: int) -> int:
+    """Returns n of a CondensedMatrix with length = n(n+1)/2 values."""
+    n = (math.isqrt(8*length + 1) - 1)//2
+    if n*(n + 1)//2 != length:
+        raise ValueError('Invalid length of condensed matrix: ', length)
+    return n
+
+def getChunkedMax(values: ndarray) -> float:
+    if len(values) == 0:
+        return -math.inf
+    return max(np.max(values[start:start + CHUNK_SIZE]).item() for start in range(0, len(values), CHUNK_SIZE))
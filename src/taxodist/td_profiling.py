@@ -0,0 +1,184 @@
+import cProfile
+import functools
+import os
+import time
+from contextlib import nullcontext
+from timeit import default_timer as timer
+
+class Instrumentation:
+    """
+    Collects where the time of Taxodist runs goes: \n
+    phases - exclusive wall time and number of entries per phase ('tree_parse', 'ic', 'lca', 'cs', 'set_sim', 'normalize', 'mds', 'output').
+    A nested phase pauses the enclosing one, so the phases of a run add up to its total time; time outside of all phases is 'other'. \n
+    counters - e.g. getCS calls, CS values looked up (cs_lookups) and computed (cs_values), CS cache hits and misses
+    (in CS values), set pairs scored (set_sims), tiles \n
+    workers - busy and idle time and number of tiles of every worker process of the tiled computations (see td_utils.runTiles).
+    The counters of worker processes are added to those of the calling process, phases within them are not recorded,
+    their time is part of the enclosing phase of the calling process. \n
+    If profile_path is given, the runs are also profiled with cProfile and the accumulated stats are dumped to profile_path
+    after every run (read them with pstats.Stats(profile_path)).
+    """
+    enabled = True
+
+    def __init__(self, profile_path: str = None) -> None:
+        self.profile_path = profile_path
+        self.profiler = cProfile.Profile() if profile_path is not None else None
+        self.reset()
+
+    def reset(self):
+        """Drops all collected times and counters."""
+        self.phases = {}
+        self.counters = {}
+        self.workers = {}
+        self.runs = {}
+        self.total_time = 0.0
+        self._stack = []
+
+    def phase(self, name: str) -> 'Phase':
+        """Returns a context manager that adds the wall time spent in it to the phase name."""
+        return Phase(self, name)
+
+    def _enter(self, name: str):
+        now = timer()
+        if self._stack:
+            self._addTime(self._stack[-1][0], now - self._stack[-1][1], 0)
+        self._stack.append([name, now])
+
+    def _exit(self):
+        now = timer()
+        name, start = self._stack.pop()
+        self._addTime(name, now - start, 1)
+        if self._stack:
+            # the enclosing phase continues now
+            self._stack[-1][1] = now
+
+    def _addTime(self, name: str, elapsed: float, calls: int):
+        phase = self.phases.setdefault(name, {'time': 0.0, 'calls': 0})
+        phase['time'] += elapsed
+        phase['calls'] += calls
+
+    def count(self, name: str, n: int = 1):
+        """Increments the counter name by n."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_counters(self, counters: dict):
+        """Adds counters collected elsewhere, e.g. in a worker process (see getTimedTile)."""
+        for name, n in counters.items():
+            self.count(name, n)
+
+    def add_worker_times(self, times: list, wall_time: float):
+        """
+        Adds the (worker, start, stop) times of the tiles of one tiled computation that took wall_time seconds.
+        Workers are idle for the part of wall_time they spend on no tile, including their startup.
+        """
+        busy = {}
+        for worker, start, stop in times:
+            worker_busy = busy.setdefault(worker, [0.0, 0])
+            worker_busy[0] += stop - start
+            worker_busy[1] += 1
+        for worker, (busy_time, tiles) in busy.items():
+            worker_times = self.workers.setdefault(worker, {'busy': 0.0, 'idle': 0.0, 'tiles': 0})
+            worker_times['busy'] += busy_time
+            worker_times['idle'] += max(wall_time - busy_time, 0.0)
+            worker_times['tiles'] += tiles
+
+    def report(self) -> dict:
+        """Returns the collected times and counters as dict, see Instrumentation."""
+        return {
+            'total_time': self.total_time,
+            'runs': dict(self.runs),
+            'phases': {name: dict(phase) for name, phase in self.phases.items()},
+            'counters': dict(self.counters),
+            'workers': {worker: dict(times) for worker, times in self.workers.items()},
+            'profile_path': self.profile_path,
+        }
+
+class Phase:
+    """Context manager of Instrumentation.phase."""
+    __slots__ = ('instrumentation', 'name')
+
+    def __init__(self, instrumentation: Instrumentation, name: str) -> None:
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.instrumentation._enter(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation._exit()
+
+class NullInstrumentation:
+    """Instrumentation that records nothing, used while instrumentation is turned off."""
+    enabled = False
+    profile_path = None
+    _phase = nullcontext()
+
+    def phase(self, name: str):
+        return self._phase
+
+    def count(self, name: str, n: int = 1):
+        pass
+
+    def add_counters(self, counters: dict):
+        pass
+
+    def add_worker_times(self, times: list, wall_time: float):
+        pass
+
+    def reset(self):
+        pass
+
+    def report(self) -> dict:
+        return None
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+# instrumentation of the current run, used by the hooks in td_utils, see instrumented
+active = NULL_INSTRUMENTATION
+
+def instrumented(method):
+    """
+    Decorator for Taxodist methods: while the method runs, self.instrumentation is the active instrumentation and
+    the run is timed (and profiled). Calls from within an instrumented method are part of the outer run.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        global active
+        instrumentation = self.instrumentation
+        if not instrumentation.enabled or active is instrumentation:
+            return method(self, *args, **kwargs)
+        previous, active = active, instrumentation
+        if instrumentation.profiler is not None:
+            instrumentation.profiler.enable()
+        start = timer()
+        try:
+            with instrumentation.phase('other'):
+                return method(self, *args, **kwargs)
+        finally:
+            instrumentation.total_time += timer() - start
+            instrumentation.runs[method.__name__] = instrumentation.runs.get(method.__name__, 0) + 1
+            if instrumentation.profiler is not None:
+                instrumentation.profiler.disable()
+                instrumentation.profiler.dump_stats(instrumentation.profile_path)
+            active = previous
+    return wrapper
+
+def getTimedTile(tile_function, tile: tuple) -> tuple:
+    """
+    Runs tile_function(tile) and returns its result with the process id, the start and stop time and the counters
+    of the tile, see td_utils.runTiles. Within the calling process, the counters go to the active instrumentation
+    directly and the returned counters are empty.
+    """
+    global active
+    if active.enabled:
+        # wall clock times, as they are compared across processes
+        start = time.time()
+        result = tile_function(tile)
+        return result, os.getpid(), start, time.time(), {}
+    previous, active = active, Instrumentation()
+    try:
+        start = time.time()
+        result = tile_function(tile)
+        return result, os.getpid(), start, time.time(), active.counters
+    finally:
+        active = previous
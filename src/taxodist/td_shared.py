@@ -0,0 +1,61 @@
+from multiprocessing import shared_memory
+import numpy as np
+from numpy import ndarray
+
+class SharedArrays:
+    """
+    Copies numpy arrays into multiprocessing.shared_memory blocks. \n
+    spec is a small picklable description that worker processes pass to attachSharedArrays
+    to map the same memory without copying or pickling the data. The creating process owns the
+    blocks and has to release them with close().
+    """
+    def __init__(self, arrays: dict) -> None:
+        self.arrays = {}
+        self.spec = {}
+        self._blocks = []
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self._blocks.append(block)
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared[...] = array
+            self.arrays[name] = shared
+            self.spec[name] = (block.name, array.shape, array.dtype.str)
+
+    def add(self, name: str, shape: tuple, dtype) -> ndarray:
+        """Allocates a new zero-initialized shared array, e.g. as output buffer of the workers."""
+        dtype = np.dtype(dtype)
+        block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*dtype.itemsize, 1))
+        self._blocks.append(block)
+        shared = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        shared.fill(0)
+        self.arrays[name] = shared
+        self.spec[name] = (block.name, shape, dtype.str)
+        return shared
+
+    def close(self):
+        """Releases and removes all blocks. Arrays handed out before are invalid afterwards."""
+        self.arrays = {}
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def attachSharedArrays(spec: dict):
+    """
+    Maps the arrays described by SharedArrays.spec into the calling process. \n
+    Returns the arrays and the shared-memory handles, which have to be kept alive as long as the arrays are used.
+    """
+    arrays = {}
+    blocks = []
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    return arrays, blocks
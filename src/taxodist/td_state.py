@@ -0,0 +1,261 @@
+import json
+import os
+import sys
+import numpy as np
+from numpy import ndarray
+from treelib.tree import Tree
+from src.taxodist import td_utils as utils
+from src.taxodist.td_matrix import CondensedMatrix, CHUNK_SIZE
+from src.taxodist.td_taxonomy import CompiledTaxonomy, ConceptSets
+from src.taxodist.td_cache import CSCache
+
+STATE_FORMAT = 2
+
+class SetSimState:
+    """
+    Persisted set sim matrix of a growing cohort of concept sets, stored as a directory: \n
+    header.json - format, taxonomy fingerprint, modes, dtype, number of sets (n) and of concepts (vocabulary) \n
+    set_offsets.npy, set_ids.npy - the sets as ConceptSets of node ids, active.npy - False for removed sets \n
+    vocabulary.bin - int32 node ids of all concepts seen so far, in the order they were added \n
+    cs.bin - the CS values of the vocabulary (not needed for trivial set sims), matrix.bin - the raw set sims, both as packed
+    lower triangle including the diagonal: row i holds the values of item i with items 0..i and starts at i*(i+1)/2,
+    so new concepts and sets only write to the end of the files. \n
+    The header is replaced last and only counts complete rows, the .npy files are replaced via temporary files,
+    so an interrupted append leaves the state as it was before. append_sets computes only the rows of the new sets and
+    only the CS of new concepts. remove_sets marks sets as removed, compact drops them from the files, both without
+    computing any set sims. CS values of new concepts are taken from and memorized in the cache, if any.
+    """
+    def __init__(self, path: str, tree: Tree, cache: CSCache = None) -> None:
+        self.path = path
+        self.cache = cache
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        if header.get('format') != STATE_FORMAT:
+            raise ValueError('Unsupported set sim state format: ', header.get('format'))
+        self.taxonomy: CompiledTaxonomy = utils.getCompiledTaxonomy(tree)
+        if header['fingerprint'] != self.taxonomy.get_fingerprint():
+            raise ValueError('Set sim state was created for a different taxonomy: ', path)
+        self.ic_mode = header['ic_mode']
+        self.cs_mode = header['cs_mode']
+        self.setsim_mode = header['setsim_mode']
+        self.dtype = np.dtype(header['dtype'])
+        self.n = header['n']
+
+        # files can hold sets and concepts of an interrupted append, which the header does not count
+        offsets = np.load(self._getFile('set_offsets.npy'))[:self.n + 1]
+        self.sets = ConceptSets(offsets, np.load(self._getFile('set_ids.npy'))[:offsets[-1]])
+        self.active = np.load(self._getFile('active.npy'))[:self.n]
+        self.vocabulary = np.fromfile(self._getFile('vocabulary.bin'), dtype=np.int32, count=header['vocabulary'])
+        # maps node ids to their position in the vocabulary
+        self.local_ids = np.full(len(self.taxonomy), -1, dtype=np.int64)
+        self.local_ids[self.vocabulary] = np.arange(len(self.vocabulary))
+
+    @classmethod
+    def create(cls, path: str, sets, tree: Tree, ic_mode: str, cs_mode: str, setsim_mode: str, dtype=np.float64, cache: CSCache = None) -> 'SetSimState':
+        """Creates a new state directory at path for the given sets."""
+        try:
+            if setsim_mode not in utils.BATCH_SETSIM_MODES:
+                raise ValueError("Unsupported setsim algorithm: ", setsim_mode)
+        except ValueError as err:
+            print(err.args)
+            sys.exit()
+        taxonomy = utils.getCompiledTaxonomy(tree)
+        os.makedirs(path, exist_ok=True)
+        header = {'format': STATE_FORMAT, 'fingerprint': taxonomy.get_fingerprint(), 'ic_mode': ic_mode, 'cs_mode': cs_mode,
+                  'setsim_mode': setsim_mode, 'dtype': np.dtype(dtype).str, 'n': 0, 'vocabulary': 0}
+        np.save(os.path.join(path, 'set_offsets.npy'), np.zeros(1, dtype=np.int64))
+        np.save(os.path.join(path, 'set_ids.npy'), np.zeros(0, dtype=np.int32))
+        np.save(os.path.join(path, 'active.npy'), np.zeros(0, dtype=bool))
+        for name in ('vocabulary.bin', 'cs.bin', 'matrix.bin'):
+            open(os.path.join(path, name), 'wb').close()
+        replaceFile(os.path.join(path, 'header.json'), lambda f: f.write(json.dumps(header).encode('utf-8')))
+
+        state = cls(path, taxonomy, cache)
+        state.append_sets(sets)
+        return state
+
+    @classmethod
+    def open(cls, path: str, tree: Tree, cache: CSCache = None) -> 'SetSimState':
+        """Opens an existing state directory; the taxonomy must be the one it was created with."""
+        return cls(path, tree, cache)
+
+    def _getFile(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def __len__(self) -> int:
+        """Returns the number of active sets."""
+        return int(np.count_nonzero(self.active))
+
+    def active_indices(self) -> ndarray:
+        """Returns the indices of the active sets; indices are stable until compact is called."""
+        return np.flatnonzero(self.active)
+
+    def get_matrix(self) -> ndarray:
+        """Returns the packed lower triangle as read-only memory map."""
+        length = self.n*(self.n + 1)//2
+        if length == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self._getFile('matrix.bin'), dtype=self.dtype, mode='r', shape=(length,))
+
+    def get_pairs(self, rows, cols) -> ndarray:
+        """Returns the set sims of the given pairs of set indices."""
+        return getPackedValues(self.get_matrix(), rows, cols)
+
+    def get_cs_values(self) -> ndarray:
+        """Returns the CS values of the vocabulary as packed lower triangle (see SetSimState) in a read-only memory map."""
+        length = len(self.vocabulary)*(len(self.vocabulary) + 1)//2
+        if length == 0 or self.setsim_mode in utils.TRIVIAL_SETSIM_MODES:
+            return np.zeros(0)
+        return np.memmap(self._getFile('cs.bin'), dtype=np.float64, mode='r', shape=(length,))
+
+    def get_cs_matrix(self, local_ids: ndarray) -> ndarray:
+        """Returns the CS matrix of the concepts at the given positions of the vocabulary."""
+        cs_values = self.get_cs_values()
+        local_ids = np.asarray(local_ids, dtype=np.int64)
+        cs_matrix = np.empty((len(local_ids), len(local_ids)))
+        block_size = max(CHUNK_SIZE//max(len(local_ids), 1), 1)
+        for row_start in range(0, len(local_ids), block_size):
+            cs_matrix[row_start:row_start + block_size] = getPackedValues(cs_values, local_ids[row_start:row_start + block_size, None], local_ids[None, :])
+        return cs_matrix
+
+    def get(self, i: int, j: int) -> float:
+        """Returns the set sim of sets i and j."""
+        return self.get_pairs(i, j).item()
+
+    def row(self, i: int) -> ndarray:
+        """Returns the set sims of set i with all active sets."""
+        return self.get_pairs(i, self.active_indices())
+
+    def append_sets(self, sets) -> ndarray:
+        """
+        Appends concept sets and computes their set sims with all active sets. \n
+        Returns the indices of the new sets.
+        """
+        new_sets = self.taxonomy.get_concept_sets(sets)
+        try:
+            if (new_sets.sizes() == 0).any():
+                raise ValueError('Empty Concept Set(s)')
+        except ValueError as err:
+            print(err.args)
+            sys.exit()
+        if len(new_sets) == 0:
+            return np.zeros(0, dtype=np.int64)
+        self._extendVocabulary(new_sets.ids)
+
+        start = self.n
+        self.sets = ConceptSets(np.concatenate((self.sets.offsets, new_sets.offsets[1:] + self.sets.offsets[-1])),
+                                np.concatenate((self.sets.ids, new_sets.ids)))
+        self.active = np.concatenate((self.active, np.ones(len(new_sets), dtype=bool)))
+        local_sets = ConceptSets(self.sets.offsets, self.local_ids[self.sets.ids])
+
+        matrix_file = self._getFile('matrix.bin')
+        with open(matrix_file, 'r+b') as f:
+            # drop rows of an interrupted append, they are not counted in the header
+            f.truncate(start*(start + 1)//2*self.dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            row_start = start
+            while row_start < len(self.sets):
+                row_stop = min(row_start + max(CHUNK_SIZE//(row_start + 1), 1), len(self.sets))
+                cols = np.flatnonzero(self.active[:row_stop])
+                block = np.full((row_stop - row_start, row_stop), np.nan, dtype=self.dtype)
+                block[:, cols] = self._getSetSimBlock(local_sets.take(np.arange(row_start, row_stop)), local_sets.take(cols))
+                # the lower triangle in row-major order is the packed layout
+                lower = np.arange(row_start, row_stop)[:, None] >= np.arange(row_stop)[None, :]
+                f.write(block[lower].tobytes())
+                row_start = row_stop
+
+        self.n = len(self.sets)
+        self._saveSets()
+        return np.arange(start, self.n)
+
+    def _getSetSimBlock(self, sets_1: ConceptSets, sets_2: ConceptSets) -> ndarray:
+        """Returns the set sims of two groups of sets of vocabulary positions, using the CS matrix of only their concepts."""
+        if self.setsim_mode in utils.TRIVIAL_SETSIM_MODES:
+            return utils.getSetSimBlock(sets_1, sets_2, self.setsim_mode, self.cs_mode, None, len(self.vocabulary))
+        concepts, ids = np.unique(np.concatenate((sets_1.ids, sets_2.ids)), return_inverse=True)
+        sets_1, sets_2 = ConceptSets(sets_1.offsets, ids[:len(sets_1.ids)]), ConceptSets(sets_2.offsets, ids[len(sets_1.ids):])
+        return utils.getSetSimBlock(sets_1, sets_2, self.setsim_mode, self.cs_mode, self.get_cs_matrix(concepts), len(concepts))
+
+    def _extendVocabulary(self, concept_ids: ndarray):
+        """Appends unseen concepts to the vocabulary and only their rows to the CS values."""
+        new_concepts = np.unique(concept_ids)
+        new_concepts = new_concepts[self.local_ids[new_concepts] < 0].astype(np.int32)
+        if len(new_concepts) == 0:
+            return
+        n_old = len(self.vocabulary)
+        vocabulary = np.concatenate((self.vocabulary, new_concepts))
+        # drop concepts and CS rows of an interrupted append, they are not counted in the header
+        with open(self._getFile('vocabulary.bin'), 'r+b') as f:
+            f.truncate(n_old*vocabulary.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(new_concepts.tobytes())
+        if self.setsim_mode not in utils.TRIVIAL_SETSIM_MODES:
+            with open(self._getFile('cs.bin'), 'r+b') as f:
+                f.truncate(n_old*(n_old + 1)//2*np.dtype(np.float64).itemsize)
+                f.seek(0, os.SEEK_END)
+                row_start = n_old
+                while row_start < len(vocabulary):
+                    row_stop = min(row_start + max(CHUNK_SIZE//len(vocabulary), 1), len(vocabulary))
+                    block = utils.getCSBlock(vocabulary[row_start:row_stop], vocabulary[:row_stop], self.taxonomy, self.ic_mode, self.cs_mode, self.cache)
+                    lower = np.arange(row_start, row_stop)[:, None] >= np.arange(row_stop)[None, :]
+                    f.write(block[lower].tobytes())
+                    row_start = row_stop
+        self.vocabulary = vocabulary
+        self.local_ids[new_concepts] = np.arange(n_old, len(vocabulary))
+
+    def _saveSets(self):
+        replaceFile(self._getFile('set_offsets.npy'), lambda f: np.save(f, self.sets.offsets))
+        replaceFile(self._getFile('set_ids.npy'), lambda f: np.save(f, self.sets.ids))
+        replaceFile(self._getFile('active.npy'), lambda f: np.save(f, self.active))
+        # the header is replaced last, so it only counts complete rows
+        header = {'format': STATE_FORMAT, 'fingerprint': self.taxonomy.get_fingerprint(), 'ic_mode': self.ic_mode, 'cs_mode': self.cs_mode,
+                  'setsim_mode': self.setsim_mode, 'dtype': self.dtype.str, 'n': self.n, 'vocabulary': len(self.vocabulary)}
+        replaceFile(self._getFile('header.json'), lambda f: f.write(json.dumps(header).encode('utf-8')))
+
+    def remove_sets(self, indices):
+        """Marks sets as removed; their rows stay in the files until compact is called."""
+        self.active[np.asarray(indices, dtype=np.int64)] = False
+        self._saveSets()
+
+    def to_condensed(self, path: str = None) -> CondensedMatrix:
+        """Returns the set sims of the active sets as CondensedMatrix, memory-mapped if a path is given."""
+        indices = self.active_indices()
+        condensed = CondensedMatrix.create(len(indices), dtype=self.dtype, path=path)
+        row_start = 0
+        while row_start < len(indices):
+            row_stop = min(row_start + max(CHUNK_SIZE//len(indices), 1), len(indices))
+            block = self.get_pairs(indices[row_start:row_stop, None], indices[None, row_start:])
+            condensed.set_block(row_start, row_start, block)
+            row_start = row_stop
+        return condensed
+
+    def compact(self):
+        """Drops removed sets from the files by copying the set sims of the active sets. Set indices change accordingly."""
+        indices = self.active_indices()
+        tmp_file = self._getFile('matrix.bin.tmp')
+        with open(tmp_file, 'wb') as f:
+            row_start = 0
+            while row_start < len(indices):
+                row_stop = min(row_start + max(CHUNK_SIZE//(row_start + 1), 1), len(indices))
+                block = self.get_pairs(indices[row_start:row_stop, None], indices[None, :row_stop])
+                lower = np.arange(row_start, row_stop)[:, None] >= np.arange(row_stop)[None, :]
+                f.write(block[lower].tobytes())
+                row_start = row_stop
+        os.replace(tmp_file, self._getFile('matrix.bin'))
+        self.sets = self.sets.take(indices)
+        self.active = np.ones(len(indices), dtype=bool)
+        self.n = len(indices)
+        self._saveSets()
+
+def getPackedValues(values: ndarray, rows, cols) -> ndarray:
+    """Returns the values of the given pairs of a symmetric matrix stored as packed lower triangle, see SetSimState."""
+    rows, cols = np.broadcast_arrays(np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))
+    upper, lower = np.maximum(rows, cols), np.minimum(rows, cols)
+    return np.asarray(values[upper*(upper + 1)//2 + lower])
+
+def replaceFile(path: str, write):
+    """Calls write with a temporary file that then replaces the file at path, so the file is never left partly written."""
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        write(f)
+    os.replace(tmp_file, path)
@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from src.taxodist.td_taxonomy import CompiledTaxonomy, STORAGE_FORMAT
+
+# default directory of the persistent taxonomy cache
+CACHE_DIR = '.taxodist_cache'
+
+def getCachedTaxonomy(source: str, build_tree, version: str = None, cache_dir: str = CACHE_DIR, mmap: bool = True) -> CompiledTaxonomy:
+    """
+    Returns the compiled taxonomy of a source file (e.g. a ClaML export) from the persistent cache. \n
+    Entries are keyed by the SHA-256 of the source file and the version. On a miss, build_tree() is called
+    to parse the source, and the compiled result is stored before it is returned. Hits are loaded as
+    memory maps, so all processes using the same cache share one copy of the pages.
+    """
+    path = os.path.join(cache_dir, getCacheKey(source, version, cache_dir))
+    if os.path.isfile(os.path.join(path, 'header.json')):
+        return CompiledTaxonomy.load(path, mmap=mmap)
+
+    taxonomy = CompiledTaxonomy(build_tree())
+    # write into a temporary directory first, so concurrent readers never see a partial entry
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        taxonomy.save(tmp_path)
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process stored the same entry in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return CompiledTaxonomy.load(path, mmap=mmap) if mmap else taxonomy
+
+def getCacheKey(source: str, version: str, cache_dir: str = CACHE_DIR) -> str:
+    """
+    Returns the cache key of a source file. \n
+    Hashes are remembered in an index next to the entries, so unchanged files (same size and mtime)
+    are not read again.
+    """
+    stat = os.stat(source)
+    index_path = os.path.join(cache_dir, 'index.json')
+    index = {}
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    entry = index.get(os.path.abspath(source))
+    if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': getFileHash(source)}
+        index[os.path.abspath(source)] = entry
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_index = index_path + '.' + str(os.getpid())
+        with open(tmp_index, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_index, index_path)
+
+    name = os.path.splitext(os.path.basename(source))[0]
+    return '{}-{}-{}-v{}'.format(name, version, entry['sha256'][:16], STORAGE_FORMAT)
+
+def getFileHash(path: str) -> str:
+    """Returns the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,304 @@
+import hashlib
+import json
+import os
+import numpy as np
+from treelib.tree import Tree
+from numpy import ndarray
+
+# version of the on-disk layout written by CompiledTaxonomy.save
+STORAGE_FORMAT = 1
+STORED_ARRAYS = ('parents','depths','subtree_ends','euler','first_visit','sparse_table','label_bytes','label_offsets')
+
+class CompiledTaxonomy:
+    """
+    Immutable, array-backed representation of a taxonomy tree. \n
+    Nodes are numbered in depth-first pre-order, so every subtree occupies the contiguous id-range
+    [id, subtree_ends[id]). LCA queries are answered in constant time by a sparse-table RMQ
+    over the Euler tour of the tree.
+
+    ----
+    ## Attributes:\n
+
+    * codes (list): identifier of every node, indexed by node id \n
+    * ids (dict): node id of every identifier \n
+    * parents (ndarray): int32 parent id of every node, -1 for the root \n
+    * depths (ndarray): int32 depth of every node, 0 for the root \n
+    * subtree_ends (ndarray): int32 exclusive end of every node's pre-order subtree range \n
+    * euler (ndarray): int32 Euler tour of the node ids (length 2n-1) \n
+    * first_visit (ndarray): int32 position of every node's first appearance in the Euler tour \n
+    * sparse_table (ndarray): int32 RMQ table, row k holds the shallowest node of euler[i:i+2^k] \n
+    * label_bytes, label_offsets (ndarray): UTF-8 labels (node data) of all nodes, see get_label \n
+
+    Compiled taxonomies can be saved to a directory and loaded memory-mapped (see save and load),
+    so several processes share one copy of the arrays.
+    """
+    def __init__(self, tree: Tree) -> None:
+        if tree is None or tree.root is None:
+            raise ValueError('Empty taxonomy tree')
+
+        # pre-order traversal that keeps the insertion order of the children
+        codes = []
+        labels = []
+        parents = []
+        nodes = tree.nodes
+        stack = [(tree.root, -1)]
+        while stack:
+            code, parent = stack.pop()
+            parents.append(parent)
+            codes.append(code)
+            data = nodes[code].data
+            labels.append(data if isinstance(data, str) else '')
+            node_id = len(codes) - 1
+            for child in reversed(nodes[code].successors(tree.identifier)):
+                stack.append((child, node_id))
+
+        self.codes = codes
+        self.parents = np.asarray(parents, dtype=np.int32)
+        self.label_bytes, self.label_offsets = encodeStrings(labels)
+        self._setArrays()
+        self._setIndex()
+
+    def _setArrays(self):
+        n = len(self.codes)
+
+        # parents always precede their children in pre-order
+        parent_list = self.parents.tolist()
+        depths = [0]*n
+        for i in range(1, n):
+            depths[i] = depths[parent_list[i]] + 1
+        subtree_ends = list(range(1, n + 1))
+        for i in range(n - 1, 0, -1):
+            if subtree_ends[i] > subtree_ends[parent_list[i]]:
+                subtree_ends[parent_list[i]] = subtree_ends[i]
+        self.depths = np.asarray(depths, dtype=np.int32)
+        self.subtree_ends = np.asarray(subtree_ends, dtype=np.int32)
+
+        self.euler, self.first_visit = getEulerTour(self.parents, self.depths, self.subtree_ends)
+        self.sparse_table = getSparseTable(self.euler, self.depths)
+
+    def _setIndex(self):
+        self.ids = {code: i for i, code in enumerate(self.codes)}
+        self.root = self.codes[0]
+        self._log2 = np.zeros(len(self.euler) + 1, dtype=np.int32)
+        self._log2[2:] = np.floor(np.log2(np.arange(2, len(self.euler) + 1))).astype(np.int32)
+        self.max_depth = int(self.depths.max())
+        self.metadata = {}
+
+    def save(self, path: str):
+        """
+        Saves the taxonomy as a directory of .npy files plus a small JSON header. \n
+        Identifiers must be strings or integers.
+        """
+        os.makedirs(path, exist_ok=True)
+        code_kinds = np.zeros(len(self.codes), dtype=np.int8)
+        for i, code in enumerate(self.codes):
+            if isinstance(code, (int, np.integer)):
+                code_kinds[i] = 1
+            elif not isinstance(code, str):
+                raise ValueError('Unsupported identifier type for storage: ', type(code))
+        code_bytes = np.frombuffer('\x00'.join(map(str, self.codes)).encode('utf-8'), dtype=np.uint8)
+
+        arrays = self.get_arrays()
+        arrays['code_bytes'] = code_bytes
+        arrays['code_kinds'] = code_kinds
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+        header = {'format': STORAGE_FORMAT, 'size': len(self.codes), 'fingerprint': self.get_fingerprint()}
+        with open(os.path.join(path, 'header.json'), 'w') as f:
+            json.dump(header, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'CompiledTaxonomy':
+        """Loads a taxonomy saved with save. With mmap the arrays are read-only memory maps of the files."""
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        if header.get('format') != STORAGE_FORMAT:
+            raise ValueError('Unsupported taxonomy storage format: ', header.get('format'))
+
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in STORED_ARRAYS}
+
+        code_kinds = np.load(os.path.join(path, 'code_kinds.npy'))
+        code_bytes = np.load(os.path.join(path, 'code_bytes.npy'))
+        codes = code_bytes.tobytes().decode('utf-8').split('\x00')
+        for i in np.flatnonzero(code_kinds):
+            codes[i] = int(codes[i])
+        return cls.fromArrays(arrays, codes, header['fingerprint'])
+
+    @classmethod
+    def fromArrays(cls, arrays: dict, codes: list, fingerprint: str = None) -> 'CompiledTaxonomy':
+        """
+        Creates a taxonomy from the arrays returned by get_arrays without copying them,
+        e.g. from memory maps or shared memory (see td_shared).
+        """
+        taxonomy = cls.__new__(cls)
+        for name in STORED_ARRAYS:
+            setattr(taxonomy, name, arrays[name])
+        taxonomy.codes = codes
+        taxonomy._setIndex()
+        if fingerprint is not None:
+            taxonomy.metadata['fingerprint'] = fingerprint
+        return taxonomy
+
+    def get_arrays(self) -> dict:
+        """Returns the arrays that make up the taxonomy (see STORED_ARRAYS), keyed by name."""
+        return {name: getattr(self, name) for name in STORED_ARRAYS}
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __contains__(self, code) -> bool:
+        return code in self.ids
+
+    def contains(self, code) -> bool:
+        return code in self.ids
+
+    def size(self) -> int:
+        return len(self.codes)
+
+    def depth(self, node=None) -> int:
+        """Same as treelib.Tree.depth: maximum depth of the taxonomy, or depth of the given concept."""
+        if node is None:
+            return self.max_depth
+        return int(self.depths[self.ids[node]])
+
+    def level(self, node) -> int:
+        return int(self.depths[self.ids[node]])
+
+    def is_leaf(self, node) -> bool:
+        node_id = self.ids[node]
+        return self.subtree_ends[node_id] == node_id + 1
+
+    def get_fingerprint(self) -> str:
+        """Returns a hash of the taxonomy's structure and identifiers, e.g. to key caches."""
+        if 'fingerprint' not in self.metadata:
+            digest = hashlib.sha1(self.parents.tobytes())
+            digest.update('\x00'.join(map(repr, self.codes)).encode('utf-8'))
+            self.metadata['fingerprint'] = digest.hexdigest()
+        return self.metadata['fingerprint']
+
+    def get_label(self, node) -> str:
+        """Returns the label (node data) of a concept, '' if it had none."""
+        node_id = self.ids[node]
+        return bytes(self.label_bytes[self.label_offsets[node_id]:self.label_offsets[node_id+1]]).decode('utf-8')
+
+    def get_ids(self, codes) -> ndarray:
+        """Returns the int32 node ids of the given concepts."""
+        return np.fromiter((self.ids[code] for code in codes), dtype=np.int32)
+
+    def get_codes(self, ids) -> list:
+        """Returns the concepts of the given node ids, the inverse of get_ids."""
+        codes = self.codes
+        return [codes[i] for i in np.asarray(ids).tolist()]
+
+    def get_concept_sets(self, sets) -> 'ConceptSets':
+        """Encodes concept sets (iterables of concepts) as ConceptSets of node ids. ConceptSets are returned as they are."""
+        if isinstance(sets, ConceptSets):
+            return sets
+        return ConceptSets.fromIds([self.get_ids(concepts) for concepts in sets])
+
+    def get_ancestor_ids(self, node_id: int) -> list:
+        """Returns the ids of all proper ancestors of a node, starting with its parent."""
+        ancestors = []
+        node_id = self.parents[node_id]
+        while node_id >= 0:
+            ancestors.append(int(node_id))
+            node_id = self.parents[node_id]
+        return ancestors
+
+    def get_lca_ids(self, ids_1, ids_2):
+        """
+        Returns the lowest common ancestors of the given node ids (scalars or arrays of equal shape).
+        A node counts as its own ancestor here, see get_proper_lca_ids for the definition used by the CS algorithms.
+        """
+        left = self.first_visit[ids_1]
+        right = self.first_visit[ids_2]
+        left, right = np.minimum(left, right), np.maximum(left, right)
+        k = self._log2[right - left + 1]
+        candidate_1 = self.sparse_table[k, left]
+        candidate_2 = self.sparse_table[k, right - (1 << k) + 1]
+        return np.where(self.depths[candidate_1] <= self.depths[candidate_2], candidate_1, candidate_2)
+
+    def get_proper_lca_ids(self, ids_1, ids_2):
+        """
+        Returns the deepest shared ancestor of the given node ids, where a node is NOT its own ancestor
+        (as in td_utils.getAncestors). Pairs including the root map to the root.
+        """
+        lca = self.get_lca_ids(ids_1, ids_2)
+        nested = (lca == ids_1) | (lca == ids_2)
+        proper = np.where(nested, self.parents[lca], lca)
+        return np.where(proper < 0, 0, proper)
+
+class ConceptSets:
+    """
+    Concept sets as node ids of a CompiledTaxonomy in CSR layout: set i consists of
+    ids[offsets[i]:offsets[i+1]], sorted and without duplicates. Sets keep their position,
+    so duplicate sets are separate entries.
+    """
+    def __init__(self, offsets: ndarray, ids: ndarray) -> None:
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ids = np.asarray(ids, dtype=np.int32)
+
+    @classmethod
+    def fromIds(cls, sets: list) -> 'ConceptSets':
+        """Creates ConceptSets from a list of id arrays."""
+        sets = [np.unique(np.asarray(ids, dtype=np.int32)) for ids in sets]
+        offsets = np.zeros(len(sets) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(ids) for ids in sets])
+        ids = np.concatenate(sets) if sets else np.zeros(0, dtype=np.int32)
+        return cls(offsets, ids)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> ndarray:
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def sizes(self) -> ndarray:
+        """Returns the number of concepts of every set."""
+        return np.diff(self.offsets)
+
+    def take(self, indices: ndarray) -> 'ConceptSets':
+        """Returns the sets at the given indices as new ConceptSets."""
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.offsets[indices + 1] - self.offsets[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        positions = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return ConceptSets(offsets, self.ids[positions])
+
+def getEulerTour(parents: ndarray, depths: ndarray, subtree_ends: ndarray):
+    """
+    Returns the Euler tour of a tree given in pre-order numbering and the first-visit position of every node. \n
+    Before node i is entered, all i preceding nodes were entered and all of them except its ancestors were left again,
+    so it is first visited at 2i - depth(i). Leaving a subtree of size s returns to the parent 2s - 1 steps later.
+    """
+    n = len(parents)
+    ids = np.arange(n, dtype=np.int32)
+    first_visit = (2*ids - depths).astype(np.int32)
+    euler = np.empty(2*n - 1, dtype=np.int32)
+    euler[first_visit] = ids
+    subtree_sizes = subtree_ends[1:] - ids[1:]
+    euler[first_visit[1:] + 2*subtree_sizes - 1] = parents[1:]
+    return euler, first_visit
+
+def getSparseTable(euler: ndarray, depths: ndarray) -> ndarray:
+    """Returns the sparse table for range-minimum queries over the depths of the Euler tour."""
+    length = len(euler)
+    levels = max(int(np.log2(length)) + 1, 1)
+    table = np.zeros(shape=(levels, length), dtype=np.int32)
+    table[0] = euler
+    for k in range(1, levels):
+        half = 1 << (k - 1)
+        stop = length - (1 << k) + 1
+        a = table[k - 1, :stop]
+        b = table[k - 1, half:half + stop]
+        table[k, :stop] = np.where(depths[a] <= depths[b], a, b)
+    return table
+
+def encodeStrings(strings: list):
+    """Returns the concatenated UTF-8 bytes of the given strings and the int64 offsets of each string."""
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
@@ -2,6 +2,9 @@ import sys
 import os
 import math
 import random
+import time
+import weakref
+import concurrent.futures as cf
 import xml.etree.ElementTree as ET
 sys.path.append(os.getcwd())
 
@@ -11,17 +14,31 @@ import pandas as pd
 import treelib
 from pandas.core.frame import DataFrame
 from scipy.spatial import distance_matrix
-from sklearn.manifold import MDS
+from scipy import sparse
 from treelib.node import Node
 from treelib.tree import Tree
 from src.taxodist import cs_algorithms
 from src.taxodist import ic_algorithms
 from src.taxodist import setsim_algorithms
+from src.taxodist.td_taxonomy import CompiledTaxonomy, ConceptSets
+from src.taxodist.td_cache import CSCache
+from src.taxodist import td_shared
+from src.taxodist import td_embedding
+from src.taxodist import td_profiling
+from src.taxodist.td_matrix import CondensedMatrix, CHUNK_SIZE
 from numpy import ndarray
 
-# global hashtables
-ic_table = {}
-cs_table = {}
+# set sims that only depend on the intersection and the sizes of the sets, see getTrivialSetSimMatrix
+TRIVIAL_SETSIM_MODES = ('jaccard','dice','cosine','overlap')
+# set sims that are computed for all pairs at once, see getBatchSetSimMatrix
+BATCH_SETSIM_MODES = TRIVIAL_SETSIM_MODES + ('mean_cs','hierarchical','bipartite_matching')
+# CS measures where smaller values mean more similar concepts
+DIST_CS_MODES = ('nguyen_almubaid','path_based')
+
+# inputs of the tile-computing worker processes, see initDistWorker
+worker_state = {}
+# (structure key, compiled version) of the treelib trees passed to getIC, see getCompiledTaxonomy
+compiled_trees = weakref.WeakKeyDictionary()
 
 def iterateOverDiags(parent: ET.Element, parent_node: Node, tree: Tree):
     for diag in parent.iter('diag'):
@@ -36,27 +53,38 @@ def getIC(concept: str, tree: Tree, ic_mode: str):
     based on the IC algorthms from https://doi.org/10.1186/s12911-019-0807-y
     
     """
-    global ic_table 
-    
-    if ic_table.get(concept):
-        return ic_table[concept]
-    
+    taxonomy = getCompiledTaxonomy(tree)
+    return getICVector(taxonomy, ic_mode)[taxonomy.ids[concept]].item()
+
+def getICVector(taxonomy: CompiledTaxonomy, ic_mode: str) -> ndarray:
+    """
+    Returns the information content of every node of a compiled taxonomy, indexed by node id. \n
+    The vector is computed in one pass on first use and kept in the taxonomy's metadata.
+    """
+    key = ('ic', ic_mode)
+    if key in taxonomy.metadata:
+        return taxonomy.metadata[key]
     try:
-        if ic_mode == 'levels':
-            # IC calculation based on Boriah et al. https://doi.org/10.1137/1.9781611972788.22 
-            ic = tree.depth(concept)
-        elif ic_mode == 'sanchez':
-            ic = ic_algorithms.getICSanchez(concept,tree)
-        else:
-            raise ValueError('Unsupported IC-mode: ',ic_mode)
-        ic_table[concept] = ic
-        return ic
+        with td_profiling.active.phase('ic'):
+            if ic_mode == 'levels':
+                # IC calculation based on Boriah et al. https://doi.org/10.1137/1.9781611972788.22 
+                ic = ic_algorithms.getICVectorLevels(taxonomy)
+            elif ic_mode == 'sanchez':
+                ic = ic_algorithms.getICVectorSanchez(taxonomy)
+            else:
+                raise ValueError('Unsupported IC-mode: ',ic_mode)
     except ValueError as err:
         print(err.args)
         sys.exit()
+    ic.flags.writeable = False
+    taxonomy.metadata[key] = ic
+    return ic
 
 def getLCA(concept1: str, concept2: str, tree: Tree, ic_mode: str) -> str:
     """Return lowest common ancester of two concepts."""
+    if isinstance(tree, CompiledTaxonomy):
+        # IC grows monotonically along every path, so the deepest shared ancestor has the highest IC
+        return tree.codes[tree.get_proper_lca_ids(tree.ids[concept1], tree.ids[concept2])]
     lca = 0
     ca = list(getAncestors(concept1, tree).intersection(getAncestors(concept2, tree)))
     if len(ca) != 0:
@@ -71,6 +99,8 @@ def getAncestors(concept: str, tree: Tree):
     """Return the ancestors of a concept in a given tree"""
     if concept == tree.root:
         return set()
+    if isinstance(tree, CompiledTaxonomy):
+        return {tree.codes[i] for i in tree.get_ancestor_ids(tree.ids[concept])}
     ancestors = []
     parent: Node = tree.parent(concept)
     while tree.depth(parent.identifier) >= 0:
@@ -86,27 +116,34 @@ def getShortestPath(concept1: str, concept2: str, depth_lca: int, tree: Tree):
     depth_concept2 = tree.level(concept2)
     return depth_concept1 + depth_concept2 - 2*depth_lca
 
-def getCS(concept1: str, concept2: str, tree: Tree, depth: int,ic_mode: str,cs_mode: str):
-    """Returns concept similarity of two concepts based on CS-algorithms from https://doi.org/10.1186/s12911-019-0807-y"""
-    
-    global cs_table
-    
-    if cs_table.get((concept1,concept2)):
-        return cs_table[(concept1,concept2)]
-    if cs_table.get((concept2,concept1)):
-        return cs_table[(concept2,concept1)]
-    
+def getCS(concept1: str, concept2: str, tree: Tree, depth: int,ic_mode: str,cs_mode: str, cache: CSCache=None):
+    """
+    Returns concept similarity of two concepts based on CS-algorithms from https://doi.org/10.1186/s12911-019-0807-y \n
+    Values are memorized in the given cache, if any.
+    """
+    instrumentation = td_profiling.active
+    instrumentation.count('getCS')
+    # compiled once, the helpers below get the compiled taxonomy as tree
+    taxonomy = getCompiledTaxonomy(tree)
+    if cache is None:
+        return getUncachedCS(concept1, concept2, taxonomy, depth, ic_mode, cs_mode)
+    key = CSCache.getKey((taxonomy.get_fingerprint(), ic_mode, cs_mode), taxonomy.ids[concept1], taxonomy.ids[concept2])
+    cs = cache.get(key)
+    if cs is not None:
+        instrumentation.count('cs_cache_hits')
+        return cs
+    instrumentation.count('cs_cache_misses')
+    cs = getUncachedCS(concept1, concept2, taxonomy, depth, ic_mode, cs_mode)
+    cache.put(key, cs)
+    return cs
+
+def getUncachedCS(concept1: str, concept2: str, tree: Tree, depth: int, ic_mode: str, cs_mode: str):
+    """Computes the concept similarity of two concepts, see getCS."""
     if concept1 == concept2:
         if cs_mode == 'wu_palmer' or cs_mode == 'simple_wu_palmer':
-            cs = 1.0
-            cs_table[(concept1,concept2)] = cs
-            cs_table[(concept2,concept1)] = cs
-            return cs
+            return 1.0
         elif cs_mode == 'path_based':
-            cs = 0.0
-            cs_table[(concept1,concept2)] = cs
-            cs_table[(concept2,concept1)] = cs
-            return cs
+            return 0.0
     
     lca = getLCA(concept1, concept2, tree, ic_mode)
     ic_lca = getIC(lca, tree,ic_mode)
@@ -132,8 +169,6 @@ def getCS(concept1: str, concept2: str, tree: Tree, depth: int,ic_mode: str,cs_m
         else:
          raise ValueError('Unsupported CS-mode: ',cs_mode)
 
-        cs_table[(concept1,concept2)] = cs
-        cs_table[(concept2,concept1)] = cs
         return cs
     except ValueError as err:
         print(err.args)
@@ -154,7 +189,110 @@ def getCS(concept1: str, concept2: str, tree: Tree, depth: int,ic_mode: str,cs_m
     #     case 'simple_wu_palmer':
     #         return (depth - ic_lca)/(depth - 1)
 
-def getSetSim(concepts_1: set, concepts_2: set, setsim_mode: str, tree: Tree, cs_mode: str, ic_mode: str) -> float:
+def getCompiledTaxonomy(tree: Tree) -> CompiledTaxonomy:
+    """
+    Returns the compiled, array-backed version of a taxonomy tree. \n
+    Compiled trees are memorized until the tree is garbage collected or its structure changes (see getTreeStructureKey),
+    e.g. by tree.move_node. Other changes, e.g. of node data, need invalidateCompiledTaxonomy.
+    """
+    if isinstance(tree, CompiledTaxonomy):
+        return tree
+    key = getTreeStructureKey(tree)
+    memorized = compiled_trees.get(tree)
+    if memorized is None or memorized[0] != key:
+        with td_profiling.active.phase('tree_parse'):
+            compiled = CompiledTaxonomy(tree)
+        compiled_trees[tree] = (key, compiled)
+        return compiled
+    return memorized[1]
+
+def getTreeStructureKey(tree: Tree) -> tuple:
+    """Returns the size and a hash of the identifiers and parents of all nodes of a treelib tree, in one pass over its nodes."""
+    nodes = tree.nodes
+    return len(nodes), hash((tuple(nodes), tuple([node.predecessor(tree.identifier) for node in nodes.values()])))
+
+def invalidateCompiledTaxonomy(tree: Tree):
+    """Drops the compiled version of a treelib tree, so the next call of getCompiledTaxonomy compiles it again."""
+    compiled_trees.pop(tree, None)
+
+def getICs(concept_ids: ndarray, taxonomy: CompiledTaxonomy, ic_mode: str) -> ndarray:
+    """Returns the information content of every concept id in the given array."""
+    return getICVector(taxonomy, ic_mode)[concept_ids]
+
+def getCSBlock(concept_ids_1: ndarray, concept_ids_2: ndarray, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, cache: CSCache = None) -> ndarray:
+    """
+    Returns the len(concept_ids_1) x len(concept_ids_2) CS matrix of two arrays of concept ids
+    using the batch kernels from cs_algorithms. Yields the same values as getCS for every pair. \n
+    If a cache is given, the block is memorized in it and cached blocks are returned read-only.
+    The requested, computed and cached CS values are counted as cs_lookups, cs_values and cs_cache_hits/cs_cache_misses.
+    """
+    instrumentation = td_profiling.active
+    n_values = len(concept_ids_1)*len(concept_ids_2)
+    instrumentation.count('cs_lookups', n_values)
+    if cache is None:
+        return getUncachedCSBlock(concept_ids_1, concept_ids_2, taxonomy, ic_mode, cs_mode)
+    key = CSCache.getBlockKey((taxonomy.get_fingerprint(), ic_mode, cs_mode), concept_ids_1, concept_ids_2)
+    cs = cache.get(key)
+    if cs is not None:
+        instrumentation.count('cs_cache_hits', n_values)
+        return cs
+    instrumentation.count('cs_cache_misses', n_values)
+    cs = getUncachedCSBlock(concept_ids_1, concept_ids_2, taxonomy, ic_mode, cs_mode)
+    cache.put(key, cs)
+    return cs
+
+def getUncachedCSBlock(concept_ids_1: ndarray, concept_ids_2: ndarray, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str) -> ndarray:
+    """Computes the CS matrix of two arrays of concept ids, see getCSBlock."""
+    ids_1, ids_2 = np.broadcast_arrays(np.asarray(concept_ids_1)[:, None], np.asarray(concept_ids_2)[None, :])
+    identical = ids_1 == ids_2
+    depth = taxonomy.depth()
+    instrumentation = td_profiling.active
+    instrumentation.count('cs_values', identical.size)
+
+    try:
+        with instrumentation.phase('cs'), np.errstate(divide='ignore', invalid='ignore'):
+            if cs_mode == 'path_based':
+                cs = cs_algorithms.getPathBasedDistBatch(taxonomy.depths[ids_1], taxonomy.depths[ids_2], depth)
+            elif cs_mode == 'nguyen_almubaid':
+                with instrumentation.phase('lca'):
+                    lcas = taxonomy.get_proper_lca_ids(ids_1, ids_2)
+                cs = cs_algorithms.getCSNguyenAlMubaidBatch(taxonomy.depths[ids_1], taxonomy.depths[ids_2], taxonomy.depths[lcas], depth)
+            elif cs_mode == 'batet':
+                if identical.any():
+                    raise ValueError('Batet measure does not support identical concept comparisons.')
+                with instrumentation.phase('lca'):
+                    lcas = taxonomy.get_lca_ids(ids_1, ids_2)
+                cs = cs_algorithms.getCSBatetBatch(taxonomy.depths[ids_1], taxonomy.depths[ids_2], taxonomy.depths[lcas])
+            elif cs_mode in ('wu_palmer','li','simple_wu_palmer','leacock_chodorow'):
+                with instrumentation.phase('lca'):
+                    lcas = taxonomy.get_proper_lca_ids(ids_1, ids_2)
+                ic_lca = getICs(lcas, taxonomy, ic_mode)
+                if cs_mode == 'simple_wu_palmer':
+                    cs = cs_algorithms.getCSSimpleWuPalmerBatch(ic_lca, depth)
+                else:
+                    ic_1 = getICs(ids_1, taxonomy, ic_mode)
+                    ic_2 = getICs(ids_2, taxonomy, ic_mode)
+                    if cs_mode == 'wu_palmer':
+                        cs = cs_algorithms.getCSWuPalmerBatch(ic_1, ic_2, ic_lca)
+                    elif cs_mode == 'li':
+                        cs = cs_algorithms.getCSLiBatch(ic_1, ic_2, ic_lca)
+                    else:
+                        max_ic = depth if ic_mode == 'levels' else getMaxIC(taxonomy, ic_mode)
+                        cs = cs_algorithms.getCSLeacockChodorowBatch(ic_1, ic_2, ic_lca, max_ic)
+            else:
+                raise ValueError('Unsupported CS-mode: ',cs_mode)
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+
+    cs = np.array(cs, dtype=np.float64)
+    if cs_mode == 'wu_palmer' or cs_mode == 'simple_wu_palmer':
+        cs[identical] = 1.0
+    elif cs_mode == 'path_based':
+        cs[identical] = 0.0
+    return cs
+
+def getSetSim(concepts_1: set, concepts_2: set, setsim_mode: str, tree: Tree, cs_mode: str, ic_mode: str, cache: CSCache=None) -> float:
     try:
         if len(concepts_1) != 0 and len(concepts_2) != 0:
             
@@ -167,11 +305,11 @@ def getSetSim(concepts_1: set, concepts_2: set, setsim_mode: str, tree: Tree, cs
             elif setsim_mode == 'overlap':
                 return setsim_algorithms.getOverlapSetSim(concepts_1, concepts_2)
             elif setsim_mode == 'mean_cs':
-                return setsim_algorithms.getMeanCSSetSim(concepts_1, concepts_2, tree, cs_mode, ic_mode)
+                return setsim_algorithms.getMeanCSSetSim(concepts_1, concepts_2, tree, cs_mode, ic_mode, cache)
             elif setsim_mode == 'hierarchical':
-                return setsim_algorithms.getHierachicalDistSetSim(concepts_1, concepts_2, tree, cs_mode, ic_mode)
+                return setsim_algorithms.getHierachicalDistSetSim(concepts_1, concepts_2, tree, cs_mode, ic_mode, cache)
             elif setsim_mode == 'bipartite_matching':
-                return setsim_algorithms.getWeightedBipartiteMatchingSim(concepts_1,concepts_2,tree,ic_mode,cs_mode)
+                return setsim_algorithms.getWeightedBipartiteMatchingSim(concepts_1,concepts_2,tree,ic_mode,cs_mode,cache)
             else:
                 raise ValueError("Unsupported setsim algorithm: ", setsim_mode)
         else:
@@ -180,68 +318,796 @@ def getSetSim(concepts_1: set, concepts_2: set, setsim_mode: str, tree: Tree, cs
         print(err.args)
         sys.exit()
 
+def getSetSimIds(concept_ids_1: ndarray, concept_ids_2: ndarray, setsim_mode: str, taxonomy: CompiledTaxonomy, cs_mode: str, ic_mode: str) -> float:
+    """
+    Returns the same set sim as getSetSim for two sorted arrays of unique node ids (see td_taxonomy.ConceptSets).
+    CS values are computed as one block with getCSBlock.
+    """
+    try:
+        if len(concept_ids_1) == 0 or len(concept_ids_2) == 0:
+            raise ValueError('Empty Concept Set(s)')
+        if setsim_mode in ('jaccard','dice','cosine','overlap'):
+            intersection = len(np.intersect1d(concept_ids_1, concept_ids_2, assume_unique=True))
+            len_1, len_2 = len(concept_ids_1), len(concept_ids_2)
+            if setsim_mode == 'jaccard':
+                return intersection/(len_1 + len_2 - intersection)
+            elif setsim_mode == 'dice':
+                return (2*intersection)/(len_1 + len_2)
+            elif setsim_mode == 'cosine':
+                return intersection/math.sqrt(len_1*len_2)
+            return intersection/min(len_1, len_2)
+        elif setsim_mode not in ('mean_cs','hierarchical','bipartite_matching'):
+            raise ValueError("Unsupported setsim algorithm: ", setsim_mode)
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+
+    if setsim_mode == 'hierarchical':
+        only_in_1 = ~np.isin(concept_ids_1, concept_ids_2, assume_unique=True)
+        only_in_2 = ~np.isin(concept_ids_2, concept_ids_1, assume_unique=True)
+        if not only_in_1.any() and not only_in_2.any():
+            return 0.0
+        cs_matrix = getCSBlock(concept_ids_1, concept_ids_2, taxonomy, ic_mode, cs_mode)
+        return setsim_algorithms.getHierachicalDistSetSimFromCS(cs_matrix, only_in_1, only_in_2)
+
+    cs_matrix = getCSBlock(concept_ids_1, concept_ids_2, taxonomy, ic_mode, cs_mode)
+    if setsim_mode == 'mean_cs':
+        return setsim_algorithms.getMeanCSSetSimFromCS(cs_matrix)
+    return setsim_algorithms.getWeightedBipartiteMatchingSimFromCS(cs_matrix, cs_mode)
+
+def getLocalConceptSets(sets) -> ConceptSets:
+    """
+    Encodes concept sets as ConceptSets with ids local to the given sets, for set sims that do not need a taxonomy.
+    ConceptSets are returned as they are.
+    """
+    if isinstance(sets, ConceptSets):
+        return sets
+    vocabulary = {}
+    return ConceptSets.fromIds([[vocabulary.setdefault(concept, len(vocabulary)) for concept in concepts] for concepts in sets])
+
+def getIncidenceMatrix(sets: ConceptSets, n_concepts: int = None) -> sparse.csr_matrix:
+    """Returns the sparse set x concept incidence matrix of the given sets, n_concepts defaults to the highest id + 1."""
+    if n_concepts is None:
+        n_concepts = int(sets.ids.max()) + 1 if len(sets.ids) else 0
+    return sparse.csr_matrix((np.ones(len(sets.ids), dtype=np.int32), sets.ids, sets.offsets), shape=(len(sets), n_concepts))
+
+def getTrivialSetSimMatrix(sets, setsim_mode: str, storage: str = 'dense', dtype=np.float64, path: str = None, block_size: int = None):
+    """
+    Computes the upper triangle of the set sim matrix for jaccard, dice, cosine and overlap. \n
+    The intersections of all pairs come from the product of the sparse incidence matrix with its transpose,
+    computed in blocks of block_size rows to bound the memory. The result is stored as in getDistMatrix.
+    """
+    return writeRowBlocks(iterTrivialSetSimBlocks(sets, setsim_mode, block_size), len(sets), storage, dtype, path)
+
+def iterTrivialSetSimBlocks(sets, setsim_mode: str, block_size: int = None):
+    """Yields the row blocks of getTrivialSetSimMatrix, see iterSetSimBlocks."""
+    sets = getLocalConceptSets(sets)
+    sizes = sets.sizes()
+    try:
+        if setsim_mode == 'jaccard':
+            kernel = setsim_algorithms.getJaccardSetSimBatch
+        elif setsim_mode == 'dice':
+            kernel = setsim_algorithms.getDiceSetSimBatch
+        elif setsim_mode == 'cosine':
+            kernel = setsim_algorithms.getCosineSetSimBatch
+        elif setsim_mode == 'overlap':
+            kernel = setsim_algorithms.getOverlapSetSimBatch
+        else:
+            raise ValueError("Unsupported setsim algorithm: ", setsim_mode)
+        if (sizes == 0).any():
+            raise ValueError('Empty Concept Set(s)')
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+
+    length = len(sets)
+    if block_size is None:
+        # about 64 MB of intersection counts per block
+        block_size = max(1, (1 << 23)//max(length, 1))
+
+    incidence = getIncidenceMatrix(sets)
+    sizes = sizes.astype(np.float64)
+    for row_start in range(0, length, block_size):
+        row_stop = min(row_start + block_size, length)
+        intersections = (incidence[row_start:row_stop] @ incidence[row_start:].T).toarray()
+        block = kernel(intersections, sizes[row_start:row_stop, None], sizes[None, row_start:])
+        yield row_start, np.triu(block)
+
+def getCohortCS(sets: ConceptSets, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, cache: CSCache = None):
+    """
+    Returns the incidence matrix of the sets over their union vocabulary (the concepts that occur in any set)
+    and the CS matrix of that vocabulary, so every concept pair is computed once for the whole cohort.
+    With a cache, the CS matrix is reused by later calls on the same vocabulary (see getCSBlock).
+    """
+    vocabulary, local_ids = np.unique(sets.ids, return_inverse=True)
+    incidence = getIncidenceMatrix(ConceptSets(sets.offsets, local_ids), len(vocabulary))
+    return incidence, getCSBlock(vocabulary, vocabulary, taxonomy, ic_mode, cs_mode, cache)
+
+def getIncidenceCSSums(incidence: sparse.csr_matrix, cs_matrix: ndarray, block_size: int) -> sparse.csr_matrix:
+    """
+    Returns the sparse matrix A∘(A·C): for every concept a of set i, the sum of the CS values of a
+    with all concepts of set i.
+    """
+    values = np.empty(incidence.nnz)
+    for row_start in range(0, incidence.shape[0], block_size):
+        block = incidence[row_start:row_start + block_size]
+        block_cs = block @ cs_matrix
+        rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+        values[incidence.indptr[row_start]:incidence.indptr[row_start] + block.nnz] = block_cs[rows, block.indices]
+    return sparse.csr_matrix((values, incidence.indices, incidence.indptr), shape=incidence.shape)
+
+def getCSSetSimMatrix(sets, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, setsim_mode: str, storage: str = 'dense', dtype=np.float64, path: str = None, block_size: int = None, cache: CSCache = None):
+    """
+    Computes the upper triangle of the mean_cs or hierarchical set sim matrix. \n
+    The CS sums of all set pairs are the entries of A·C·Aᵀ, with the sparse incidence matrix A and the CS matrix C
+    of the cohort's vocabulary (see getCohortCS). For hierarchical, the sums over concepts shared by both sets are
+    subtracted: A·Pᵀ and P·Aᵀ with P = A∘(A·C). Computed in blocks of block_size rows and stored as in getDistMatrix.
+    """
+    return writeRowBlocks(iterCSSetSimBlocks(sets, taxonomy, ic_mode, cs_mode, setsim_mode, block_size, cache), len(sets), storage, dtype, path)
+
+def iterCSSetSimBlocks(sets, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, setsim_mode: str, block_size: int = None, cache: CSCache = None):
+    """Yields the row blocks of getCSSetSimMatrix, see iterSetSimBlocks."""
+    sets = taxonomy.get_concept_sets(sets)
+    sizes = sets.sizes()
+    try:
+        if setsim_mode not in ('mean_cs','hierarchical'):
+            raise ValueError("Unsupported setsim algorithm: ", setsim_mode)
+        if (sizes == 0).any():
+            raise ValueError('Empty Concept Set(s)')
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+
+    incidence, cs_matrix = getCohortCS(sets, taxonomy, ic_mode, cs_mode, cache)
+    length = len(sets)
+    if block_size is None:
+        # about 64 MB of intermediate values per block
+        block_size = max(1, (1 << 23)//max(length, cs_matrix.shape[0], 1))
+    if setsim_mode == 'hierarchical':
+        shared_sums = getIncidenceCSSums(incidence, cs_matrix, block_size)
+
+    sizes = sizes.astype(np.float64)
+    for row_start in range(0, length, block_size):
+        row_stop = min(row_start + block_size, length)
+        rows = incidence[row_start:row_stop]
+        # (A_block·C)·Aᵀ, computed as A·(A_block·C)ᵀ to keep the sparse matrix on the left
+        cs_sums = (incidence[row_start:] @ (rows @ cs_matrix).T).T
+        sizes_1 = sizes[row_start:row_stop, None]
+        sizes_2 = sizes[None, row_start:]
+        if setsim_mode == 'mean_cs':
+            block = setsim_algorithms.getMeanCSSetSimBatch(cs_sums, sizes_1, sizes_2)
+        else:
+            # CS values are symmetric, so both summands are corrected with the same P
+            first_summands = cs_sums - (rows @ shared_sums[row_start:].T).toarray()
+            second_summands = cs_sums - (shared_sums[row_start:row_stop] @ incidence[row_start:].T).toarray()
+            intersections = (rows @ incidence[row_start:].T).toarray()
+            block = setsim_algorithms.getHierachicalDistSetSimBatch(first_summands, second_summands, intersections, sizes_1, sizes_2)
+        yield row_start, np.triu(block)
+
+def getBipartiteMatchingSetSimMatrix(sets, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, storage: str = 'dense', dtype=np.float64, path: str = None, block_size: int = None, cache: CSCache = None):
+    """
+    Computes the upper triangle of the bipartite_matching set sim matrix. \n
+    The cost matrices of all pairs are sliced from the CS matrix of the cohort's vocabulary (see getCohortCS)
+    and solved in batches of block_size rows with setsim_algorithms.getWeightedBipartiteMatchingSimBatch.
+    Pairs of duplicate sets are solved once. Stored as in getDistMatrix.
+    """
+    return writeRowBlocks(iterBipartiteMatchingSetSimBlocks(sets, taxonomy, ic_mode, cs_mode, block_size, cache), len(sets), storage, dtype, path)
+
+def iterBipartiteMatchingSetSimBlocks(sets, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, block_size: int = None, cache: CSCache = None):
+    """Yields the row blocks of getBipartiteMatchingSetSimMatrix, see iterSetSimBlocks."""
+    sets = taxonomy.get_concept_sets(sets)
+    try:
+        if (sets.sizes() == 0).any():
+            raise ValueError('Empty Concept Set(s)')
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+
+    incidence, cs_matrix = getCohortCS(sets, taxonomy, ic_mode, cs_mode, cache)
+    local_sets = ConceptSets(incidence.indptr, incidence.indices)
+    # index of the first equal set of every set
+    first_sets = {}
+    set_index = np.array([first_sets.setdefault(local_sets[i].tobytes(), i) for i in range(len(local_sets))], dtype=np.int64)
+
+    length = len(sets)
+    if block_size is None:
+        # about a million pairs per block
+        block_size = max(1, (1 << 20)//max(length, 1))
+
+    for row_start in range(0, length, block_size):
+        row_stop = min(row_start + block_size, length)
+        rows, cols = np.nonzero(np.triu(np.ones((row_stop - row_start, length - row_start), dtype=bool)))
+        sets_1 = set_index[rows + row_start]
+        sets_2 = set_index[cols + row_start]
+        pair_keys, pair_index = np.unique(np.minimum(sets_1, sets_2)*length + np.maximum(sets_1, sets_2), return_inverse=True)
+        sims = setsim_algorithms.getWeightedBipartiteMatchingSimBatch(local_sets, pair_keys//length, pair_keys % length, cs_matrix, cs_mode)
+        block = np.zeros(shape=(row_stop - row_start, length - row_start))
+        block[rows, cols] = sims[pair_index]
+        yield row_start, block
+
+def getBipartiteMatchingNeighbours(sets, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, threshold: float = None, top_k: int = None, stats: dict = None, cache: CSCache = None) -> list:
+    """
+    Returns, for every set, the other sets whose bipartite matching sim reaches threshold (at least for similarity,
+    at most for distance measures) and/or the top_k best of them, as lists of (set index, sim) with the best first. \n
+    Pairs whose bounds (see setsim_algorithms.getWeightedBipartiteMatchingBoundsBatch) show that they cannot reach the
+    threshold or the current k-th best sim are skipped without solving the assignment. If stats is given, it is filled
+    with the number of candidate, pruned and solved pairs.
+    """
+    sets = taxonomy.get_concept_sets(sets)
+    try:
+        if threshold is None and top_k is None:
+            raise ValueError('Neither threshold nor top_k given')
+        if (sets.sizes() == 0).any():
+            raise ValueError('Empty Concept Set(s)')
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+
+    incidence, cs_matrix = getCohortCS(sets, taxonomy, ic_mode, cs_mode, cache)
+    local_sets = ConceptSets(incidence.indptr, incidence.indices)
+    # scores are sims for similarity and negated distances for distance measures, higher is always better
+    sign = -1.0 if cs_mode == 'nguyen_almubaid' or cs_mode == 'path_based' else 1.0
+    min_score = -np.inf if threshold is None else sign*threshold
+    counters = {'pairs': 0, 'pruned': 0, 'solved': 0}
+
+    neighbours = []
+    for i in range(len(sets)):
+        candidates = np.delete(np.arange(len(sets)), i)
+        lower, upper = setsim_algorithms.getWeightedBipartiteMatchingBoundsBatch(local_sets, np.full(len(candidates), i), candidates, cs_matrix, cs_mode)
+        best, worst = (upper, lower) if sign > 0 else (-lower, -upper)
+        # bounds and exact sims are summed in different orders
+        slack = 1e-9*(np.abs(best) + 1)
+        best, worst = best + slack, worst - slack
+        bar = min_score
+        if top_k is not None and len(candidates) >= top_k:
+            # the k best pairs score at least as much as the k-th best guaranteed score
+            bar = max(bar, np.partition(worst, len(worst) - top_k)[len(worst) - top_k])
+        order = np.argsort(-best, kind='stable')
+        order = order[best[order] >= bar]
+
+        scores = np.empty(0)
+        indices = np.empty(0, dtype=np.int64)
+        position = 0
+        # solve the most promising pairs first, in chunks, until no bound reaches the bar
+        while position < len(order) and best[order[position]] >= bar:
+            chunk = order[position:position + 256]
+            chunk = chunk[best[chunk] >= bar]
+            position += 256
+            sims = setsim_algorithms.getWeightedBipartiteMatchingSimBatch(local_sets, np.full(len(chunk), i), candidates[chunk], cs_matrix, cs_mode)
+            counters['solved'] += len(chunk)
+            keep = sign*sims >= min_score
+            scores = np.concatenate((scores, sign*sims[keep]))
+            indices = np.concatenate((indices, candidates[chunk][keep]))
+            if top_k is not None and len(scores) >= top_k:
+                best_k = np.argsort(-scores, kind='stable')[:top_k]
+                scores, indices = scores[best_k], indices[best_k]
+                bar = max(bar, scores[-1])
+        counters['pairs'] += len(candidates)
+
+        ranking = np.argsort(-scores, kind='stable')
+        neighbours.append([(int(indices[r]), float(sign*scores[r])) for r in ranking])
+    counters['pruned'] = counters['pairs'] - counters['solved']
+    if stats is not None:
+        stats.update(counters)
+    return neighbours
+
+def getSetSimBlock(sets_1: ConceptSets, sets_2: ConceptSets, setsim_mode: str, cs_mode: str, cs_matrix: ndarray = None, n_concepts: int = None) -> ndarray:
+    """
+    Returns the len(sets_1) x len(sets_2) set sim matrix of two groups of sets. \n
+    The sets hold local concept ids that index cs_matrix, the CS matrix of their vocabulary (see getCohortCS),
+    which is not needed for trivial set sims; n_concepts is the size of the vocabulary.
+    """
+    if n_concepts is None:
+        n_concepts = cs_matrix.shape[0]
+    sizes_1 = sets_1.sizes().astype(np.float64)[:, None]
+    sizes_2 = sets_2.sizes().astype(np.float64)[None, :]
+    try:
+        if (sizes_1 == 0).any() or (sizes_2 == 0).any():
+            raise ValueError('Empty Concept Set(s)')
+        if setsim_mode not in BATCH_SETSIM_MODES:
+            raise ValueError("Unsupported setsim algorithm: ", setsim_mode)
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+
+    if setsim_mode == 'bipartite_matching':
+        sets = ConceptSets(np.concatenate((sets_1.offsets, sets_2.offsets[1:] + sets_1.offsets[-1])), np.concatenate((sets_1.ids, sets_2.ids)))
+        rows, cols = np.meshgrid(np.arange(len(sets_1)), np.arange(len(sets_2)) + len(sets_1), indexing='ij')
+        sims = setsim_algorithms.getWeightedBipartiteMatchingSimBatch(sets, rows.ravel(), cols.ravel(), cs_matrix, cs_mode)
+        return sims.reshape(len(sets_1), len(sets_2))
+
+    incidence_1 = getIncidenceMatrix(sets_1, n_concepts)
+    incidence_2 = getIncidenceMatrix(sets_2, n_concepts)
+    if setsim_mode in TRIVIAL_SETSIM_MODES:
+        intersections = (incidence_1 @ incidence_2.T).toarray()
+        if setsim_mode == 'jaccard':
+            return setsim_algorithms.getJaccardSetSimBatch(intersections, sizes_1, sizes_2)
+        elif setsim_mode == 'dice':
+            return setsim_algorithms.getDiceSetSimBatch(intersections, sizes_1, sizes_2)
+        elif setsim_mode == 'cosine':
+            return setsim_algorithms.getCosineSetSimBatch(intersections, sizes_1, sizes_2)
+        return setsim_algorithms.getOverlapSetSimBatch(intersections, sizes_1, sizes_2)
+
+    cs_1 = incidence_1 @ cs_matrix
+    cs_sums = (incidence_2 @ cs_1.T).T
+    if setsim_mode == 'mean_cs':
+        return setsim_algorithms.getMeanCSSetSimBatch(cs_sums, sizes_1, sizes_2)
+    # see getCSSetSimMatrix
+    shared_sums_1 = incidence_1.multiply(cs_1).tocsr()
+    shared_sums_2 = incidence_2.multiply(incidence_2 @ cs_matrix).tocsr()
+    first_summands = cs_sums - (incidence_1 @ shared_sums_2.T).toarray()
+    second_summands = cs_sums - (shared_sums_1 @ incidence_2.T).toarray()
+    intersections = (incidence_1 @ incidence_2.T).toarray()
+    return setsim_algorithms.getHierachicalDistSetSimBatch(first_summands, second_summands, intersections, sizes_1, sizes_2)
+
+def getBatchSetSimMatrix(sets, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, setsim_mode: str, storage: str = 'dense', dtype=np.float64, path: str = None, cache: CSCache = None):
+    """Computes the upper triangle of the set sim matrix of a setsim mode in BATCH_SETSIM_MODES, see iterSetSimBlocks."""
+    return writeRowBlocks(iterSetSimBlocks(sets, taxonomy, ic_mode, cs_mode, setsim_mode, cache=cache), len(sets), storage, dtype, path)
+
+def isDistance(cs_mode: str, setsim_mode: str = None) -> bool:
+    """Returns whether smaller values mean more similar for a CS measure or, if given, a set sim based on it."""
+    if setsim_mode in TRIVIAL_SETSIM_MODES:
+        return False
+    if setsim_mode == 'hierarchical':
+        return True
+    return cs_mode in DIST_CS_MODES
+
+def getBlockingAncestors(concept_ids: ndarray, taxonomy: CompiledTaxonomy, level: int) -> ndarray:
+    """Returns the ancestor at the given level (e.g. the chapter of an ICD code) of every concept, concepts above that level are their own ancestor."""
+    nodes = np.array(concept_ids, dtype=np.int64)
+    below = taxonomy.depths[nodes] > level
+    while below.any():
+        nodes[below] = taxonomy.parents[nodes[below]]
+        below = taxonomy.depths[nodes] > level
+    return nodes
+
+def getThresholdedDistMatrix(concept_ids: ndarray, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, threshold: float, block_level: int = 1, dtype=np.float64) -> sparse.csr_matrix:
+    """
+    Returns the CS values of the concept pairs i < j that reach the threshold (at least threshold for similarities,
+    at most threshold for distances) as sparse upper triangular matrix. \n
+    Only concepts with the same ancestor at block_level are compared (see getBlockingAncestors), so memory and compute
+    scale with the pairs inside these blocks instead of all pairs; block_level=0 compares all pairs.
+    """
+    concept_ids = np.asarray(concept_ids)
+    length = len(concept_ids)
+    keys = getBlockingAncestors(concept_ids, taxonomy, block_level)
+    order = np.argsort(keys, kind='stable')
+    distance = isDistance(cs_mode)
+
+    rows, cols, values = [], [], []
+    for group in np.split(order, np.flatnonzero(np.diff(keys[order])) + 1):
+        block_size = max(1, CHUNK_SIZE//max(len(group), 1))
+        for start in range(0, len(group), block_size):
+            stop = min(start + block_size, len(group))
+            block = getCSBlock(concept_ids[group[start:stop]], concept_ids[group[start:]], taxonomy, ic_mode, cs_mode)
+            hits = (block <= threshold) if distance else (block >= threshold)
+            block_rows, block_cols = np.nonzero(np.triu(hits, 1))
+            rows.append(group[start + block_rows])
+            cols.append(group[start + block_cols])
+            values.append(block[block_rows, block_cols].astype(dtype))
+    return getUpperTriangularMatrix(rows, cols, values, length, dtype)
+
+def getThresholdedSetSimMatrix(sets, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, setsim_mode: str, threshold: float, block_level: int = 1, dtype=np.float64, stats: dict = None, cache: CSCache = None) -> sparse.csr_matrix:
+    """
+    Returns the set sims of the set pairs i < j that reach the threshold (see getThresholdedDistMatrix) as sparse upper
+    triangular matrix, for a setsim mode in BATCH_SETSIM_MODES. \n
+    Candidate pairs share at least one ancestor at block_level (see getBlockingAncestors) and are found from the sparse
+    set x ancestor incidence matrix, so pairs without a common block are never scored. bipartite_matching pairs whose bounds
+    cannot reach the threshold are not solved. If stats is given, it is filled with the number of all, candidate and kept pairs.
+    """
+    sets = taxonomy.get_concept_sets(sets)
+    try:
+        if setsim_mode not in BATCH_SETSIM_MODES:
+            raise ValueError("Unsupported setsim algorithm: ", setsim_mode)
+        if (sets.sizes() == 0).any():
+            raise ValueError('Empty Concept Set(s)')
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+
+    length = len(sets)
+    keys = getBlockingAncestors(sets.ids, taxonomy, block_level)
+    blocking = getIncidenceMatrix(ConceptSets(sets.offsets, keys), len(taxonomy))
+    if setsim_mode in TRIVIAL_SETSIM_MODES:
+        local_sets, cs_matrix = getLocalConceptSets(sets), None
+    else:
+        incidence, cs_matrix = getCohortCS(sets, taxonomy, ic_mode, cs_mode, cache)
+        local_sets = ConceptSets(incidence.indptr, incidence.indices)
+    concept_sums = getConceptCSSums(local_sets, cs_matrix) if setsim_mode == 'hierarchical' else None
+    n_concepts = int(local_sets.ids.max()) + 1
+    distance = isDistance(cs_mode, setsim_mode)
+
+    rows, cols, values = [], [], []
+    n_candidates = 0
+    # about a million candidate pairs and incidence rows at once
+    block_size = max(1, (1 << 20)//max(length, n_concepts))
+    for row_start in range(0, length, block_size):
+        row_stop = min(row_start + block_size, length)
+        candidates = sparse.triu(blocking[row_start:row_stop] @ blocking[row_start:].T, 1).tocoo()
+        pair_rows = candidates.row.astype(np.int64) + row_start
+        pair_cols = candidates.col.astype(np.int64) + row_start
+        n_candidates += len(pair_rows)
+        if setsim_mode == 'bipartite_matching':
+            lower, upper = setsim_algorithms.getWeightedBipartiteMatchingBoundsBatch(local_sets, pair_rows, pair_cols, cs_matrix, cs_mode)
+            # bounds and exact sims are summed in different orders
+            reachable = (lower <= threshold + 1e-9*(abs(threshold) + 1)) if distance else (upper >= threshold - 1e-9*(abs(threshold) + 1))
+            pair_rows, pair_cols = pair_rows[reachable], pair_cols[reachable]
+        td_profiling.active.count('set_sims', len(pair_rows))
+        sims = getSetSimPairs(pair_rows, pair_cols, setsim_mode, cs_mode, local_sets, cs_matrix, concept_sums)
+        hits = (sims <= threshold) if distance else (sims >= threshold)
+        rows.append(pair_rows[hits])
+        cols.append(pair_cols[hits])
+        values.append(sims[hits].astype(dtype))
+
+    matrix = getUpperTriangularMatrix(rows, cols, values, length, dtype)
+    if stats is not None:
+        stats.update({'pairs': length*(length - 1)//2, 'candidates': n_candidates, 'kept': matrix.nnz})
+    return matrix
+
+def getSetSimPairs(rows: ndarray, cols: ndarray, setsim_mode: str, cs_mode: str, local_sets: ConceptSets, cs_matrix: ndarray = None, concept_sums: ndarray = None) -> ndarray:
+    """
+    Returns the set sims of the set pairs (rows[k], cols[k]) of sets over the cohort's vocabulary and its CS matrix (see getCohortCS),
+    as the entries of the matrices computed in iterSetSimBlocks. concept_sums are the CS sums of getConceptCSSums (hierarchical only). \n
+    The incidence rows and CS sums A·C of the distinct row sets are computed once, then every pair only gathers the entries of the
+    concepts of its column set, so the cost grows with the sizes of the paired sets instead of the vocabulary.
+    """
+    sims = np.empty(len(rows))
+    if len(rows) == 0:
+        return sims
+    if setsim_mode == 'bipartite_matching':
+        sims[:] = setsim_algorithms.getWeightedBipartiteMatchingSimBatch(local_sets, rows, cols, cs_matrix, cs_mode)
+        return sims
+
+    sizes = local_sets.sizes()
+    n_concepts = cs_matrix.shape[0] if cs_matrix is not None else int(local_sets.ids.max()) + 1
+    unique_rows, row_index = np.unique(rows, return_inverse=True)
+    row_incidence = getIncidenceMatrix(local_sets.take(unique_rows), n_concepts)
+    row_cs = row_incidence @ cs_matrix if cs_matrix is not None else None
+    row_incidence = row_incidence.toarray()
+
+    chunk_start = 0
+    while chunk_start < len(rows):
+        # about CHUNK_SIZE concepts of the column sets at once
+        chunk_stop = chunk_start + max(1, int(np.searchsorted(np.cumsum(sizes[cols[chunk_start:]]), CHUNK_SIZE)))
+        chunk = slice(chunk_start, min(chunk_stop, len(rows)))
+        chunk_cols = cols[chunk]
+        lengths = sizes[chunk_cols]
+        pairs = np.repeat(np.arange(len(chunk_cols)), lengths)
+        positions = np.repeat(local_sets.offsets[chunk_cols] - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        concepts = local_sets.ids[positions]
+        entry_rows = row_index[chunk][pairs]
+        shared = row_incidence[entry_rows, concepts]
+        intersections = np.bincount(pairs, weights=shared, minlength=len(chunk_cols))
+        sizes_1, sizes_2 = sizes[rows[chunk]].astype(np.float64), lengths.astype(np.float64)
+
+        if setsim_mode == 'jaccard':
+            sims[chunk] = setsim_algorithms.getJaccardSetSimBatch(intersections, sizes_1, sizes_2)
+        elif setsim_mode == 'dice':
+            sims[chunk] = setsim_algorithms.getDiceSetSimBatch(intersections, sizes_1, sizes_2)
+        elif setsim_mode == 'cosine':
+            sims[chunk] = setsim_algorithms.getCosineSetSimBatch(intersections, sizes_1, sizes_2)
+        elif setsim_mode == 'overlap':
+            sims[chunk] = setsim_algorithms.getOverlapSetSimBatch(intersections, sizes_1, sizes_2)
+        else:
+            entry_cs = row_cs[entry_rows, concepts]
+            cs_sums = np.bincount(pairs, weights=entry_cs, minlength=len(chunk_cols))
+            if setsim_mode == 'mean_cs':
+                sims[chunk] = setsim_algorithms.getMeanCSSetSimBatch(cs_sums, sizes_1, sizes_2)
+            else:
+                # A·Pᵀ and P·Aᵀ of getCSSetSimMatrix, restricted to the shared concepts of each pair
+                first_summands = cs_sums - np.bincount(pairs, weights=shared*concept_sums[positions], minlength=len(chunk_cols))
+                second_summands = cs_sums - np.bincount(pairs, weights=shared*entry_cs, minlength=len(chunk_cols))
+                sims[chunk] = setsim_algorithms.getHierachicalDistSetSimBatch(first_summands, second_summands, intersections, sizes_1, sizes_2)
+        chunk_start = chunk.stop
+    return sims
+
+def getConceptCSSums(local_sets: ConceptSets, cs_matrix: ndarray) -> ndarray:
+    """Returns the sum of the CS values of every concept of every set with all concepts of its own set, aligned with local_sets.ids."""
+    sums = np.empty(len(local_sets.ids))
+    block_size = max(1, CHUNK_SIZE//max(cs_matrix.shape[0], 1))
+    for start in range(0, len(local_sets), block_size):
+        stop = min(start + block_size, len(local_sets))
+        block_sets = local_sets.take(np.arange(start, stop))
+        block_cs = getIncidenceMatrix(block_sets, cs_matrix.shape[0]) @ cs_matrix
+        sums[local_sets.offsets[start]:local_sets.offsets[stop]] = block_cs[np.repeat(np.arange(stop - start), block_sets.sizes()), block_sets.ids]
+    return sums
+
+def getUpperTriangularMatrix(rows: list, cols: list, values: list, length: int, dtype) -> sparse.csr_matrix:
+    """Returns the length x length CSR matrix of the concatenated (row, col, value) chunks."""
+    if not rows:
+        return sparse.csr_matrix((length, length), dtype=dtype)
+    return sparse.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(length, length), dtype=dtype).tocsr()
+
+def iterSetSimBlocks(sets, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, setsim_mode: str, block_size: int = None, cache: CSCache = None):
+    """
+    Yields the upper triangle of the set sim matrix of a setsim mode in BATCH_SETSIM_MODES as (row_start, block) tuples,
+    where block holds rows row_start:row_start + len(block) and columns row_start: (zero below the diagonal). \n
+    Only the current block and the CS matrix of the cohort's vocabulary are held in memory, so blocks can be
+    written to disk as they arrive (see td_writers) for cohorts whose matrix does not fit into memory.
+    The CS matrix is taken from and memorized in the cache, if any (see getCohortCS).
+    """
+    if setsim_mode in TRIVIAL_SETSIM_MODES:
+        return countSetSims(iterTrivialSetSimBlocks(sets, setsim_mode, block_size))
+    if setsim_mode == 'bipartite_matching':
+        return countSetSims(iterBipartiteMatchingSetSimBlocks(sets, taxonomy, ic_mode, cs_mode, block_size, cache))
+    return countSetSims(iterCSSetSimBlocks(sets, taxonomy, ic_mode, cs_mode, setsim_mode, block_size, cache))
+
+def countSetSims(blocks):
+    """Passes the row blocks of iterSetSimBlocks on and counts the set pairs of their upper triangles as set_sims."""
+    for row_start, block in blocks:
+        rows, cols = block.shape
+        td_profiling.active.count('set_sims', rows*cols - rows*(rows - 1)//2)
+        yield row_start, block
+
+def writeRowBlocks(blocks, length: int, storage: str, dtype, path: str = None):
+    """Writes the row blocks of iterSetSimBlocks into a new dense or condensed matrix (see createMatrix) and returns it."""
+    output = createMatrix(length, storage, dtype, path)
+    for row_start, block in blocks:
+        writeTile(output, (row_start, row_start + len(block), row_start, length), block)
+    if isinstance(output, CondensedMatrix):
+        output.flush()
+    return output
+
+def createMatrix(length: int, storage: str, dtype, path: str = None):
+    """Returns a zero-initialized dense or condensed (see td_matrix.CondensedMatrix) length x length matrix."""
+    if storage == 'condensed':
+        return CondensedMatrix.create(length, dtype, path)
+    return np.zeros(shape=(length, length), dtype=dtype)
+
 def getAllConcepts(tree: Tree):
+    if isinstance(tree, CompiledTaxonomy):
+        return tree.codes[1:]
     all_concepts = []
     for node in tree.all_nodes():
         all_concepts.append(node.identifier)
     all_concepts.remove(0)
     return all_concepts
 
-def getDistMatrix(concepts: list, tree: Tree, worker_index, max_workers,ic_mode,cs_mode):
+def getUpperTriangleTiles(length: int, tile_size: int) -> list:
     """
-    Function for the parallelized processes. \n 
-    Computes the part of the (absolute) distance matrix of the given concepts, 
-    that corresponds to the worker index of the calling process.
+    Splits the upper triangle of a length x length matrix into square tiles of tile_size x tile_size
+    (smaller at the edges). Returns (row_start, row_stop, col_start, col_stop) tuples, most expensive first,
+    so that dynamic scheduling ends with the cheap diagonal and edge tiles.
     """
-    depth = tree.depth()
-    length = len(concepts)
-    start = getStart(worker_index, max_workers, length)
-    stop = getStop(worker_index, max_workers, length)
-    dist_matrix = np.zeros(shape=(stop-start, length))
-    i = 0
-    for concept1 in concepts[start:stop]: 
-        concept1_index = concepts.index(concept1)
-        for concept2 in concepts[concept1_index:]:
-            cs = getCS(concept1, concept2, tree,depth,ic_mode,cs_mode)
-            # safe CS values in matrix (only upper triangular)
-            dist_matrix[i, concepts.index(concept2)] = cs
-        i+=1
-    return dist_matrix, worker_index
-
-def getStop(worker_index, max_workers, length):
-    """Returns logarithmically spaced stop index"""
-    if worker_index == max_workers:
-        return length
-    return getStart(worker_index + 1, max_workers, length)
-
-def getStart(worker_index, max_workers, length):
-    '''Returns logarithmically spaced start index'''
-    logspace = getSpacing(max_workers, length)
-    return math.ceil(logspace[worker_index-1])
-
-def getSpacing(max_workers, length):
-    """Returns spacing for the concept list."""
-    logspace =  length/10*np.logspace(start=-1,stop=1,num=max_workers, endpoint=True)
-    # remove offset
-    logspace = logspace - logspace[0] 
-    return logspace
-
-def getDistMatrixWrapper(p):
-    """Wrapper for the parallel-process-function"""
-    return getDistMatrix(*p)
-
-def getMDSMatrix(dist_matrix: ndarray) -> DataFrame:
-    """Computes multi-dimensionally-scaled two-dimensional concept-coordinates based on a pairwise-distance-matrix"""
-    # use MDS to compute the relative distances of the distinct concepts
-    embedding = MDS(n_components=2)
-    dist_matrix_transformed = embedding.fit_transform(dist_matrix)
-
-    df_dist_matrix = pd.DataFrame(dist_matrix_transformed)
-    return df_dist_matrix
+    tiles = []
+    for row_start in range(0, length, tile_size):
+        row_stop = min(row_start + tile_size, length)
+        for col_start in range(row_start, length, tile_size):
+            col_stop = min(col_start + tile_size, length)
+            tiles.append((row_start, row_stop, col_start, col_stop))
+    return sorted(tiles, key=getTileCost, reverse=True)
+
+def getTileCost(tile: tuple) -> float:
+    """Returns the number of matrix cells of a tile that lie in the upper triangle."""
+    row_start, row_stop, col_start, col_stop = tile
+    cells = (row_stop - row_start)*(col_stop - col_start)
+    if row_start == col_start:
+        # diagonal tiles are only half filled
+        return (cells + (row_stop - row_start))/2
+    return cells
+
+def getTileSize(length: int, max_workers: int) -> int:
+    """Returns a tile size that yields about 16 tiles per worker, clamped to [32, 1024]."""
+    tile_size = int(length/math.sqrt(32*max_workers)) if length else 1
+    return max(32, min(1024, tile_size))
+
+def getSharedInputs(taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str) -> dict:
+    """
+    Returns the arrays the workers need to compute CS values: the taxonomy arrays and,
+    for IC-based CS modes, the IC vector, so it is computed once and not in every worker.
+    """
+    arrays = taxonomy.get_arrays()
+    if cs_mode in ('wu_palmer','li','simple_wu_palmer','leacock_chodorow'):
+        arrays['ic'] = getICVector(taxonomy, ic_mode)
+    return arrays
+
+def initDistWorker(shared_spec: dict, codes: list, fingerprint: str, settings: dict):
+    """
+    Initializer of the processes that compute tiles. \n
+    Maps the taxonomy, the inputs and the output buffer from shared memory (see td_shared), so only
+    their names are sent to the worker and the tiles are written in place.
+    """
+    arrays, blocks = td_shared.attachSharedArrays(shared_spec)
+    setWorkerState(arrays, codes, fingerprint, settings)
+    # the mapped arrays are only valid as long as the handles are alive
+    worker_state['blocks'] = blocks
+    # a forked worker inherits the instrumentation of the calling process, its counters are sent back by getTimedTile
+    td_profiling.active = td_profiling.NULL_INSTRUMENTATION
+
+def setWorkerState(arrays: dict, codes: list, fingerprint: str, settings: dict):
+    """
+    Sets up the state used by getDistTile and getSetDistTile in the current process. \n
+    settings holds ic_mode, cs_mode, setsim_mode, storage and output_path (see runTiles), and n_concepts for getSetDistTile.
+    """
+    global worker_state
+    taxonomy = CompiledTaxonomy.fromArrays(arrays, codes, fingerprint)
+    if 'ic' in arrays:
+        ic = arrays['ic']
+        ic.flags.writeable = False
+        taxonomy.metadata[('ic', settings['ic_mode'])] = ic
+    if settings['output_path'] is not None:
+        output = CondensedMatrix.open(settings['output_path'], mode='r+')
+    elif settings['storage'] == 'condensed':
+        output = CondensedMatrix(arrays['output'])
+    else:
+        output = arrays['output']
+    worker_state = dict(settings, taxonomy=taxonomy, arrays=arrays, output=output)
+
+def clearWorkerState():
+    global worker_state
+    worker_state = {}
+
+def writeTile(output, tile: tuple, block: ndarray):
+    """Writes a computed tile into a dense or a CondensedMatrix output."""
+    row_start, row_stop, col_start, col_stop = tile
+    if isinstance(output, CondensedMatrix):
+        output.set_block(row_start, col_start, block)
+    else:
+        output[row_start:row_stop, col_start:col_stop] = block
+
+def getDistTile(tile: tuple) -> tuple:
+    """
+    Function for the parallelized processes. \n
+    Computes the CS values of one tile of the concept matrix (only the upper triangle of diagonal tiles)
+    and writes them into the output buffer.
+    """
+    row_start, row_stop, col_start, col_stop = tile
+    ids = worker_state['arrays']['concept_ids']
+    block = getCSBlock(ids[row_start:row_stop], ids[col_start:col_stop], worker_state['taxonomy'], worker_state['ic_mode'], worker_state['cs_mode'])
+    if row_start == col_start:
+        block = np.triu(block)
+    writeTile(worker_state['output'], tile, block)
+    return tile
+
+def getSetDistTile(tile: tuple) -> tuple:
+    """
+    Function for the parallelized processes. \n
+    Computes the set sims of one tile of the set matrix with getSetSimBlock (only the upper triangle of diagonal tiles)
+    and writes them into the output buffer.
+    """
+    row_start, row_stop, col_start, col_stop = tile
+    arrays = worker_state['arrays']
+    sets = ConceptSets(arrays['set_offsets'], arrays['set_ids'])
+    block = getSetSimBlock(sets.take(np.arange(row_start, row_stop)), sets.take(np.arange(col_start, col_stop)), worker_state['setsim_mode'],
+                           worker_state['cs_mode'], arrays.get('cs_matrix'), worker_state['n_concepts'])
+    if row_start == col_start:
+        block = np.triu(block)
+        td_profiling.active.count('set_sims', len(block)*(len(block) + 1)//2)
+    else:
+        td_profiling.active.count('set_sims', block.size)
+    writeTile(worker_state['output'], tile, block)
+    return tile
+
+def runTiles(tile_function, inputs: dict, length: int, taxonomy: CompiledTaxonomy, settings: dict, max_workers: int = None, tile_size: int = None):
+    """
+    Computes the upper triangle of a length x length matrix with tile_function. \n
+    The triangle is split into tiles (see getUpperTriangleTiles) that are handed out to max_workers
+    processes one at a time, so all workers stay busy until the last tile is done. The inputs and the
+    output matrix live in shared memory, so neither is pickled per task nor sent back. \n
+    settings['storage'] selects the output: 'dense' returns an ndarray, 'condensed' a CondensedMatrix
+    that is memory-mapped to settings['output_path'] if given. settings['dtype'] is the dtype of the values. \n
+    With active instrumentation (see td_profiling), every tile is timed for the busy and idle times of the workers,
+    and the counters of the tiles computed in worker processes are added to it.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if tile_size is None:
+        tile_size = getTileSize(length, max_workers)
+    tiles = getUpperTriangleTiles(length, tile_size)
+    fingerprint = taxonomy.get_fingerprint()
+    storage = settings['storage']
+    try:
+        if storage not in ('dense', 'condensed'):
+            raise ValueError('Unsupported storage: ', storage)
+        if storage == 'dense' and settings['output_path'] is not None:
+            raise ValueError('Only condensed matrices can be memory-mapped')
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+
+    instrumentation = td_profiling.active
+    instrumentation.count('tiles', len(tiles))
+    tile_times = []
+    if max_workers == 1:
+        output = createMatrix(length, storage, settings['dtype'], settings['output_path'])
+        inputs['output'] = output.values if isinstance(output, CondensedMatrix) else output
+        setWorkerState(inputs, taxonomy.codes, fingerprint, settings)
+        output = worker_state['output']
+        start = time.time()
+        try:
+            for tile in tiles:
+                if instrumentation.enabled:
+                    tile_times.append(td_profiling.getTimedTile(tile_function, tile)[1:4])
+                else:
+                    tile_function(tile)
+        finally:
+            clearWorkerState()
+        instrumentation.add_worker_times(tile_times, time.time() - start)
+        if isinstance(output, CondensedMatrix):
+            output.flush()
+        return output
+
+    with td_shared.SharedArrays(inputs) as shared:
+        if settings['output_path'] is not None:
+            # the workers map the file themselves
+            CondensedMatrix.create(length, settings['dtype'], settings['output_path']).flush()
+        elif storage == 'condensed':
+            shared.add('output', (length*(length + 1)//2,), settings['dtype'])
+        else:
+            shared.add('output', (length, length), settings['dtype'])
+        initargs = (shared.spec, taxonomy.codes, fingerprint, settings)
+        start = time.time()
+        with cf.ProcessPoolExecutor(max_workers=max_workers, initializer=initDistWorker, initargs=initargs) as executor:
+            if instrumentation.enabled:
+                fs = [executor.submit(td_profiling.getTimedTile, tile_function, tile) for tile in tiles]
+            else:
+                fs = [executor.submit(tile_function, tile) for tile in tiles]
+            for future in cf.as_completed(fs):
+                # raises the exceptions of the workers
+                result = future.result()
+                if instrumentation.enabled:
+                    tile_times.append(result[1:4])
+                    instrumentation.add_counters(result[4])
+        instrumentation.add_worker_times(tile_times, time.time() - start)
+        if settings['output_path'] is not None:
+            return CondensedMatrix.open(settings['output_path'], mode='r+')
+        # the shared blocks are removed on exit
+        output = np.array(shared.arrays['output'])
+        return CondensedMatrix(output) if storage == 'condensed' else output
+
+def getDistMatrix(concept_ids: ndarray, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, max_workers: int = None, tile_size: int = None, storage: str = 'dense', dtype=np.float64, path: str = None):
+    """
+    Computes the upper triangle of the (absolute) distance matrix of the given concept ids, see runTiles. \n
+    With storage='condensed' a CondensedMatrix is returned, memory-mapped to path if given.
+    """
+    inputs = getSharedInputs(taxonomy, ic_mode, cs_mode)
+    inputs['concept_ids'] = np.asarray(concept_ids, dtype=np.int32)
+    settings = {'ic_mode': ic_mode, 'cs_mode': cs_mode, 'setsim_mode': None, 'storage': storage, 'dtype': np.dtype(dtype).str, 'output_path': path}
+    return runTiles(getDistTile, inputs, len(concept_ids), taxonomy, settings, max_workers, tile_size)
+
+def getSetDistMatrix(sets, taxonomy: CompiledTaxonomy, ic_mode: str, cs_mode: str, setsim_mode: str, max_workers: int = None, tile_size: int = None, storage: str = 'dense', dtype=np.float64, path: str = None, cache: CSCache = None):
+    """
+    Computes the upper triangle of the (absolute) distance matrix of the given concept sets for a setsim mode in
+    BATCH_SETSIM_MODES, see runTiles. \n
+    sets is either a list of concept sets or ConceptSets of node ids. The sets, with ids local to the cohort's vocabulary, and
+    the CS matrix of that vocabulary (see getCohortCS) are computed once and shared with the workers, which compute
+    their tiles with getSetSimBlock. The CS matrix is taken from and memorized in the cache, if any.
+    """
+    inputs = taxonomy.get_arrays()
+    if setsim_mode in TRIVIAL_SETSIM_MODES:
+        local_sets = getLocalConceptSets(sets)
+        n_concepts = int(local_sets.ids.max()) + 1 if len(local_sets.ids) else 0
+    else:
+        incidence, inputs['cs_matrix'] = getCohortCS(taxonomy.get_concept_sets(sets), taxonomy, ic_mode, cs_mode, cache)
+        local_sets = ConceptSets(incidence.indptr, incidence.indices)
+        n_concepts = incidence.shape[1]
+    try:
+        # checked here, as the workers cannot exit the calling process
+        if setsim_mode not in BATCH_SETSIM_MODES:
+            raise ValueError("Unsupported setsim algorithm: ", setsim_mode)
+        if (local_sets.sizes() == 0).any():
+            raise ValueError('Empty Concept Set(s)')
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+    inputs['set_offsets'] = local_sets.offsets
+    inputs['set_ids'] = local_sets.ids
+    settings = {'ic_mode': ic_mode, 'cs_mode': cs_mode, 'setsim_mode': setsim_mode, 'n_concepts': n_concepts, 'storage': storage, 'dtype': np.dtype(dtype).str, 'output_path': path}
+    return runTiles(getSetDistTile, inputs, len(local_sets), taxonomy, settings, max_workers, tile_size)
+
+def getMDSMatrix(dist_matrix: ndarray, embedding_mode: str = 'classical', stats: dict = None) -> DataFrame:
+    """
+    Computes multi-dimensionally-scaled two-dimensional concept-coordinates based on a pairwise-distance-matrix (ndarray or CondensedMatrix). \n
+    embedding_mode is one of td_embedding.EMBEDDING_MODES, see td_embedding.getEmbedding.
+    """
+    return td_embedding.getEmbedding(dist_matrix, embedding_mode, n_components=2, stats=stats)
 
 def mirrorMatrix(dist_matrix:ndarray) -> ndarray:
     """mirrors uppertriangular distance matrix along its diagonal"""
-    return dist_matrix + dist_matrix.T - np.diag(np.diag(dist_matrix))
+    mirrored = dist_matrix + dist_matrix.T
+    # the diagonal was added twice
+    mirrored[np.diag_indices_from(mirrored)] = np.diag(dist_matrix)
+    return mirrored
 
 def plotDistMatrix(coordinates: DataFrame, datapoints: list):
     fig, ax = plt.subplots()
@@ -271,85 +1137,136 @@ def getConceptCount(tree: treelib.Tree) -> int:
     """Returns the number of concepts in a taxonomy."""
     return len(tree.leaves())    
 
-def setMaxIC(tree: Tree, ic_mode: str):
-    max_ic = 0
-    for node in tree.all_nodes():
-        concept = node.identifier
-        ic = getIC(concept,tree,ic_mode)
-        if ic > max_ic:
-            max_ic = ic
-    tree.create_node('max_ic','max_ic', data=max_ic,parent=0)
-    return
+def setMaxIC(tree: Tree, ic_mode: str) -> float:
+    """Computes the maximum IC of a taxonomy and keeps it in the metadata of its compiled version, the tree is not changed."""
+    taxonomy = getCompiledTaxonomy(tree)
+    max_ic = getICVector(taxonomy, ic_mode).max().item()
+    taxonomy.metadata[('max_ic', ic_mode)] = max_ic
+    return max_ic
 
 def getMaxIC(tree: Tree, ic_mode: str) -> float:
-    if not tree.contains('max_ic'):
-            setMaxIC(tree, ic_mode)
-    return tree.get_node('max_ic').data
+    taxonomy = getCompiledTaxonomy(tree)
+    if ('max_ic', ic_mode) not in taxonomy.metadata:
+        setMaxIC(taxonomy, ic_mode)
+    return taxonomy.metadata[('max_ic', ic_mode)]
 
-def setMaxDistOrSim(tree: Tree, ic_mode: str, cs_mode: str):
-    max_dist_or_sim = 0
-    depth = tree.depth()
-    for node1 in tree.all_nodes():
-        concept1 = node1.identifier
-        for node2 in tree.all_nodes():
-            concept2 = node2.identifier
-            cs = getCS(concept1,concept2,tree,depth,ic_mode,cs_mode)
-            if cs > max_dist_or_sim:
-                max_dist_or_sim = cs
-    tree.create_node('max_dist_or_sim','max_dist_or_sim', data=max_dist_or_sim,parent=0)
-    return
-
-def getMaxDistOrSim(tree: Tree, ic_mode: str, cs_mode: str) -> float:
-    if not tree.contains('max_dist_or_sim'):
-            setMaxDistOrSim(tree, ic_mode, cs_mode)
-    return tree.get_node('max_dist_or_sim').data
-
-def getCSMatrix(concepts_1: list, concepts_2: list, tree: Tree, ic_mode, cs_mode) -> ndarray:
+def setMaxDistOrSim(tree: Tree, ic_mode: str, cs_mode: str, cache: CSCache=None) -> float:
+    """
+    Computes the maximum CS value of all concept pairs of a taxonomy (at least 0) and keeps it in the metadata of its compiled version. \n
+    All measures only depend on the LCA and the sum of the ICs (or depths) of both concepts and are monotone in that sum,
+    so for every LCA only the pairs with the smallest and largest sum are evaluated with the batch kernels of getCSBlock:
+    pairs from two different child subtrees, pairs of a concept and one of its descendants, and identical concepts.
+    Batet pairs use the LCA where a concept is its own ancestor and skip identical concepts. cache is not needed anymore.
+    """
+    taxonomy = getCompiledTaxonomy(tree)
+    parents = taxonomy.parents.astype(np.int64)
+    depth = taxonomy.depth()
+    if cs_mode in ('nguyen_almubaid','batet','path_based'):
+        values = taxonomy.depths.astype(np.float64)
+    else:
+        values = np.asarray(getICVector(taxonomy, ic_mode), dtype=np.float64)
+
+    # smallest and largest value of every subtree (with and without its root), children before parents
+    subtree_min, subtree_max = values.copy(), values.copy()
+    below_min, below_max = np.full(len(values), np.inf), np.full(len(values), -np.inf)
+    for level in range(int(taxonomy.depths.max()), 0, -1):
+        nodes = np.flatnonzero(taxonomy.depths == level)
+        np.minimum.at(below_min, parents[nodes], subtree_min[nodes])
+        np.maximum.at(below_max, parents[nodes], subtree_max[nodes])
+        subtree_min[parents[nodes]] = np.minimum(subtree_min[parents[nodes]], below_min[parents[nodes]])
+        subtree_max[parents[nodes]] = np.maximum(subtree_max[parents[nodes]], below_max[parents[nodes]])
+
+    # proper LCA of a node and its descendants or itself: its parent (the root for the root)
+    proper_lcas = np.maximum(parents, 0)
+    # (lca, non-proper lca, smallest sum, largest sum, identical concepts) of the pair groups
+    groups = []
+    inner = np.flatnonzero(np.isfinite(below_min))
+    groups.append((proper_lcas[inner], inner, values[inner] + below_min[inner], values[inner] + below_max[inner], False))
+    if cs_mode != 'batet':
+        nodes = np.arange(len(values))
+        groups.append((proper_lcas, nodes, 2*values, 2*values, True))
+    # two smallest subtree minima and two largest subtree maxima among the children of every node
+    children = np.flatnonzero(parents >= 0)
+    for subtree_values, sign in ((subtree_min, 1), (subtree_max, -1)):
+        order = children[np.lexsort((sign*subtree_values[children], parents[children]))]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = parents[order[1:]] != parents[order[:-1]]
+        second = np.flatnonzero(~first[1:] & first[:-1]) + 1
+        lcas = parents[order[second]]
+        sums = subtree_values[order[second]] + subtree_values[order[second - 1]]
+        groups.append((lcas, lcas, sums, sums, False))
+
+    lcas = np.concatenate([group[0] for group in groups]*2)
+    shared = np.concatenate([group[1] for group in groups]*2)
+    sums = np.concatenate([group[2] for group in groups] + [group[3] for group in groups])
+    identical = np.concatenate([np.full(len(group[0]), group[4]) for group in groups]*2)
+    zeros = np.zeros(len(sums))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if cs_mode == 'path_based':
+            cs = cs_algorithms.getPathBasedDistBatch(sums, zeros, depth)
+        elif cs_mode == 'nguyen_almubaid':
+            cs = cs_algorithms.getCSNguyenAlMubaidBatch(sums, zeros, values[lcas], depth)
+        elif cs_mode == 'batet':
+            cs = cs_algorithms.getCSBatetBatch(sums, zeros, values[shared])
+        elif cs_mode == 'wu_palmer':
+            cs = cs_algorithms.getCSWuPalmerBatch(sums, zeros, values[lcas])
+        elif cs_mode == 'li':
+            cs = cs_algorithms.getCSLiBatch(sums, zeros, values[lcas])
+        elif cs_mode == 'simple_wu_palmer':
+            cs = cs_algorithms.getCSSimpleWuPalmerBatch(values[lcas], depth)
+        elif cs_mode == 'leacock_chodorow':
+            max_ic = depth if ic_mode == 'levels' else getMaxIC(taxonomy, ic_mode)
+            cs = cs_algorithms.getCSLeacockChodorowBatch(sums, zeros, values[lcas], max_ic)
+        else:
+            try:
+                raise ValueError('Unsupported CS-mode: ',cs_mode)
+            except ValueError as err:
+                print(err.args)
+                sys.exit()
+
+    if cs_mode in ('wu_palmer','simple_wu_palmer','path_based'):
+        # identical concepts are not computed with the formula, see getCS
+        cs = np.where(identical, 0.0 if cs_mode == 'path_based' else 1.0, cs)
+    max_dist_or_sim = max(0.0, float(np.nanmax(cs)))
+    taxonomy.metadata[('max_cs', ic_mode, cs_mode)] = max_dist_or_sim
+    return max_dist_or_sim
+
+def getMaxDistOrSim(tree: Tree, ic_mode: str, cs_mode: str, cache: CSCache=None) -> float:
+    taxonomy = getCompiledTaxonomy(tree)
+    if ('max_cs', ic_mode, cs_mode) not in taxonomy.metadata:
+        setMaxDistOrSim(taxonomy, ic_mode, cs_mode, cache)
+    return taxonomy.metadata[('max_cs', ic_mode, cs_mode)]
+
+def getCSMatrix(concepts_1: list, concepts_2: list, tree: Tree, ic_mode, cs_mode, cache: CSCache=None) -> ndarray:
     """ Returns CS matrix for given concept sets. """
     cs_matrix = np.zeros(shape=(len(concepts_1),len(concepts_2)))
+    tree = getCompiledTaxonomy(tree)
     depth = tree.depth()
 
-    for concept1 in concepts_1:
-        c1_index = concepts_1.index(concept1)
-        for concept2 in concepts_2:
-            c2_index = concepts_2.index(concept2)
-            cs_matrix[c1_index,c2_index] = getCS(concept1,concept2,tree,depth,ic_mode,cs_mode)
+    for c1_index, concept1 in enumerate(concepts_1):
+        for c2_index, concept2 in enumerate(concepts_2):
+            cs_matrix[c1_index,c2_index] = getCS(concept1,concept2,tree,depth,ic_mode,cs_mode,cache)
             
     return cs_matrix
 
 def normalize(matrix: ndarray) -> ndarray:
+    if isinstance(matrix, CondensedMatrix):
+        # rescaled in place, the matrix might not fit into memory twice
+        return matrix.normalize()
     return matrix/np.max(matrix)
 
-def getSetDistMatrixWrapper(p):
-    """Wrapper for the parallel-process-function"""
-    return getSetDistMatrix(*p)
-
-def getSetDistMatrix(sets: list, tree: Tree, worker_index, max_workers,ic_mode,cs_mode,setsim_mode) -> ndarray:
-    """
-    Function for the parallelized processes. \n 
-    Computes the part of the (absolute) distance matrix of the given conceptsets, 
-    that corresponds to the worker index of the calling process.
-    """
-    length = len(sets)
-    start = getStart(worker_index, max_workers, length)
-    stop = getStop(worker_index, max_workers, length)
-    dist_matrix = np.zeros(shape=(stop-start, length))
-    i = 0
-    for set1 in sets[start:stop]: 
-        set1_index = sets.index(set1)
-        for set2 in sets[set1_index:]:
-            setsim = getSetSim(concepts_1=set1, concepts_2=set2, tree=tree,ic_mode=ic_mode,cs_mode=cs_mode,setsim_mode=setsim_mode)
-            # safe SetSim values in matrix (only upper triangular)
-            dist_matrix[i, sets.index(set2)] = setsim
-        i+=1
-    return dist_matrix, worker_index
-
 def getScaledSetSim(setSim, len1, len2):
     ''' Used to scale the set-similarities to account for differences in set-sizes that might impair the accuracy of the calculations. '''
     setDiff = abs(len1 - len2)
     maxSim = min(len1,len2)
     return setSim/(maxSim + math.log(setDiff + 1))
 
+def getScaledSetSims(matrix: ndarray, sizes_1: ndarray, sizes_2: ndarray) -> ndarray:
+    ''' Vectorized getScaledSetSim for a matrix of set sims and the sizes of its row and column sets. '''
+    sizes_1 = np.asarray(sizes_1)[:, None]
+    sizes_2 = np.asarray(sizes_2)[None, :]
+    return matrix/(np.minimum(sizes_1, sizes_2) + np.log(np.abs(sizes_1 - sizes_2) + 1))
+
 def getModifierLabel(root: ET.Element, modifier: str, mod_code: str) -> str:
     for mod_class in root.iter('ModifierClass'):
         if mod_class.get('code') == mod_code and mod_class.get('modifier') == modifier:
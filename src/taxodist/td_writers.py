@@ -0,0 +1,165 @@
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+from numpy import ndarray
+from src.taxodist.td_matrix import CondensedMatrix, CHUNK_SIZE
+from src.taxodist import td_profiling
+
+class RowBlockWriter:
+    """
+    Sink for the row blocks of td_utils.iterSetSimBlocks: write(row_start, block) is called for every block as it arrives,
+    close() once at the end. Writers can be used as context managers.
+    """
+    def __init__(self, path: str, length: int, dtype=np.float64) -> None:
+        self.path = path
+        self.length = length
+        self.dtype = np.dtype(dtype)
+
+    def write(self, row_start: int, block: ndarray):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> 'RowBlockWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class NpyWriter(RowBlockWriter):
+    """Writes into a memory-mapped .npy file in the layout of td_matrix.CondensedMatrix, read it with CondensedMatrix.open(path)."""
+    def __init__(self, path: str, length: int, dtype=np.float64) -> None:
+        super().__init__(path, length, dtype)
+        self.matrix = CondensedMatrix.create(length, self.dtype, path)
+
+    def write(self, row_start: int, block: ndarray):
+        self.matrix.set_block(row_start, row_start, block)
+
+    def close(self):
+        self.matrix.flush()
+
+class ParquetWriter(RowBlockWriter):
+    """Writes the upper triangle in long format (columns row, col, sim) to a Parquet file, one row group per block. Requires pyarrow."""
+    def __init__(self, path: str, length: int, dtype=np.float64) -> None:
+        super().__init__(path, length, dtype)
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as err:
+            raise ImportError('Writing Parquet files requires pyarrow (pip install taxodist[parquet])') from err
+        self.pa = pa
+        schema = pa.schema([('row', pa.int64()), ('col', pa.int64()), ('sim', pa.from_numpy_dtype(self.dtype))])
+        self.writer = pq.ParquetWriter(path, schema)
+
+    def write(self, row_start: int, block: ndarray):
+        rows, cols = np.nonzero(np.triu(np.ones(block.shape, dtype=bool)))
+        table = self.pa.table({'row': rows + row_start, 'col': cols + row_start, 'sim': block[rows, cols].astype(self.dtype)})
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+class HDF5Writer(RowBlockWriter):
+    """Writes into the upper triangle of a chunked, compressed length x length dataset of an HDF5 file. Requires h5py."""
+    def __init__(self, path: str, length: int, dtype=np.float64, dataset: str = 'set_sims') -> None:
+        super().__init__(path, length, dtype)
+        try:
+            import h5py
+        except ImportError as err:
+            raise ImportError('Writing HDF5 files requires h5py (pip install taxodist[hdf5])') from err
+        self.file = h5py.File(path, 'w')
+        self.dataset = self.file.create_dataset(dataset, shape=(length, length), dtype=self.dtype, chunks=True, compression='gzip')
+
+    def write(self, row_start: int, block: ndarray):
+        self.dataset[row_start:row_start + len(block), row_start:] = block
+
+    def close(self):
+        self.file.close()
+
+class NpzWriter(RowBlockWriter):
+    """Writes every block as compressed array rows_<row_start> of an .npz archive, read it with np.load(path)."""
+    def __init__(self, path: str, length: int, dtype=np.float64) -> None:
+        super().__init__(path, length, dtype)
+        self.archive = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def write(self, row_start: int, block: ndarray):
+        with self.archive.open('rows_%d.npy' % row_start, 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.ascontiguousarray(block, dtype=self.dtype))
+
+    def close(self):
+        self.archive.close()
+
+class CSVWriter(RowBlockWriter):
+    """Writes the upper triangle in long format (columns row, col, sim) to a CSV file."""
+    def __init__(self, path: str, length: int, dtype=np.float64) -> None:
+        super().__init__(path, length, dtype)
+        self.file = open(path, 'w')
+        self.file.write('row,col,sim\n')
+
+    def write(self, row_start: int, block: ndarray):
+        rows, cols = np.nonzero(np.triu(np.ones(block.shape, dtype=bool)))
+        pd.DataFrame({'row': rows + row_start, 'col': cols + row_start, 'sim': block[rows, cols]}).to_csv(self.file, header=False, index=False)
+
+    def close(self):
+        self.file.close()
+
+class ExcelWriter(RowBlockWriter):
+    """
+    Writes the symmetric square matrix to an Excel sheet. \n
+    The whole matrix is kept in memory until close, and sheets are limited to 16384 columns.
+    """
+    MAX_COLUMNS = 16384
+
+    def __init__(self, path: str, length: int, dtype=np.float64) -> None:
+        super().__init__(path, length, dtype)
+        if length + 1 > self.MAX_COLUMNS:
+            raise ValueError('Matrix exceeds the column limit of Excel sheets: ', length)
+        self.matrix = np.zeros((length, length), dtype=self.dtype)
+
+    def write(self, row_start: int, block: ndarray):
+        self.matrix[row_start:row_start + len(block), row_start:] = block
+
+    def close(self):
+        pd.DataFrame(self.matrix + np.triu(self.matrix, 1).T).to_excel(self.path)
+
+WRITERS = {'.npy': NpyWriter, '.npz': NpzWriter, '.csv': CSVWriter, '.parquet': ParquetWriter, '.h5': HDF5Writer, '.hdf5': HDF5Writer, '.xlsx': ExcelWriter}
+
+def getRowBlockWriter(path: str, length: int, dtype=np.float64) -> RowBlockWriter:
+    """Returns the writer for the file extension of path (.npy, .npz, .csv, .parquet, .h5, .hdf5 or .xlsx)."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError('Unsupported output file type: ', extension)
+    return WRITERS[extension](path, length, dtype)
+
+def writeBlocks(blocks, writer: RowBlockWriter) -> RowBlockWriter:
+    """Passes all (row_start, block) tuples to the writer and closes it. Returns the writer."""
+    instrumentation = td_profiling.active
+    try:
+        for row_start, block in blocks:
+            with instrumentation.phase('output'):
+                writer.write(row_start, block)
+    finally:
+        with instrumentation.phase('output'):
+            writer.close()
+    return writer
+
+def iterMatrixBlocks(matrix, block_size: int = None):
+    """Yields the upper triangle of a symmetric ndarray or td_matrix.CondensedMatrix as row blocks, like td_utils.iterSetSimBlocks."""
+    length = len(matrix)
+    if block_size is None:
+        block_size = max(1, CHUNK_SIZE//max(length, 1))
+    for row_start in range(0, length, block_size):
+        row_stop = min(row_start + block_size, length)
+        if isinstance(matrix, CondensedMatrix):
+            block = matrix.get_pairs(np.arange(row_start, row_stop)[:, None], np.arange(row_start, length)[None, :])
+        else:
+            block = np.asarray(matrix[row_start:row_stop, row_start:])
+        yield row_start, np.triu(block)
+
+def writeMatrix(matrix, writer) -> RowBlockWriter:
+    """Writes a symmetric matrix with a writer or, if writer is a path, with the writer for its file extension (see getRowBlockWriter)."""
+    if isinstance(writer, str):
+        writer = getRowBlockWriter(writer, len(matrix), matrix.dtype)
+    return writeBlocks(iterMatrixBlocks(matrix), writer)
@@ -3,135 +3,294 @@ import treelib
 import xml.etree.ElementTree as ET
 import sys
 import os
+import contextlib
+import tracemalloc
+from timeit import default_timer as timer
 sys.path.append(os.getcwd())
 from src.taxodist import td_utils as utils
+from src.taxodist import td_storage
+from src.taxodist.td_taxonomy import CompiledTaxonomy
 
-def getICD10GMTree(version = '2022'):
+# source files of the implemented taxonomies by (taxonomy, version)
+SOURCE_FILES = {
+    ('ICD-10-GM', '2021'): os.path.join('resources', 'ICD_10_GM_2021.xml'),
+    ('ICD-10-GM', '2022'): os.path.join('resources', 'ICD_10_GM_2022.xml'),
+    ('ICD-10-CM', '2022'): os.path.join('resources', 'ICD_10_CM_2022.xml'),
+    ('ICD-10-WHO', '2019'): os.path.join('resources', 'ICD_10_WHO_2019.xml'),
+    ('ICD-O-3', '2019'): os.path.join('resources', 'ICD_O_3_2019.xml'),
+}
+
+def getICD10GMTree(version = '2022', streaming: bool = False, stats: dict = None, trace_memory: bool = False):
     """
     Returns a tree that represents the ICD-10-GM taxonomy. \n
-    Based on the ICD-10-XML export from https://www.dimdi.de/dynamic/de/klassifikationen/downloads/
+    Based on the ICD-10-XML export from https://www.dimdi.de/dynamic/de/klassifikationen/downloads/ \n
+    With streaming, the XML is read incrementally and every element is freed once it is consumed (see iterClaMLElements).
+    If a stats dict is given, it receives the elapsed time of the parse, or with trace_memory its peak memory and the
+    elapsed time while tracing, which is slower (see measureParse).
     """
-    if(version == '2021'):
-        raw_xml = ET.parse('resources/ICD_10_GM_2021.xml')
-    elif(version == '2022'):
-        raw_xml = ET.parse('resources/ICD_10_GM_2022.xml')
-    root = raw_xml.getroot()
+    with measureParse(stats, trace_memory):
+        classes, modifier_values, modifier_labels = getClaMLRecords(getClaMLElements(SOURCE_FILES[('ICD-10-GM', version)], streaming))
+        tree = buildICD10GMTree(classes, modifier_values, modifier_labels)
+    return tree
+
+def buildICD10GMTree(classes: list, modifier_values: dict, modifier_labels: dict) -> treelib.Tree:
+    """Builds the ICD-10-GM tree, including the modifier codes, from the records of getClaMLRecords."""
     tree = treelib.Tree()
     tree.create_node('ICD-10', 0)
+    addClaMLClasses(tree, classes, with_labels=True)
 
-    # create all nodes
-    for clss in root.iter('Class'):
-        data =  clss.find('Rubric').find('Label').text
-        tree.create_node(clss.get('code'), clss.get('code'), parent=0, data=data)
-
-    # move them to represent the hierarchy
-    for clss in root.iter('Class'):
-        if clss.get('kind') != 'chapter':
-            for superclass in clss.iter('SuperClass'):
-                tree.move_node(clss.get('code'), superclass.get('code'))
-    
     # add modifier codes
-    for clss in root.iter('Class'):
-        parent_name = clss.get('code')
-        parent = tree.get_node(parent_name)
-        
-        class_mods = clss.findall('ModifiedBy')
+    for parent_name, kind, superclasses, label, class_mods, valid_mod_classes in classes:
         if len(class_mods) > 1:
-            # iterate over class modifiers
-            for mod1 in root.iter('Modifier'):
-                if mod1.get('code') == class_mods[0].get('code'):
-                    for val1 in mod1.iter('SubClass'):
-                        for mod2 in root.iter('Modifier'):
-                            if mod2.get('code') == class_mods[1].get('code'):
-                                for val2 in mod2.iter('SubClass'):
-                                    # merge the modifier values
-                                    data = clss.find('Rubric').find('Label').text
-                                    data = data+' | '+utils.getModifierLabel(root,mod1.get('code'),val1.get('code'))+' & '+utils.getModifierLabel(root,mod2.get('code'),val2.get('code'))
-                                    node_name = parent_name+val1.get('code')+val2.get('code')
-                                    tree.create_node(node_name, node_name, parent=parent, data=data)
+            # merge the values of the first two class modifiers
+            mod1, mod2 = class_mods[0][0], class_mods[1][0]
+            for val1 in modifier_values.get(mod1, []):
+                for val2 in modifier_values.get(mod2, []):
+                    data = label+' | '+modifier_labels.get((mod1,val1))+' & '+modifier_labels.get((mod2,val2))
+                    node_name = parent_name+val1+val2
+                    tree.create_node(node_name, node_name, parent=parent_name, data=data)
         else:
-            for cls_mod in clss.iter('ModifiedBy'): 
-                if cls_mod.get('all') == 'false':
+            for mod, mod_all in class_mods:
+                if mod_all == 'false':
                     # only add valid modifier codes
-                    for modclass in clss.iter('ValidModifierClass'):
-                        mod_class_code = modclass.get('code')
-                        data = clss.find('Rubric').find('Label').text
-                        data = data+' | '+utils.getModifierLabel(root=root, modifier = cls_mod.get('code'), mod_code = mod_class_code)
-                        node_name = parent_name+mod_class_code
-                        tree.create_node(node_name, node_name, parent=parent, data=data)
+                    mod_codes = valid_mod_classes
                 else:
-                    #find corresponding modifier
-                    for mod in root.iter('Modifier'):
-                        # get values of class modifier
-                        if mod.get('code') == cls_mod.get('code'):
-                            for value in mod.iter('SubClass'):
-                                mod_code = value.get('code')
-                                data = clss.find('Rubric').find('Label').text
-                                data = data+' | '+utils.getModifierLabel(root=root, modifier = mod.get('code'), mod_code = mod_code)
-                                node_name = parent_name+mod_code
-                                tree.create_node(node_name, node_name, parent=parent, data=data)
+                    mod_codes = modifier_values.get(mod, [])
+                for mod_code in mod_codes:
+                    data = label+' | '+modifier_labels.get((mod,mod_code))
+                    node_name = parent_name+mod_code
+                    tree.create_node(node_name, node_name, parent=parent_name, data=data)
     
     return tree
 
-def getICDO3Tree():
+def getClaMLRecords(elements):
     """
-    Returns a tree that represents the ICD-O-3 taxonomy. \n
-    Based on the ICD-O-3-XML export from https://www.bfarm.de/DE/Kodiersysteme/Services/Downloads/_node.html
+    Collects everything the ClaML tree builders need in one pass over the top-level elements of the document. \n
+    Returns
+    * the classes in document order as (code, kind, superclasses, label, modified_by, valid_modifier_classes) tuples,
+      where modified_by holds (modifier, all) tuples
+    * the SubClass codes of every Modifier by modifier code
+    * the label of every ModifierClass by (modifier, code)
     """
-    raw_xml = ET.parse('resources\\ICD_O_3_2019.xml')
-    root = raw_xml.getroot()
-    tree = treelib.Tree()
-    tree.create_node('ICD-O-3', 0)
+    classes = []
+    modifier_values = {}
+    modifier_labels = {}
+    for element in elements:
+        if element.tag == 'Class':
+            classes.append((
+                element.get('code'),
+                element.get('kind'),
+                [superclass.get('code') for superclass in element.iter('SuperClass')],
+                getRubricLabel(element),
+                [(mod.get('code'), mod.get('all')) for mod in element.findall('ModifiedBy')],
+                [mod_class.get('code') for mod_class in element.iter('ValidModifierClass')],
+            ))
+        elif element.tag == 'Modifier':
+            values = modifier_values.setdefault(element.get('code'), [])
+            values.extend(value.get('code') for value in element.iter('SubClass'))
+        elif element.tag == 'ModifierClass':
+            # the first ModifierClass of a code wins, as in td_utils.getModifierLabel
+            modifier_labels.setdefault((element.get('modifier'), element.get('code')), getRubricLabel(element))
+    return classes, modifier_values, modifier_labels
+
+def getClaMLElements(path: str, streaming: bool = False):
+    """Returns the top-level elements of a ClaML file, either from the parsed document or streamed."""
+    if streaming:
+        return iterClaMLElements(path)
+    return ET.parse(path).getroot()
 
-    # create all nodes
-    for clss in root.iter('Class'):
-        tree.create_node(clss.get('code'), clss.get('code'), parent=0)
+def iterClaMLElements(path: str):
+    """
+    Yields the top-level elements (Class, Modifier, ...) of a ClaML file as soon as they are parsed.
+    Each element is cleared once the consumer moves on, so the document is never held in memory as a whole.
+    """
+    depth = 0
+    root = None
+    for event, element in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                yield element
+                element.clear()
+                root.clear()
+
+@contextlib.contextmanager
+def measureParse(stats: dict = None, trace_memory: bool = False):
+    """
+    Context manager that writes the elapsed time (s) of its block into stats as elapsed_time. Does nothing if stats is None. \n
+    With trace_memory, it writes the peak of traced Python memory (bytes) as peak_memory instead. tracemalloc slows parsing
+    down several times, so the elapsed time is then written as elapsed_time_traced; measure time and memory in separate runs.
+    """
+    if stats is None:
+        yield
+        return
+    if not trace_memory:
+        start = timer()
+        try:
+            yield
+        finally:
+            stats['elapsed_time'] = timer() - start
+        return
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = timer()
+    try:
+        yield
+    finally:
+        stats['elapsed_time_traced'] = timer() - start
+        stats['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        if not was_tracing:
+            tracemalloc.stop()
 
-    # move them to represent the hierarchy
-    for clss in root.iter('Class'):
-        if clss.get('kind') != 'chapter':
-            for superclass in clss.iter('SuperClass'):
-                tree.move_node(clss.get('code'), superclass.get('code'))
+def getRubricLabel(element: ET.Element) -> str:
+    """Returns the label of the first rubric of a ClaML element."""
+    rubric = element.find('Rubric')
+    if rubric is None or rubric.find('Label') is None:
+        return None
+    return rubric.find('Label').text
+
+def addClaMLClasses(tree: treelib.Tree, classes: list, with_labels: bool = False):
+    """
+    Adds the ClaML classes from getClaMLRecords to the tree, directly below their (last) superclass.
+    Chapters are added below the root. \n
+    Classes whose superclass is defined later in the document wait below the root and are moved once their
+    superclass exists, so the children keep document order.
+    """
+    waiting = {}
+    for code, kind, superclasses, label, class_mods, valid_mod_classes in classes:
+        parent = 0
+        if kind != 'chapter' and len(superclasses) > 0:
+            parent = superclasses[-1]
+        data = label if with_labels else None
+        if tree.contains(parent):
+            tree.create_node(code, code, parent=parent, data=data)
+        else:
+            tree.create_node(code, code, parent=0, data=data)
+            waiting.setdefault(parent, []).append(code)
+        for child in waiting.pop(code, []):
+            tree.move_node(child, code)
+    if waiting:
+        raise ValueError('Unknown superclasses: ', list(waiting))
 
+def getICDO3Tree(streaming: bool = False, stats: dict = None, trace_memory: bool = False):
+    """
+    Returns a tree that represents the ICD-O-3 taxonomy. \n
+    Based on the ICD-O-3-XML export from https://www.bfarm.de/DE/Kodiersysteme/Services/Downloads/_node.html \n
+    See getICD10GMTree for streaming, stats and trace_memory.
+    """
+    with measureParse(stats, trace_memory):
+        classes, _, _ = getClaMLRecords(getClaMLElements(SOURCE_FILES[('ICD-O-3', '2019')], streaming))
+        tree = treelib.Tree()
+        tree.create_node('ICD-O-3', 0)
+        addClaMLClasses(tree, classes)
     return tree
 
-def getICD10WHOTree():
+def getICD10WHOTree(streaming: bool = False, stats: dict = None, trace_memory: bool = False):
     """
     Returns a tree that represents the ICD-10-WHO taxonomy. \n
-    Based on the ICD-10-WHO-XML export from https://www.bfarm.de/DE/Kodiersysteme/Services/Downloads/_node.html
+    Based on the ICD-10-WHO-XML export from https://www.bfarm.de/DE/Kodiersysteme/Services/Downloads/_node.html \n
+    See getICD10GMTree for streaming, stats and trace_memory.
     """
-    raw_xml = ET.parse('resources\\ICD_10_WHO_2019.xml')
-    root = raw_xml.getroot()
-    tree = treelib.Tree()
-    tree.create_node('ICD-10-WHO', 0)
+    with measureParse(stats, trace_memory):
+        classes, _, _ = getClaMLRecords(getClaMLElements(SOURCE_FILES[('ICD-10-WHO', '2019')], streaming))
+        tree = treelib.Tree()
+        tree.create_node('ICD-10-WHO', 0)
+        addClaMLClasses(tree, classes)
+    return tree
 
-    # create all nodes
-    for clss in root.iter('Class'):
-        tree.create_node(clss.get('code'), clss.get('code'), parent=0)
+def getICD10CMTree(streaming: bool = False, stats: dict = None, trace_memory: bool = False):
+    """
+    Returns a tree that represents the ICD-10-CM taxonomy. \n
+    Based on the ICD-10-CM-XML export from \n
+    See getICD10GMTree for streaming, stats and trace_memory.
+    """
+    with measureParse(stats, trace_memory):
+        if streaming:
+            tree = buildICD10CMTreeStreaming(SOURCE_FILES[('ICD-10-CM', '2022')])
+        else:
+            raw_xml = ET.parse(SOURCE_FILES[('ICD-10-CM', '2022')])
+            root = raw_xml.getroot()
+            tree = treelib.Tree()
+            tree.create_node('ICD-10-CM', 0)
 
-    # move them to represent the hierarchy
-    for clss in root.iter('Class'):
-        if clss.get('kind') != 'chapter':
-            for superclass in clss.iter('SuperClass'):
-                tree.move_node(clss.get('code'), superclass.get('code'))
+            # iterate over chapters, sections & diags to create tree
+            for chapter in root.iter('chapter'):
+                chapter_node = tree.create_node(chapter.find('name').text, chapter.find('name').text, parent=0)
+                for section in chapter.iter('section'):
+                    section_node = tree.create_node(section.get('id'), section.get('id'), parent=chapter_node)
+                    utils.iterateOverDiags(section,section_node,tree)
 
     return tree
 
-def getICD10CMTree():
+def buildICD10CMTreeStreaming(path: str) -> treelib.Tree:
     """
-    Returns a tree that represents the ICD-10-CM taxonomy. \n
-    Based on the ICD-10-CM-XML export from
+    Builds the ICD-10-CM tree with iterparse, same result as the DOM-based path of getICD10CMTree. \n
+    Chapters and diags are created when their name has been read, sections when they start.
+    Diags whose name already exists are skipped, their children go to the closest created ancestor.
     """
-    raw_xml = ET.parse('resources/ICD_10_CM_2022.xml')
-    root = raw_xml.getroot()
     tree = treelib.Tree()
     tree.create_node('ICD-10-CM', 0)
+    # open elements and the tree node created for each of them (None if there is none)
+    tags = []
+    nodes = []
+    root = None
+    for event, element in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            node = None
+            if element.tag == 'section' and 'chapter' in tags:
+                node = element.get('id')
+                tree.create_node(node, node, parent=getClosestNode(nodes))
+            tags.append(element.tag)
+            nodes.append(node)
+            continue
 
-    # iterate over chapters, sections & diags to create tree
-    for chapter in root.iter('chapter'):
-        chapter_node = tree.create_node(chapter.find('name').text, chapter.find('name').text, parent=0)
-        for section in chapter.iter('section'):
-            section_node = tree.create_node(section.get('id'), section.get('id'), parent=chapter_node)
-            utils.iterateOverDiags(section,section_node,tree)
+        tags.pop()
+        nodes.pop()
+        if element.tag == 'name' and tags:
+            name = element.text
+            if tags[-1] == 'chapter' and nodes[-1] is None:
+                tree.create_node(name, name, parent=0)
+                nodes[-1] = name
+            elif tags[-1] == 'diag' and nodes[-1] is None and 'section' in tags and not tree.contains(name):
+                tree.create_node(name, name, parent=getClosestNode(nodes[:-1]))
+                nodes[-1] = name
+        elif element.tag in ('chapter', 'section', 'diag'):
+            element.clear()
+            if element.tag == 'chapter':
+                root.clear()
+    return tree
+
+def getClosestNode(nodes: list):
+    """Returns the last created node in the stack of open elements."""
+    for node in reversed(nodes):
+        if node is not None:
+            return node
+    return 0
 
-    return tree
\ No newline at end of file
+def getCompiledTree(taxonomy: str = 'ICD-10-GM', version: str = '2022', cache_dir: str = td_storage.CACHE_DIR) -> CompiledTaxonomy:
+    """
+    Returns the compiled taxonomy (see td_taxonomy) of one of the implemented taxonomies. \n
+    The parsed result is cached on disk, keyed by the hash of the source file and the version,
+    and loaded as a memory map, so only the first call has to parse the XML.
+    """
+    parsers = {
+        'ICD-10-GM': lambda: getICD10GMTree(version=version, streaming=True),
+        'ICD-10-CM': lambda: getICD10CMTree(streaming=True),
+        'ICD-10-WHO': lambda: getICD10WHOTree(streaming=True),
+        'ICD-O-3': lambda: getICDO3Tree(streaming=True),
+    }
+    try:
+        if (taxonomy, version) not in SOURCE_FILES:
+            raise ValueError('Unsupported taxonomy version: ', taxonomy, version)
+    except ValueError as err:
+        print(err.args)
+        sys.exit()
+    return td_storage.getCachedTaxonomy(SOURCE_FILES[(taxonomy, version)], parsers[taxonomy], version=version, cache_dir=cache_dir)
@@ -0,0 +1,90 @@
+import unittest
+import sys
+import os
+import treelib
+import numpy as np
+sys.path.append(os.getcwd())
+from src.taxodist import td_utils as utils
+from src.taxodist.td_cache import CSCache, ENTRY_SIZE
+from src.taxodist.td_calc import Taxodist
+
+class cacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = getTestTree()
+        self.depth = self.tree.depth()
+
+    def test_zeroIsHit(self):
+        cache = CSCache()
+        # 1 and 9 only share the root, so their Wu-Palmer similarity is 0
+        self.assertEqual(utils.getCS(1,9,self.tree,self.depth,'levels','wu_palmer',cache), 0.0)
+        self.assertEqual(utils.getCS(9,1,self.tree,self.depth,'levels','wu_palmer',cache), 0.0)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_modeAwareKeys(self):
+        cache = CSCache()
+        wu_palmer = utils.getCS(30,31,self.tree,self.depth,'levels','wu_palmer',cache)
+        li = utils.getCS(30,31,self.tree,self.depth,'levels','li',cache)
+        self.assertNotEqual(wu_palmer, li)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_eviction(self):
+        cache = CSCache(max_entries=2)
+        for concept in (10,11,12):
+            utils.getCS(1,concept,self.tree,self.depth,'levels','wu_palmer',cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_memoryCap(self):
+        cache = CSCache(max_memory=5*ENTRY_SIZE)
+        for concept in range(10,14):
+            for other in (30,31):
+                utils.getCS(concept,other,self.tree,self.depth,'levels','wu_palmer',cache)
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(cache.stats()['evictions'], 3)
+        # blocks that exceed the bound on their own are not cached
+        cache.put(('big',), np.zeros(1000))
+        self.assertIsNone(cache.get(('big',)))
+
+    def test_CSBlock(self):
+        cache = CSCache(max_entries=100)
+        taxonomy = utils.getCompiledTaxonomy(self.tree)
+        ids = taxonomy.get_ids([1,10,20,30,31])
+        block = utils.getCSBlock(ids, ids, taxonomy, 'levels', 'wu_palmer', cache)
+        self.assertIs(utils.getCSBlock(ids, ids, taxonomy, 'levels', 'wu_palmer', cache), block)
+        self.assertFalse(block.flags.writeable)
+        self.assertTrue(np.array_equal(block, utils.getCSBlock(ids, ids, taxonomy, 'levels', 'wu_palmer')))
+        self.assertIsNot(utils.getCSBlock(ids, ids, taxonomy, 'levels', 'li', cache), block)
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses'], cache.stats()['values']), (1, 2, 50))
+
+    def test_setSimCache(self):
+        td = Taxodist()
+        sets = [[1,10],[20,30,31],[9]]
+        for setsim_mode in ('mean_cs','bipartite_matching'):
+            first = td.calc_set_sim(sets, self.tree, 'levels', 'wu_palmer', setsim_mode)
+            second = td.calc_set_sim(sets, self.tree, 'levels', 'wu_palmer', setsim_mode)
+            self.assertTrue(np.array_equal(first, second))
+        # one vocabulary CS matrix, computed once and reused by the other three runs
+        self.assertEqual((td.cache.stats()['hits'], td.cache.stats()['misses']), (3, 1))
+        td.calc_set_sim_par(sets, self.tree, 'levels', 'wu_palmer', 'mean_cs', max_workers=1)
+        self.assertEqual(td.cache.stats()['hits'], 4)
+
+def getTestTree():
+        tree = treelib.Tree()
+        tree.create_node('test', 0)
+
+        for i in range(1,10):
+            tree.create_node(i,i,parent=0)
+
+        for i in range (10,14):
+            tree.create_node(i,i,parent=1)
+
+        tree.create_node(20,20,parent=10)
+        tree.create_node(30,30,parent=20)
+        tree.create_node(31,31,parent=20)
+
+        return tree
+
+if __name__ == '__main__':
+    unittest.main()
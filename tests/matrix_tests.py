@@ -0,0 +1,187 @@
+import unittest
+import importlib.util
+import sys
+import os
+import tempfile
+import pandas as pd
+import treelib
+import numpy as np
+from scipy.spatial.distance import squareform
+sys.path.append(os.getcwd())
+from src.taxodist import td_utils as utils
+from src.taxodist.td_matrix import CondensedMatrix
+from src.taxodist.td_taxonomy import CompiledTaxonomy
+from src.taxodist import td_embedding
+from src.taxodist import td_writers
+from src.taxodist.td_calc import Taxodist
+
+class condensedMatrixTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        upper = np.triu(rng.random((7,7)))
+        self.square = upper + np.triu(upper, 1).T
+        self.matrix = CondensedMatrix.create(7, dtype=np.float64)
+        self.matrix.set_block(0, 0, self.square[:4])
+        self.matrix.set_block(4, 4, self.square[4:, 4:])
+
+    def test_layout(self):
+        without_diagonal = self.square - np.diag(np.diag(self.square))
+        self.assertTrue(np.array_equal(self.matrix.condensed, squareform(without_diagonal, checks=False)))
+        self.assertTrue(np.array_equal(self.matrix.diagonal, np.diag(self.square)))
+        self.assertTrue(np.array_equal(self.matrix.to_square(), self.square))
+
+    def test_accessors(self):
+        for i in range(7):
+            self.assertTrue(np.array_equal(self.matrix.row(i), self.square[i]))
+            for j in range(7):
+                self.assertEqual(self.matrix.get(i, j), self.square[i, j])
+        rows, cols = np.meshgrid(np.arange(7), np.arange(7))
+        self.assertTrue(np.array_equal(self.matrix.get_pairs(rows.ravel(), cols.ravel()), self.square[rows.ravel(), cols.ravel()]))
+
+    def test_memmapAndNormalize(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'matrix.npy')
+            matrix = CondensedMatrix.create(7, dtype=np.float32, path=path)
+            matrix.set_block(0, 0, self.square)
+            matrix.normalize()
+            matrix.flush()
+            loaded = CondensedMatrix.open(path)
+            self.assertEqual(loaded.dtype, np.float32)
+            self.assertTrue(np.allclose(loaded.to_square(), self.square/self.square.max()))
+            del matrix, loaded
+
+    def test_condensedDistMatrix(self):
+        taxonomy = CompiledTaxonomy(getTestTree())
+        ids = taxonomy.get_ids(utils.getAllConcepts(taxonomy))
+        dense = utils.mirrorMatrix(utils.getDistMatrix(ids, taxonomy, 'levels', 'li', max_workers=1, tile_size=4))
+        condensed = utils.getDistMatrix(ids, taxonomy, 'levels', 'li', max_workers=2, tile_size=4, storage='condensed')
+        self.assertTrue(np.allclose(condensed.to_square(), dense))
+        with tempfile.TemporaryDirectory() as tmp:
+            mapped = utils.getDistMatrix(ids, taxonomy, 'levels', 'li', max_workers=2, tile_size=4, storage='condensed', dtype=np.float16, path=os.path.join(tmp, 'dist.npy'))
+            self.assertTrue(np.allclose(mapped.to_square(), dense, atol=1e-3))
+            del mapped
+
+class writerTests(unittest.TestCase):
+
+    def setUp(self):
+        upper = np.triu(np.random.default_rng(2).random((9,9)))
+        self.square = upper + np.triu(upper, 1).T
+
+    def test_writers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            condensed = CondensedMatrix.create(9, dtype=np.float64)
+            condensed.set_block(0, 0, self.square)
+            for matrix in [self.square, condensed]:
+                path = os.path.join(tmp, 'matrix.npy')
+                td_writers.writeMatrix(matrix, path)
+                loaded = CondensedMatrix.open(path)
+                self.assertTrue(np.array_equal(loaded.to_square(), self.square))
+                del loaded
+
+            path = os.path.join(tmp, 'matrix.npz')
+            td_writers.writeBlocks(td_writers.iterMatrixBlocks(self.square, block_size=4), td_writers.getRowBlockWriter(path, 9))
+            with np.load(path) as archive:
+                self.assertEqual(sorted(archive.files), ['rows_0', 'rows_4', 'rows_8'])
+                self.assertTrue(np.array_equal(archive['rows_4'], np.triu(self.square[4:8, 4:])))
+
+            path = os.path.join(tmp, 'matrix.csv')
+            td_writers.writeMatrix(self.square, path)
+            pairs = pd.read_csv(path)
+            self.assertEqual(len(pairs), 9*10//2)
+            self.assertTrue(np.allclose(pairs['sim'], self.square[pairs['row'], pairs['col']]))
+
+            path = os.path.join(tmp, 'matrix.xlsx')
+            td_writers.writeMatrix(self.square, path)
+            self.assertTrue(np.allclose(pd.read_excel(path, index_col=0).to_numpy(), self.square))
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'requires pyarrow')
+    def test_parquetWriter(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'matrix.parquet')
+            writer = td_writers.writeBlocks(td_writers.iterMatrixBlocks(self.square, block_size=4), td_writers.getRowBlockWriter(path, 9, np.float32))
+            self.assertIsInstance(writer, td_writers.ParquetWriter)
+            pairs = pd.read_parquet(path)
+            self.assertEqual(list(pairs.columns), ['row', 'col', 'sim'])
+            self.assertEqual(pairs['sim'].dtype, np.float32)
+            self.assertEqual(len(pairs), 9*10//2)
+            self.assertTrue((pairs['row'] <= pairs['col']).all())
+            self.assertTrue(np.allclose(pairs['sim'], self.square[pairs['row'], pairs['col']]))
+
+    @unittest.skipUnless(importlib.util.find_spec('h5py'), 'requires h5py')
+    def test_hdf5Writer(self):
+        import h5py
+        with tempfile.TemporaryDirectory() as tmp:
+            for path in [os.path.join(tmp, 'matrix.h5'), os.path.join(tmp, 'matrix.hdf5')]:
+                writer = td_writers.writeBlocks(td_writers.iterMatrixBlocks(self.square, block_size=4), td_writers.getRowBlockWriter(path, 9))
+                self.assertIsInstance(writer, td_writers.HDF5Writer)
+                with h5py.File(path, 'r') as f:
+                    self.assertTrue(np.array_equal(f['set_sims'][:], np.triu(self.square)))
+
+    def test_noDefaultExport(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                stats = {}
+                matrix = Taxodist().calc_distance_with_concepts(taxonomy_tree=getTestTree(), embedding='classical', embedding_stats=stats, writer='distances.npy')
+                self.assertEqual(os.listdir(tmp), ['distances.npy'])
+                self.assertEqual(stats['coordinates'].shape, (len(matrix), 2))
+            finally:
+                os.chdir(cwd)
+
+class embeddingTests(unittest.TestCase):
+
+    def setUp(self):
+        # euclidean distances of planar points are reproduced exactly by classical and landmark MDS
+        self.points = np.random.default_rng(1).random((1200, 2))
+        self.dists = np.linalg.norm(self.points[:, None] - self.points[None, :], axis=2)
+
+    def test_classicalAndLandmarkMDS(self):
+        for dists in [self.dists[:300, :300], self.dists]:
+            condensed = CondensedMatrix.create(len(dists), dtype=np.float64)
+            condensed.set_block(0, 0, dists)
+            for matrix in [dists, condensed]:
+                for embedding_mode in ['classical','landmark']:
+                    stats = {}
+                    coordinates = td_embedding.getEmbedding(matrix, embedding_mode, n_landmarks=20, stats=stats)
+                    self.assertEqual(coordinates.shape, (len(dists), 2))
+                    self.assertLess(stats['stress'], 1e-6, (len(dists), embedding_mode))
+                    self.assertGreaterEqual(stats['elapsed_time'], 0)
+
+    def test_condensedStorage(self):
+        tree = getTestTree()
+        coordinates = {}
+        for storage in ['dense','condensed']:
+            stats = {}
+            Taxodist().calc_distance_with_concepts(taxonomy_tree=tree, cs_mode='wu_palmer', storage=storage, max_workers=1, embedding='landmark', embedding_stats=stats)
+            self.assertIn('stress', stats, storage)
+            coordinates[storage] = stats['coordinates'].to_numpy()
+        # the coordinates are unique up to reflections
+        self.assertTrue(np.allclose(np.abs(coordinates['dense']), np.abs(coordinates['condensed'])))
+
+    def test_smacofAndNone(self):
+        stats = {}
+        coordinates = td_embedding.getEmbedding(self.dists[:50, :50], 'smacof', stats=stats)
+        self.assertEqual(coordinates.shape, (50, 2))
+        self.assertLess(stats['stress'], 0.1)
+        self.assertIsNone(td_embedding.getEmbedding(self.dists, 'none'))
+
+def getTestTree():
+        tree = treelib.Tree()
+        tree.create_node('test', 0)
+
+        for i in range(1,10):
+            tree.create_node(i,i,parent=0)
+
+        for i in range (10,14):
+            tree.create_node(i,i,parent=1)
+
+        tree.create_node(20,20,parent=10)
+        tree.create_node(30,30,parent=20)
+        tree.create_node(31,31,parent=20)
+
+        return tree
+
+if __name__ == '__main__':
+    unittest.main()
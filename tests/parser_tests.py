@@ -0,0 +1,114 @@
+import unittest
+import sys
+import os
+import json
+import tempfile
+from unittest import mock
+import numpy as np
+sys.path.append(os.getcwd())
+from src.taxodist import tree_parsers
+from src.taxodist.td_taxonomy import CompiledTaxonomy
+
+FIXTURES = os.path.join('tests', 'fixtures')
+# small excerpts of the taxonomy files, with modifiers and a class before its superclass
+FIXTURE_FILES = {
+    ('ICD-10-GM', '2022'): os.path.join(FIXTURES, 'icd10gm_claml.xml'),
+    ('ICD-10-WHO', '2019'): os.path.join(FIXTURES, 'icd10gm_claml.xml'),
+    ('ICD-10-CM', '2022'): os.path.join(FIXTURES, 'icd10cm_tabular.xml'),
+    ('ICD-O-3', '2019'): os.path.join('resources', 'ICD_O_3_2019.xml'),
+}
+PARSERS = {
+    'ICD-10-GM': lambda streaming: tree_parsers.getICD10GMTree('2022', streaming=streaming),
+    'ICD-10-CM': lambda streaming: tree_parsers.getICD10CMTree(streaming=streaming),
+    'ICD-10-WHO': lambda streaming: tree_parsers.getICD10WHOTree(streaming=streaming),
+    'ICD-O-3': lambda streaming: tree_parsers.getICDO3Tree(streaming=streaming),
+}
+
+class claMLParserTests(unittest.TestCase):
+    """Compares the ClaML parsers with the trees of the original parser (create all nodes, then move them), recorded in tests/fixtures."""
+
+    def test_ICDO3Tree(self):
+        self.assertEqual(getNodes(tree_parsers.getICDO3Tree()), getFixture('icd_o_3_2019_tree.json'))
+
+    def test_ICD10GMTree(self):
+        with mock.patch.dict(tree_parsers.SOURCE_FILES, FIXTURE_FILES):
+            tree = tree_parsers.getICD10GMTree('2022')
+        self.assertEqual(getNodes(tree), getFixture('icd10gm_claml_tree.json'))
+
+    def test_claMLRecords(self):
+        classes, modifier_values, modifier_labels = tree_parsers.getClaMLRecords(tree_parsers.getClaMLElements(FIXTURE_FILES[('ICD-10-GM', '2022')]))
+        self.assertEqual(classes[0], ('I', 'chapter', [], 'Chapter one', [], []))
+        self.assertEqual(classes[5], ('A01', 'category', ['A00-A09'], 'Category A01', [('S03', 'false')], ['.2', '.0']))
+        self.assertEqual(modifier_values, {'S01': ['0', '1', '9'], 'S02': ['0', '1'], 'S03': ['.0', '.1', '.2']})
+        # the first ModifierClass of a code wins
+        self.assertEqual(modifier_labels[('S02', '1')], 'Chronic')
+
+    def test_unknownSuperclass(self):
+        tree = tree_parsers.treelib.Tree()
+        tree.create_node('root', 0)
+        with self.assertRaises(ValueError):
+            tree_parsers.addClaMLClasses(tree, [('A00', 'category', ['A00-A09'], None, [], [])])
+
+class streamingParserTests(unittest.TestCase):
+    """Compares the streaming parsers (and getCompiledTree, which uses them) with the DOM-based parsers."""
+
+    def test_fixtures(self):
+        with mock.patch.dict(tree_parsers.SOURCE_FILES, FIXTURE_FILES):
+            for taxonomy, parser in PARSERS.items():
+                with self.subTest(taxonomy=taxonomy):
+                    self.assertEqual(getNodes(parser(streaming=True)), getNodes(parser(streaming=False)))
+
+    def test_ICD10CMTree(self):
+        # recorded with the original parser, like the fixtures of claMLParserTests
+        with mock.patch.dict(tree_parsers.SOURCE_FILES, FIXTURE_FILES):
+            for streaming in (False, True):
+                self.assertEqual(getNodes(tree_parsers.getICD10CMTree(streaming=streaming)), getFixture('icd10cm_tabular_tree.json'))
+
+    def test_sourceFiles(self):
+        # the taxonomy files that are present in resources
+        for (taxonomy, version), path in tree_parsers.SOURCE_FILES.items():
+            if not os.path.isfile(path):
+                continue
+            with self.subTest(taxonomy=taxonomy, version=version):
+                parser = PARSERS[taxonomy] if taxonomy != 'ICD-10-GM' else lambda streaming: tree_parsers.getICD10GMTree(version, streaming=streaming)
+                self.assertEqual(getNodes(parser(streaming=True)), getNodes(parser(streaming=False)))
+
+    def test_compiledTree(self):
+        with mock.patch.dict(tree_parsers.SOURCE_FILES, FIXTURE_FILES), tempfile.TemporaryDirectory() as cache_dir:
+            for (taxonomy, version) in FIXTURE_FILES:
+                with self.subTest(taxonomy=taxonomy):
+                    compiled = tree_parsers.getCompiledTree(taxonomy, version, cache_dir=cache_dir)
+                    expected = CompiledTaxonomy(PARSERS[taxonomy](streaming=False))
+                    self.assertEqual(compiled.codes, expected.codes)
+                    self.assertTrue(np.array_equal(compiled.parents, expected.parents))
+                    self.assertEqual([compiled.get_label(code) for code in compiled.codes], [expected.get_label(code) for code in expected.codes])
+
+class parseStatsTests(unittest.TestCase):
+
+    def test_measureParse(self):
+        stats, traced_stats = {}, {}
+        tree_parsers.getICDO3Tree(streaming=True, stats=stats)
+        tree_parsers.getICDO3Tree(streaming=True, stats=traced_stats, trace_memory=True)
+        # the time is only measured without tracing
+        self.assertEqual(list(stats), ['elapsed_time'])
+        self.assertEqual(sorted(traced_stats), ['elapsed_time_traced', 'peak_memory'])
+        self.assertGreater(traced_stats['peak_memory'], 0)
+
+def getNodes(tree):
+    """Returns the [identifier, parent, data] of all nodes of the tree in preorder, children in their order in the tree."""
+    nodes = []
+    stack = [tree.root]
+    while stack:
+        identifier = stack.pop()
+        node = tree.get_node(identifier)
+        parent = tree.parent(identifier)
+        nodes.append([identifier, parent.identifier if parent is not None else None, node.data])
+        stack.extend(reversed(node.successors(tree.identifier)))
+    return nodes
+
+def getFixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+if __name__ == '__main__':
+    unittest.main()
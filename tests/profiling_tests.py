@@ -0,0 +1,90 @@
+import unittest
+import sys
+import os
+import pstats
+import tempfile
+import numpy as np
+sys.path.append(os.getcwd())
+from src.taxodist import td_utils as utils
+from src.taxodist import td_profiling
+from src.taxodist.td_calc import Taxodist
+from benchmarks import synthetic
+
+class profilingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = synthetic.getSkewedTree(200)
+        self.sets = [[1,5,20], [3,4], [150,151,199], [7]]
+
+    def test_disabledByDefault(self):
+        td = Taxodist()
+        self.assertIs(td.instrumentation, td_profiling.NULL_INSTRUMENTATION)
+        td.calc_distance_with_concepts(None, self.tree, max_workers=1)
+        self.assertIsNone(td.get_report())
+        self.assertIs(td_profiling.active, td_profiling.NULL_INSTRUMENTATION)
+
+    def test_report(self):
+        td = Taxodist(instrument=True)
+        tree = synthetic.getSkewedTree(1000)
+        matrix = td.calc_distance_with_concepts(None, tree, 'sanchez', 'wu_palmer', max_workers=1, tile_size=64)
+        td.calc_set_sim(self.sets, tree, 'levels', 'wu_palmer', 'mean_cs')
+        self.assertTrue(np.allclose(matrix, Taxodist().calc_distance_with_concepts(None, tree, 'sanchez', 'wu_palmer', max_workers=1)))
+
+        report = td.get_report()
+        self.assertEqual(report['runs'], {'calc_distance_with_concepts': 1, 'calc_set_sim': 1})
+        for phase in ('tree_parse', 'ic', 'lca', 'cs', 'set_sim', 'normalize', 'mds', 'other'):
+            self.assertIn(phase, report['phases'])
+        # phases are exclusive, so the phases of the runs add up to their total time
+        run_time = sum(phase['time'] for phase in report['phases'].values())
+        self.assertTrue(np.isclose(run_time, report['total_time'], rtol=0.05), (run_time, report['total_time']))
+        self.assertEqual(report['counters']['tiles'], len(utils.getUpperTriangleTiles(999, 64)))
+        self.assertEqual(sum(worker['tiles'] for worker in report['workers'].values()), report['counters']['tiles'])
+
+    def test_setSimParReport(self):
+        td = Taxodist(instrument=True)
+        td.calc_set_sim_par(self.sets, self.tree, 'levels', 'wu_palmer', 'mean_cs', max_workers=2, tile_size=2)
+        report = td.get_report()
+        self.assertEqual(report['counters']['tiles'], len(utils.getUpperTriangleTiles(len(self.sets), 2)))
+        self.assertEqual(sum(worker['tiles'] for worker in report['workers'].values()), report['counters']['tiles'])
+
+    def test_setSimCounters(self):
+        td = Taxodist(instrument=True)
+        for _ in range(2):
+            td.calc_set_sim(self.sets, self.tree, 'levels', 'wu_palmer', 'mean_cs')
+        counters = td.get_report()['counters']
+        n_values = len(set().union(*self.sets))**2
+        self.assertEqual((counters['cs_lookups'], counters['cs_values']), (2*n_values, n_values))
+        self.assertEqual((counters['cs_cache_hits'], counters['cs_cache_misses']), (n_values, n_values))
+        self.assertEqual(counters['set_sims'], 2*len(self.sets)*(len(self.sets) + 1)//2)
+
+        # the set sims are computed in the worker processes
+        td.calc_set_sim_par(self.sets, self.tree, 'levels', 'wu_palmer', 'mean_cs', max_workers=2, tile_size=2)
+        counters = td.get_report()['counters']
+        self.assertEqual(counters['set_sims'], 3*len(self.sets)*(len(self.sets) + 1)//2)
+        self.assertEqual(counters['cs_cache_hits'], 2*n_values)
+
+    def test_getCSCounters(self):
+        td = Taxodist(instrument=True)
+        with td.instrumentation.phase('tree_parse'):
+            tree = synthetic.getSkewedTree(200)
+        self.assertEqual(td.get_report()['phases']['tree_parse']['calls'], 1)
+        td_profiling.active = td.instrumentation
+        try:
+            utils.getCS(1, 5, tree, tree.depth(), 'levels', 'wu_palmer', td.cache)
+            utils.getCS(5, 1, tree, tree.depth(), 'levels', 'wu_palmer', td.cache)
+        finally:
+            td_profiling.active = td_profiling.NULL_INSTRUMENTATION
+        counters = td.get_report()['counters']
+        self.assertEqual((counters['getCS'], counters['cs_cache_hits'], counters['cs_cache_misses']), (2, 1, 1))
+
+    def test_profileDump(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'run.prof')
+            td = Taxodist(profile_path=path)
+            td.calc_set_sim_par(self.sets, self.tree, 'levels', 'li', 'bipartite_matching', max_workers=1)
+            self.assertEqual(td.get_report()['profile_path'], path)
+            functions = [function for _, _, function in pstats.Stats(path).stats]
+            self.assertIn('calc_set_sim_par', functions)
+
+if __name__ == '__main__':
+    unittest.main()
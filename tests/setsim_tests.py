@@ -0,0 +1,212 @@
+import unittest
+import sys
+import os
+import math
+import random
+import tempfile
+from unittest import mock
+import treelib
+import numpy as np
+sys.path.append(os.getcwd())
+from src.taxodist import td_utils as utils
+from src.taxodist.td_calc import Taxodist
+from src.taxodist.td_state import SetSimState
+from src.taxodist.td_matrix import CondensedMatrix
+from src.taxodist.td_index import SetSimIndex
+from benchmarks import synthetic
+
+class setSimTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = getTestTree()
+        random.seed(1)
+        concepts = utils.getAllConcepts(self.tree)
+        self.sets = [set(random.sample(concepts, random.randint(1,5))) for _ in range(12)]
+        self.sets.append(self.sets[0])
+
+    def test_trivialSetSimMatrix(self):
+        for setsim_mode in utils.TRIVIAL_SETSIM_MODES:
+            matrix = utils.getTrivialSetSimMatrix(self.sets, setsim_mode, block_size=5)
+            condensed = utils.getTrivialSetSimMatrix(self.sets, setsim_mode, storage='condensed', block_size=3)
+            for i, set1 in enumerate(self.sets):
+                for j, set2 in enumerate(self.sets):
+                    expected = utils.getSetSim(set1, set2, setsim_mode, self.tree, 'wu_palmer', 'levels') if j >= i else 0.0
+                    self.assertTrue(math.isclose(matrix[i,j], expected, rel_tol=1e-12), (setsim_mode, set1, set2))
+                    self.assertTrue(math.isclose(condensed.get(i,j), utils.getSetSim(set1, set2, setsim_mode, self.tree, 'wu_palmer', 'levels'), rel_tol=1e-12))
+
+    def test_scaledTrivialSetSims(self):
+        taxodist = Taxodist()
+        matrix = taxodist.calc_set_sim(self.sets, self.tree, 'levels', 'wu_palmer', 'jaccard')
+        for i, set1 in enumerate(self.sets):
+            for j, set2 in enumerate(self.sets):
+                expected = utils.getScaledSetSim(utils.getSetSim(set1, set2, 'jaccard', self.tree, 'wu_palmer', 'levels'), len(set1), len(set2))
+                self.assertTrue(math.isclose(matrix[i,j], expected, rel_tol=1e-12))
+
+    def test_CSSetSimMatrix(self):
+        taxonomy = utils.getCompiledTaxonomy(self.tree)
+        for setsim_mode in ['mean_cs','hierarchical']:
+            for ic_mode in ['levels','sanchez']:
+                for cs_mode in ['wu_palmer','li','simple_wu_palmer','nguyen_almubaid','path_based']:
+                    matrix = utils.getCSSetSimMatrix(self.sets, taxonomy, ic_mode, cs_mode, setsim_mode, block_size=4)
+                    for i, set1 in enumerate(self.sets):
+                        for j, set2 in enumerate(self.sets):
+                            expected = utils.getSetSim(set1, set2, setsim_mode, taxonomy, cs_mode, ic_mode) if j >= i else 0.0
+                            self.assertTrue(math.isclose(matrix[i,j], expected, rel_tol=1e-9, abs_tol=1e-12), (setsim_mode, ic_mode, cs_mode, set1, set2))
+
+    def test_bipartiteMatchingSetSimMatrix(self):
+        taxonomy = utils.getCompiledTaxonomy(self.tree)
+        # covers identical, 1 x k, enumerated and linear_sum_assignment problems
+        sets = self.sets + [set(utils.getAllConcepts(self.tree)[:7]), set(utils.getAllConcepts(self.tree)[5:])]
+        for ic_mode in ['levels','sanchez']:
+            for cs_mode in ['wu_palmer','li','simple_wu_palmer','nguyen_almubaid','path_based']:
+                matrix = utils.getBipartiteMatchingSetSimMatrix(sets, taxonomy, ic_mode, cs_mode, block_size=5)
+                for i, set1 in enumerate(sets):
+                    for j, set2 in enumerate(sets):
+                        expected = utils.getSetSim(set1, set2, 'bipartite_matching', taxonomy, cs_mode, ic_mode) if j >= i else 0.0
+                        self.assertTrue(math.isclose(matrix[i,j], expected, rel_tol=1e-9, abs_tol=1e-12), (ic_mode, cs_mode, set1, set2))
+
+    def test_bipartiteMatchingPruning(self):
+        taxonomy = utils.getCompiledTaxonomy(self.tree)
+        for cs_mode, threshold in [('wu_palmer', 1.5), ('path_based', 4.0)]:
+            matrix = utils.mirrorMatrix(utils.getBipartiteMatchingSetSimMatrix(self.sets, taxonomy, 'levels', cs_mode))
+            sign = 1 if cs_mode == 'wu_palmer' else -1
+            stats = {}
+            neighbours = utils.getBipartiteMatchingNeighbours(self.sets, taxonomy, 'levels', cs_mode, threshold=threshold, stats=stats)
+            for i, matches in enumerate(neighbours):
+                expected = {j for j in range(len(self.sets)) if j != i and sign*matrix[i,j] >= sign*threshold}
+                self.assertEqual({j for j, _ in matches}, expected)
+                for j, sim in matches:
+                    self.assertTrue(math.isclose(sim, matrix[i,j], rel_tol=1e-9))
+            self.assertEqual(stats['pairs'], stats['pruned'] + stats['solved'])
+            self.assertGreater(stats['pruned'], 0)
+
+            neighbours = utils.getBipartiteMatchingNeighbours(self.sets, taxonomy, 'levels', cs_mode, top_k=3)
+            for i, matches in enumerate(neighbours):
+                others = sorted((sign*matrix[i,j] for j in range(len(self.sets)) if j != i), reverse=True)
+                self.assertTrue(np.allclose([sign*sim for _, sim in matches], others[:3]))
+
+    def test_setSimIndex(self):
+        taxodist = Taxodist()
+        for setsim_mode, cs_mode in [('jaccard','wu_palmer'), ('mean_cs','wu_palmer'), ('mean_cs','path_based'), ('hierarchical','wu_palmer'), ('bipartite_matching','wu_palmer'), ('bipartite_matching','path_based')]:
+            for scale_to_setsizes in (False, True):
+                index = taxodist.create_set_sim_index(self.sets, self.tree, 'levels', cs_mode, setsim_mode, scale_to_setsizes)
+                matrix = utils.mirrorMatrix(utils.getBatchSetSimMatrix(self.sets, index.taxonomy, 'levels', cs_mode, setsim_mode))
+                if scale_to_setsizes:
+                    sizes = [len(concepts) for concepts in self.sets]
+                    matrix = utils.getScaledSetSims(matrix, sizes, sizes)
+                sign = 1 if index.is_distance else -1
+                for i, query in enumerate(self.sets):
+                    stats = {}
+                    result = index.query(query, top_k=4, stats=stats)
+                    self.assertEqual(result, index.query(query, top_k=4, exact=True), (setsim_mode, cs_mode, query))
+                    expected = np.sort(sign*matrix[i])[:4]*sign
+                    self.assertTrue(np.allclose([sim for _, sim in result], expected), (setsim_mode, cs_mode, query))
+                    for j, sim in result:
+                        self.assertTrue(math.isclose(sim, matrix[i,j], rel_tol=1e-9, abs_tol=1e-12))
+                    self.assertLessEqual(stats['scored'], len(self.sets))
+
+    def test_setSimIndexPruning(self):
+        tree = synthetic.getICD10LikeTree(blocks=4, codes=4, modifiers=4, chapters=4)
+        sets = synthetic.getRandomConceptSets(tree, 300, 1, 8)
+        queries = synthetic.getRandomConceptSets(tree, 10, 1, 8, seed=7)
+        taxonomy = utils.getCompiledTaxonomy(tree)
+        for cs_mode in ('wu_palmer', 'path_based'):
+            index = SetSimIndex(sets, tree, 'levels', cs_mode, 'bipartite_matching')
+            for query in queries:
+                stats = {}
+                result = index.query(query, top_k=5, stats=stats)
+                self.assertEqual(result, index.query(query, top_k=5, exact=True))
+                sims = [utils.getSetSimIds(taxonomy.get_ids(sorted(query)), index.sets[j], 'bipartite_matching', taxonomy, cs_mode, 'levels') for j in range(len(sets))]
+                self.assertTrue(np.allclose([sim for _, sim in result], sorted(sims, reverse=not index.is_distance)[:5]))
+                self.assertLess(stats['scored'], len(sets))
+
+    def test_setSimState(self):
+        taxodist = Taxodist()
+        for setsim_mode, cs_mode in [('dice','wu_palmer'), ('mean_cs','li'), ('hierarchical','wu_palmer'), ('bipartite_matching','path_based')]:
+            with tempfile.TemporaryDirectory() as tmp:
+                state = taxodist.create_set_sim_state(tmp, self.sets[:5], self.tree, 'levels', cs_mode, setsim_mode)
+                state.append_sets(self.sets[5:9])
+                state.remove_sets([1, 6])
+                state = SetSimState.open(tmp, self.tree)
+                self.assertEqual(list(state.append_sets(self.sets[9:])), list(range(9, len(self.sets))))
+
+                kept = [i for i in range(len(self.sets)) if i not in (1, 6)]
+                expected = utils.mirrorMatrix(utils.getBatchSetSimMatrix([self.sets[i] for i in kept], state.taxonomy, 'levels', cs_mode, setsim_mode))
+                self.assertTrue(np.allclose(state.to_condensed().to_square(), expected), (setsim_mode, cs_mode))
+                self.assertTrue(np.allclose(state.row(kept[2]), expected[2]))
+                state.compact()
+                self.assertEqual(len(state), len(kept))
+                self.assertTrue(np.allclose(SetSimState.open(tmp, self.tree).to_condensed().to_square(), expected))
+
+    def test_interruptedAppend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            state = SetSimState.create(tmp, self.sets[:5], self.tree, 'levels', 'wu_palmer', 'hierarchical')
+            n_concepts = len(state.vocabulary)
+            # the files are written, but the header is not replaced
+            with mock.patch('src.taxodist.td_state.replaceFile', side_effect=[None, None, None, OSError()]):
+                with self.assertRaises(OSError):
+                    state.append_sets(self.sets[5:])
+            state = SetSimState.open(tmp, self.tree)
+            self.assertEqual((len(state), len(state.vocabulary)), (5, n_concepts))
+            state.append_sets(self.sets[5:])
+
+            expected = utils.mirrorMatrix(utils.getBatchSetSimMatrix(self.sets, state.taxonomy, 'levels', 'wu_palmer', 'hierarchical'))
+            self.assertTrue(np.allclose(SetSimState.open(tmp, self.tree).to_condensed().to_square(), expected))
+            # CS values are only appended, as packed lower triangle of the vocabulary
+            self.assertEqual(os.path.getsize(os.path.join(tmp, 'cs.bin')), len(state.vocabulary)*(len(state.vocabulary) + 1)//2*8)
+
+    def test_streamedSetSims(self):
+        taxodist = Taxodist()
+        for setsim_mode in ['cosine','hierarchical','bipartite_matching']:
+            expected = utils.getBatchSetSimMatrix(self.sets, utils.getCompiledTaxonomy(self.tree), 'levels', 'wu_palmer', setsim_mode)
+            row_stop = 0
+            for row_start, block in taxodist.iter_set_sim(self.sets, self.tree, 'levels', 'wu_palmer', setsim_mode, block_size=5):
+                self.assertEqual(row_start, row_stop)
+                self.assertTrue(np.allclose(block, expected[row_start:row_start + len(block), row_start:]))
+                row_stop = row_start + len(block)
+            self.assertEqual(row_stop, len(self.sets))
+            with tempfile.TemporaryDirectory() as tmp:
+                path = taxodist.calc_set_sim_par(self.sets, self.tree, 'levels', 'wu_palmer', setsim_mode, normalize=False, output_path=os.path.join(tmp, 'sims.npy'))
+                matrix = CondensedMatrix.open(path)
+                self.assertTrue(np.allclose(matrix.to_square(), utils.mirrorMatrix(expected)))
+                del matrix
+
+    def test_thresholdedSetSims(self):
+        taxonomy = utils.getCompiledTaxonomy(self.tree)
+        for setsim_mode, cs_mode, threshold in [('jaccard','wu_palmer',0.2), ('mean_cs','wu_palmer',0.3), ('hierarchical','wu_palmer',0.5), ('bipartite_matching','path_based',4.0)]:
+            matrix = utils.getBatchSetSimMatrix(self.sets, taxonomy, 'levels', cs_mode, setsim_mode)
+            hits = (matrix <= threshold) if utils.isDistance(cs_mode, setsim_mode) else (matrix >= threshold)
+            hits = np.triu(hits, 1)
+            blocks = [set(utils.getBlockingAncestors(taxonomy.get_ids(concepts), taxonomy, 1).tolist()) for concepts in self.sets]
+            for block_level in [0, 1]:
+                stats = {}
+                sparse_matrix = utils.getThresholdedSetSimMatrix(self.sets, taxonomy, 'levels', cs_mode, setsim_mode, threshold, block_level, stats=stats)
+                expected = hits.copy()
+                if block_level == 1:
+                    expected &= np.array([[bool(blocks[i] & blocks[j]) for j in range(len(self.sets))] for i in range(len(self.sets))])
+                else:
+                    self.assertEqual(stats['candidates'], stats['pairs'])
+                # pairs with a sim of 0 are stored explicitly
+                pairs = sparse_matrix.tocoo()
+                self.assertEqual(set(zip(pairs.row.tolist(), pairs.col.tolist())), set(zip(*np.nonzero(expected))), (setsim_mode, block_level))
+                self.assertTrue(np.allclose(pairs.data, matrix[pairs.row, pairs.col]))
+                self.assertEqual(stats['kept'], int(expected.sum()))
+
+def getTestTree():
+        tree = treelib.Tree()
+        tree.create_node('test', 0)
+
+        for i in range(1,10):
+            tree.create_node(i,i,parent=0)
+
+        for i in range (10,14):
+            tree.create_node(i,i,parent=1)
+
+        tree.create_node(20,20,parent=10)
+        tree.create_node(30,30,parent=20)
+        tree.create_node(31,31,parent=20)
+
+        return tree
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+import unittest
+import sys
+import os
+import math
+import random
+import tempfile
+import treelib
+import numpy as np
+sys.path.append(os.getcwd())
+from src.taxodist import td_utils as utils
+from src.taxodist import ic_algorithms
+from src.taxodist.td_taxonomy import CompiledTaxonomy
+from src.taxodist.td_calc import Taxodist
+from src.taxodist import td_storage
+from benchmarks import synthetic
+
+CS_MODES = ['wu_palmer','li','simple_wu_palmer','leacock_chodorow','nguyen_almubaid','batet','path_based']
+
+class compiledTaxonomyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = getTestTree()
+        self.taxonomy = CompiledTaxonomy(self.tree)
+        self.concepts = utils.getAllConcepts(self.tree)
+
+    def test_structure(self):
+        self.assertEqual(len(self.taxonomy), self.tree.size())
+        self.assertEqual(self.taxonomy.depth(), self.tree.depth())
+        self.assertEqual(sorted(utils.getAllConcepts(self.taxonomy)), sorted(self.concepts))
+        for concept in self.concepts:
+            self.assertEqual(self.taxonomy.level(concept), self.tree.level(concept))
+            self.assertEqual(self.taxonomy.is_leaf(concept), self.tree.get_node(concept).is_leaf())
+
+    def test_changedTree(self):
+        tree = treelib.Tree()
+        tree.create_node('root', 'root')
+        for code, parent in (('A', 'root'), ('B', 'root'), ('A1', 'A'), ('B1', 'B')):
+            tree.create_node(code, code, parent=parent)
+        self.assertEqual(utils.getCS('A1', 'B1', tree, tree.depth(), 'levels', 'wu_palmer'), 0.0)
+        # same size, different structure
+        tree.move_node('B1', 'A')
+        self.assertEqual(utils.getCS('A1', 'B1', tree, tree.depth(), 'levels', 'wu_palmer'), 0.5)
+
+        compiled = utils.getCompiledTaxonomy(tree)
+        tree.get_node('B1').data = 'label'
+        self.assertIs(utils.getCompiledTaxonomy(tree), compiled)
+        utils.invalidateCompiledTaxonomy(tree)
+        self.assertEqual(utils.getCompiledTaxonomy(tree).get_label('B1'), 'label')
+
+    def test_ancestorsAndLCA(self):
+        for concept1 in self.concepts:
+            self.assertEqual(utils.getAncestors(concept1, self.taxonomy), utils.getAncestors(concept1, self.tree))
+            for concept2 in self.concepts:
+                lca = utils.getLCA(concept1, concept2, self.tree, 'levels')
+                self.assertEqual(utils.getLCA(concept1, concept2, self.taxonomy, 'levels'), lca)
+                self.assertEqual(utils.getShortestPath(concept1, concept2, self.tree.level(lca), self.taxonomy),
+                                 utils.getShortestPath(concept1, concept2, self.tree.level(lca), self.tree))
+
+    def test_vectorizedLCA(self):
+        tree = getRandomTree(500)
+        taxonomy = CompiledTaxonomy(tree)
+        ids_1 = [random.randrange(len(taxonomy)) for _ in range(200)]
+        ids_2 = [random.randrange(len(taxonomy)) for _ in range(200)]
+        lcas = taxonomy.get_proper_lca_ids(ids_1, ids_2)
+        for id_1, id_2, lca in zip(ids_1, ids_2, lcas):
+            expected = utils.getLCA(taxonomy.codes[id_1], taxonomy.codes[id_2], tree, 'levels')
+            self.assertEqual(taxonomy.codes[lca], expected)
+
+    def test_CS(self):
+        for ic_mode in ['levels','sanchez']:
+            for cs_mode in CS_MODES:
+                for concept1 in self.concepts:
+                    for concept2 in self.concepts:
+                        if cs_mode == 'batet' and concept1 == concept2:
+                            continue
+                        expected = utils.getCS(concept1, concept2, self.tree, self.tree.depth(), ic_mode, cs_mode)
+                        cs = utils.getCS(concept1, concept2, self.taxonomy, self.taxonomy.depth(), ic_mode, cs_mode)
+                        self.assertTrue(math.isclose(cs, expected, rel_tol=1e-9), (ic_mode, cs_mode, concept1, concept2))
+
+    def test_maxICAndCS(self):
+        tree = getRandomTree(150)
+        size = tree.size()
+        taxonomy = utils.getCompiledTaxonomy(tree)
+        ids = np.arange(len(taxonomy))
+        for ic_mode in ['levels','sanchez']:
+            self.assertEqual(utils.getMaxIC(tree, ic_mode), max(utils.getIC(concept, taxonomy, ic_mode) for concept in taxonomy.codes))
+            for cs_mode in CS_MODES:
+                rows = [utils.getCSBlock(ids[i:i+1], ids[ids != i] if cs_mode == 'batet' else ids, taxonomy, ic_mode, cs_mode) for i in ids]
+                expected = max(0.0, np.nanmax(np.concatenate(rows, axis=None)))
+                self.assertTrue(math.isclose(utils.getMaxDistOrSim(tree, ic_mode, cs_mode), expected, rel_tol=1e-12), (ic_mode, cs_mode))
+        self.assertEqual(tree.size(), size)
+        self.assertIs(utils.getCompiledTaxonomy(tree), taxonomy)
+
+    def test_ICVectors(self):
+        tree = getRandomTree(300)
+        taxonomy = CompiledTaxonomy(tree)
+        for node in tree.all_nodes():
+            concept = node.identifier
+            self.assertEqual(utils.getIC(concept, taxonomy, 'levels'), tree.depth(concept))
+            self.assertTrue(math.isclose(utils.getIC(concept, taxonomy, 'sanchez'), ic_algorithms.getICSanchez(concept, tree), rel_tol=1e-12))
+
+    def test_saveAndLoad(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            source = os.path.join(cache_dir, 'source.txt')
+            with open(source, 'w') as f:
+                f.write('test taxonomy')
+            stored = td_storage.getCachedTaxonomy(source, getTestTree, version='1', cache_dir=cache_dir)
+            loaded = td_storage.getCachedTaxonomy(source, None, version='1', cache_dir=cache_dir)
+            self.assertEqual(loaded.codes, self.taxonomy.codes)
+            self.assertEqual(loaded.get_fingerprint(), self.taxonomy.get_fingerprint())
+            self.assertEqual(loaded.get_label(0), 'test')
+            for concept1 in self.concepts:
+                for concept2 in self.concepts:
+                    self.assertEqual(utils.getLCA(concept1, concept2, loaded, 'levels'), utils.getLCA(concept1, concept2, stored, 'levels'))
+            del stored, loaded
+
+    def test_CSBlock(self):
+        ids = self.taxonomy.get_ids(self.concepts)
+        for ic_mode in ['levels','sanchez']:
+            for cs_mode in CS_MODES:
+                if cs_mode == 'batet':
+                    continue
+                block = utils.getCSBlock(ids, ids, self.taxonomy, ic_mode, cs_mode)
+                for i, concept1 in enumerate(self.concepts):
+                    for j, concept2 in enumerate(self.concepts):
+                        cs = utils.getCS(concept1, concept2, self.taxonomy, self.taxonomy.depth(), ic_mode, cs_mode)
+                        self.assertTrue(math.isclose(block[i,j], cs, rel_tol=1e-9), (ic_mode, cs_mode, concept1, concept2))
+
+    def test_tiledDistMatrix(self):
+        ids = self.taxonomy.get_ids(self.concepts)
+        dist_matrix = utils.getDistMatrix(ids, self.taxonomy, 'sanchez', 'wu_palmer', max_workers=1, tile_size=3)
+        parallel_matrix = utils.getDistMatrix(ids, self.taxonomy, 'sanchez', 'wu_palmer', max_workers=2, tile_size=4)
+        self.assertTrue(np.array_equal(dist_matrix, parallel_matrix))
+        for i, concept1 in enumerate(self.concepts):
+            for j, concept2 in enumerate(self.concepts):
+                expected = utils.getCS(concept1, concept2, self.taxonomy, self.taxonomy.depth(), 'sanchez', 'wu_palmer') if j >= i else 0.0
+                self.assertTrue(math.isclose(dist_matrix[i,j], expected, rel_tol=1e-9))
+
+    def test_sharedSetDistMatrix(self):
+        sets = [{1,10,30}, {31}, {2,3}, {1,10,30}, {20,4,5,6}]
+        for setsim_mode in utils.BATCH_SETSIM_MODES:
+            batch_matrix = utils.getBatchSetSimMatrix(sets, self.taxonomy, 'levels', 'wu_palmer', setsim_mode)
+            for max_workers in (1, 2):
+                dist_matrix = utils.getSetDistMatrix(sets, self.taxonomy, 'levels', 'wu_palmer', setsim_mode, max_workers=max_workers, tile_size=2)
+                self.assertTrue(np.allclose(dist_matrix, batch_matrix, rtol=1e-9, atol=0), (setsim_mode, max_workers))
+        dist_matrix = utils.getSetDistMatrix(sets, self.taxonomy, 'levels', 'wu_palmer', 'bipartite_matching', max_workers=2, tile_size=2)
+        condensed = utils.getSetDistMatrix(sets, self.taxonomy, 'levels', 'wu_palmer', 'bipartite_matching', max_workers=2, tile_size=2, storage='condensed')
+        self.assertTrue(np.allclose(condensed.to_square(), utils.mirrorMatrix(dist_matrix)))
+        for i, set1 in enumerate(sets):
+            for j, set2 in enumerate(sets):
+                expected = utils.getSetSim(set1, set2, 'bipartite_matching', self.tree, 'wu_palmer', 'levels') if j >= i else 0.0
+                self.assertTrue(math.isclose(dist_matrix[i,j], expected, rel_tol=1e-9))
+
+    def test_conceptSets(self):
+        sets = [{1,10,30}, {31}, {2,3}, {1,10,30}, {20,4,5,6}]
+        concept_sets = self.taxonomy.get_concept_sets(sets)
+        self.assertEqual(len(concept_sets), len(sets))
+        self.assertEqual([set(self.taxonomy.get_codes(concept_sets[i])) for i in range(len(sets))], sets)
+        for setsim_mode in ['jaccard','dice','cosine','overlap','mean_cs','hierarchical','bipartite_matching']:
+            for cs_mode in ['wu_palmer','path_based']:
+                for i, set1 in enumerate(sets):
+                    for j, set2 in enumerate(sets):
+                        expected = utils.getSetSim(set1, set2, setsim_mode, self.tree, cs_mode, 'levels')
+                        setsim = utils.getSetSimIds(concept_sets[i], concept_sets[j], setsim_mode, self.taxonomy, cs_mode, 'levels')
+                        self.assertTrue(math.isclose(setsim, expected, rel_tol=1e-9, abs_tol=1e-12), (setsim_mode, cs_mode, set1, set2))
+        # duplicate sets keep their own rows
+        matrix = Taxodist().calc_set_sim(concept_sets, self.tree, 'levels', 'wu_palmer', 'mean_cs')
+        self.assertTrue(np.allclose(matrix, Taxodist().calc_set_sim(sets, self.tree, 'levels', 'wu_palmer', 'mean_cs')))
+        self.assertTrue(np.array_equal(matrix[0], matrix[3]))
+
+    def test_thresholdedDistMatrix(self):
+        tree = getRandomTree(300)
+        taxonomy = CompiledTaxonomy(tree)
+        ids = np.arange(len(taxonomy), dtype=np.int32)
+        for cs_mode, threshold in [('wu_palmer', 0.6), ('path_based', 5)]:
+            dense = utils.getDistMatrix(ids, taxonomy, 'levels', cs_mode, max_workers=1)
+            hits = np.triu((dense <= threshold) if utils.isDistance(cs_mode) else (dense >= threshold), 1)
+            same_block = utils.getBlockingAncestors(ids, taxonomy, 2)
+            for block_level, expected in [(0, hits), (2, hits & (same_block[:, None] == same_block[None, :]))]:
+                matrix = Taxodist().calc_distance_with_concepts(ids, tree, 'levels', cs_mode, threshold=threshold, block_level=block_level).tocoo()
+                self.assertEqual(set(zip(matrix.row.tolist(), matrix.col.tolist())), set(zip(*np.nonzero(expected))), (cs_mode, block_level))
+                self.assertTrue(np.allclose(matrix.data, dense[matrix.row, matrix.col]))
+
+    def test_syntheticTaxonomies(self):
+        balanced = synthetic.getBalancedTree(31, fanout=2)
+        self.assertEqual((balanced.size(), balanced.depth(), len(balanced.leaves())), (31, 4, 16))
+        icd10 = synthetic.getICD10LikeTree(blocks=2, codes=2, modifiers=2)
+        self.assertEqual(icd10.depth(), 4)
+        self.assertEqual(len(icd10.children(0)), 22)
+        for shape in synthetic.TREE_SHAPES:
+            tree = synthetic.getSyntheticTree(shape, 500)
+            self.assertLess(abs(tree.size() - 500), 150, shape)
+            sets = synthetic.getRandomConceptSets(tree, 20, 2, 5, leaves_only=True)
+            self.assertEqual(sets, synthetic.getRandomConceptSets(tree, 20, 2, 5, leaves_only=True))
+            for concepts in sets:
+                self.assertTrue(2 <= len(set(concepts)) == len(concepts) <= 5)
+                self.assertTrue(all(tree.get_node(concept).is_leaf() for concept in concepts))
+            matrix = Taxodist().calc_set_sim(sets, tree, 'levels', 'wu_palmer', 'mean_cs')
+            self.assertEqual(matrix.shape, (20, 20))
+
+def getTestTree():
+        tree = treelib.Tree()
+        tree.create_node('test', 0, data='test')
+
+        for i in range(1,10):
+            tree.create_node(i,i,parent=0)
+
+        for i in range (10,14):
+            tree.create_node(i,i,parent=1)
+
+        tree.create_node(20,20,parent=10)
+        tree.create_node(30,30,parent=20)
+        tree.create_node(31,31,parent=20)
+
+        return tree
+
+def getRandomTree(size: int):
+        random.seed(42)
+        tree = treelib.Tree()
+        tree.create_node('test', 0)
+        for i in range(1,size):
+            parent = random.randrange(max(i-20,0),i)
+            tree.create_node(i,i,parent=parent)
+        return tree
+
+if __name__ == '__main__':
+    unittest.main()